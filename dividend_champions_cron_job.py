@@ -4,22 +4,24 @@ import pathlib
 import logging
 import json
 import time
-import requests
 from datetime import datetime
 import numpy as np
 import pandas as pd
-from models.stock import get_all_dividend_list, get_dividend_history_by_yahoo
+from models.stock import get_all_dividend_list, get_dividend_history_by_yahoo, load_dividend_list
+from utils import web
 
 
 DELAY_TIME_SEC = 1
 RETRY_FAILED_DELAY = 20
 RETRY_CNT = 5
+# only crawl the all dividend list until the rows of the previous all_dividend_date_list.json
+INCREMENTAL_DIVIDEND_LIST = os.environ.get("INCREMENTAL_DIVIDEND_LIST", "false").lower() == "true"
 
 
 def send_request(url):
     for r in range(RETRY_CNT):
         try:
-            res = requests.get(url)
+            res = web.http_get(url)
             res.raise_for_status()
         except Exception as ex:
             print('Generated an exception: {ex}'.format(ex=ex))
@@ -48,7 +50,7 @@ def main():
 
     # get dividend champions
     dividend_champions_url = 'https://drive.google.com/uc?id=1D4H2OoHOFVPmCoyKBVCjxIl0Bt3RLYSz&export=download'
-    res = requests.get(dividend_champions_url, allow_redirects=True)
+    res = web.http_get(dividend_champions_url, allow_redirects=True)
     if res.status_code == 200:
         with open(dividend_champions_path, 'wb')as f:
             f.write(res.content)
@@ -86,7 +88,10 @@ def main():
         f.write(json.dumps(output, separators=(',', ':')))
 
     # get all dividend list
-    all_dividend_date_list = get_all_dividend_list()
+    previous_dividend_date_list = None
+    if INCREMENTAL_DIVIDEND_LIST:
+        previous_dividend_date_list = load_dividend_list(dividend_path / 'all_dividend_date_list.json')
+    all_dividend_date_list = get_all_dividend_list(previous_dividend_date_list)
     logging.info(all_dividend_date_list)
     with open(dividend_path / 'all_dividend_date_list.json', 'w', encoding='utf-8') as f:
         f.write(json.dumps(all_dividend_date_list, separators=(',', ':')))
@@ -4,12 +4,11 @@ import json
 import pathlib
 import time
 import logging
-import requests
 import traceback
 from datetime import datetime
 from urllib.parse import urlencode
-from bs4 import BeautifulSoup
-from lxml import etree
+
+from utils import web, scraping
 
 
 DELAY_TIME_SEC = 1
@@ -23,7 +22,7 @@ def send_request(url, for_cookie=False):
     for r in range(RETRY_CNT):
         res = None
         try:
-            res = requests.get(url, headers={
+            res = web.http_get(url, headers={
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36'
             })
             res.raise_for_status()
@@ -92,31 +91,26 @@ def main():
         ret, resp, url = send_request(employees_url, False)
         if ret == 0:
             try:
-                soup = BeautifulSoup(resp, "html.parser")
-                dom = etree.HTML(str(soup))
-                tables = dom.xpath('//table[@class="historical_data_table table"]')
-                if len(tables) == 0:
+                rows = scraping.macrotrends_table_rows(resp)
+                if rows is None:
                     break
-                employees_table = tables[0]
-                rows = employees_table.xpath('.//tr')
                 if len(rows) == 0:
                     logging.error('no employees data')
                     break
                 employees_list = []
                 for r_i in range(len(rows)):
-                    row = rows[r_i]
+                    tds = rows[r_i]
                     if r_i == 0:
                         continue
-                    tds = row.xpath('.//td')
                     if len(tds) == 0:
                         continue
-                    date = tds[0].text
-                    employees_cnt = tds[1].text
+                    date = tds[0]
+                    employees_cnt = tds[1]
                     try:
                         employees_cnt = int(employees_cnt.replace(',', ''))
                         employees_list.append({'date': date, 'employees_cnt': employees_cnt})
                     except Exception as ex:
-                        logging.error('Generated an exception: {ex}, {data}'.format(ex=ex, data=[tds[0].text, tds[1].text]))
+                        logging.error('Generated an exception: {ex}, {data}'.format(ex=ex, data=tds[:2]))
                         continue
 
                 # check all empty data
@@ -4,7 +4,6 @@ import pathlib
 import argparse
 import json
 import logging
-import requests
 import traceback
 import time
 from urllib.parse import urlencode
@@ -13,6 +12,8 @@ from selenium.webdriver.firefox.service import Service as FirefoxService
 from webdriver_manager.firefox import GeckoDriverManager
 from datetime import datetime, timedelta
 
+from utils import web
+
 afscreener_url = os.environ.get(
     "AF_URL", "")
 afscreener_token = os.environ.get("AF_TOKEN", "")
@@ -34,7 +35,7 @@ def is_float(value):
 def send_request(url, for_cookie=False):
     for r in range(RETRY_CNT):
         try:
-            res = requests.get(url, headers={
+            res = web.http_get(url, headers={
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36'
             })
             res.raise_for_status()
@@ -54,7 +55,7 @@ def send_request(url, for_cookie=False):
 def send_post_json(url, req_data, headers={'content-type': 'application/json'}, cookies=None):
     for r in range(RETRY_CNT):
         try:
-            res = requests.post(url, req_data, headers=headers, cookies=cookies)
+            res = web.http_post(url, req_data, headers=headers, cookies=cookies)
             res.raise_for_status()
         except Exception as ex:
             logging.error('Generated an exception: {ex}, {res}'.format(ex=ex, res=res.text))
@@ -1,8 +1,10 @@
 import pandas as pd
 import logging
 import traceback
+import contextlib
 
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.websockets import WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
@@ -12,21 +14,43 @@ from slowapi.errors import RateLimitExceeded
 
 from rate_limiter import limiter
 from routers import option, stock
+from utils import executors, http_cache, metrics
 
 # init
 logging.basicConfig(level=logging.DEBUG)
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # a recycled gunicorn worker drains its io threads and process pool before it exits
+    executors.io.shutdown()
+    executors.cpu.shutdown()
+
+
 # rate limiter
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.state.limiter = limiter.app_limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+
+# executors
+async def executor_busy_handler(request: Request, exc: executors.ExecutorBusy):
+    # also admission.Overloaded, shed before the work starts
+    return JSONResponse({"detail": str(exc)}, status_code=503,
+                        headers={"Retry-After": str(getattr(exc, "retry_after", 1))})
+
+
+app.add_exception_handler(executors.ExecutorBusy, executor_busy_handler)
+
 # routers
 app.include_router(option.router)
 app.include_router(stock.router)
 
+# cache headers, inside gzip so the ETag digest is of the uncompressed body
+app.add_middleware(http_cache.CacheControlMiddleware)
+
 # gzip
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 
@@ -49,6 +73,13 @@ async def hello_norn(request: Request, response: Response):
     return {"msg": "Hello Norn"}
 
 
+@app.get("/metrics")
+@limiter.app_limiter.limit("60/minute")
+async def get_metrics(request: Request, response: Response):
+    # this worker's counters, e.g. the quote-valuation result cache
+    return metrics.snapshot()
+
+
 @app.websocket_route("/ws")
 async def ws_hello_norn(websocket: WebSocket):
     await websocket.accept()
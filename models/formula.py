@@ -99,14 +99,19 @@ class Stock:
 
     #  Monte Carlo
     @staticmethod
-    def price_simulation_by_mc(s0, mu, sigma, days, dt=1.0/252, iteration=1000000):
-        line_list = [s0 * np.ones(iteration)]
-        s = s0
+    def iter_price_simulation_by_mc(s0, mu, sigma, days, dt=1.0/252, iteration=1000000):
+        # the prices of all the paths one day at a time, s0 first, so a caller can reduce or write each day without
+        # keeping the whole matrix
+        s = s0 * np.ones(iteration)
+        yield s
         for d in range(days):
             zt = np.random.normal(0, 1, iteration)
             s = s * np.exp((mu - 0.5 * sigma ** 2) * dt + sigma * np.sqrt(dt) * zt)
-            line_list.append(s)
+            yield s
 
+    @staticmethod
+    def price_simulation_by_mc(s0, mu, sigma, days, dt=1.0/252, iteration=1000000):
+        line_list = list(Stock.iter_price_simulation_by_mc(s0, mu, sigma, days, dt, iteration))
         output = np.array(line_list).transpose()
         return output
 
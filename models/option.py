@@ -1,12 +1,48 @@
+import os
+import time
 import numpy as np
 import pandas as pd
 import traceback
 import yfinance as yf
 import logging
+import queue
+import threading
+import collections
 from enum import Enum
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import date, datetime, timedelta
 
 from models import formula, stock
+from utils import executors, metrics
+from utils.singleflight import single_flight
+
+
+CHAIN_SIDES = ["calls", "puts"]
+VALUATION_CHUNK_SIZE = int(os.environ.get("VALUATION_CHUNK_SIZE", "8"))  # strikes per process pool task
+REQUIRED_COLUMNS = ["lastTradeDate", "strike", "lastPrice", "bid", "ask", "change", "percentChange", "volume",
+                    "openInterest", "impliedVolatility"]
+# contracts whose value_strikes columns are kept, by model inputs rounded to PRICING_CACHE_DECIMALS; 0 disables it
+PRICING_CACHE_SIZE = int(os.environ.get("PRICING_CACHE_SIZE", "50000"))
+PRICING_CACHE_DECIMALS = int(os.environ.get("PRICING_CACHE_DECIMALS", "6"))
+PRICING_FIELDS = ["BSM_EWMAHisVol", "MC_EWMAHisVol", "BT_EWMAHisVol", "delta", "gamma", "vega", "theta", "rho"]
+BSM_FIELDS = ["BSM_EWMAHisVol", "delta", "gamma", "vega", "theta", "rho"]
+# valuationData a bsm_only valuation leaves out, in the order an expiry's degraded fields are listed
+BSM_ONLY_SKIPPED_FIELDS = ["MC_EWMAHisVol", "BT_EWMAHisVol", "KellyCriterion_buy", "KellyCriterion_sell",
+                           "KellyCriterion_MU_0_buy", "KellyCriterion_MU_0_sell", "KellyCriterion_IV_buy",
+                           "KellyCriterion_IV_sell", "exerciseProbability"]
+# a valuation with a deadline: an expiry is valued in full while more than DEADLINE_SHRINK_FRACTION of the budget is
+# left, with DEADLINE_SHRINK_FACTOR times fewer MC paths, BT steps and kelly simulations while more than
+# DEADLINE_SKIP_FRACTION is left, then BSM only; work still running at the deadline is cancelled and left null
+DEADLINE_SHRINK_FRACTION = float(os.environ.get("DEADLINE_SHRINK_FRACTION", "0.5"))
+DEADLINE_SKIP_FRACTION = float(os.environ.get("DEADLINE_SKIP_FRACTION", "0.2"))
+DEADLINE_SHRINK_FACTOR = int(os.environ.get("DEADLINE_SHRINK_FACTOR", "10"))
+MC_ITERATION = 1000000
+BT_ITERATION = 1000
+KELLY_IV_ITERATION = 50000
+
+_pricing_cache = collections.OrderedDict()  # (kind, s0, strike, t, r, sigma, dv) -> row of PRICING_FIELDS
+_pricing_cache_lock = threading.Lock()
+_pricing_cache_counters = {"hits": 0, "misses": 0}
 
 
 class CalcKellyType(Enum):
@@ -15,19 +51,95 @@ class CalcKellyType(Enum):
     KellyCriterion_IV = 3
 
 
+class Deadline:
+    FULL = "full"
+    SHRINK = "shrink"
+    SKIP = "skip"
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.end = time.monotonic() + seconds
+        # the deadline passed before every expiry was fetched, the valuation lacks the later ones
+        self.truncated = False
+
+    def remaining(self):
+        return max(self.end - time.monotonic(), 0.0)
+
+    def mode(self):
+        # how expensive work started now should be valued
+        fraction = self.remaining() / self.seconds if self.seconds > 0 else 0.0
+        if fraction > DEADLINE_SHRINK_FRACTION:
+            return Deadline.FULL
+        if fraction > DEADLINE_SKIP_FRACTION:
+            return Deadline.SHRINK
+        return Deadline.SKIP
+
+
+def kelly_fields(calc_kelly_types):
+    fields = []
+    for calc_kelly_type in calc_kelly_types:
+        fields += [calc_kelly_type.name + "_buy", calc_kelly_type.name + "_sell"]
+    return fields + ["exerciseProbability"] if len(fields) > 0 else []
+
+
+# pricing engines by name and the valuationData fields each one fills; a valuation of some of the fields runs only
+# the engines filling them, and of the BSM engine only the formulas of the fields asked for
+PRICING_ENGINES = {"BSM": BSM_FIELDS, "MC": ["MC_EWMAHisVol"], "BT": ["BT_EWMAHisVol"],
+                   **{calc_kelly_type.name: kelly_fields([calc_kelly_type]) for calc_kelly_type in CalcKellyType}}
+VALUATION_FIELDS = list(dict.fromkeys(field for fields in PRICING_ENGINES.values() for field in fields))
+
+
+def parse_valuation_fields(methods=None, fields=None):
+    # comma separated PRICING_ENGINES names and VALUATION_FIELDS to the fields of both in VALUATION_FIELDS order,
+    # None if neither is given; raises ValueError for an unknown name
+    if methods is None and fields is None:
+        return None
+    selected = set()
+    for name in (methods or "").split(","):
+        name = name.strip()
+        if name == "":
+            continue
+        if name not in PRICING_ENGINES:
+            raise ValueError("unknown pricing engine {name}".format(name=name))
+        selected.update(PRICING_ENGINES[name])
+    for name in (fields or "").split(","):
+        name = name.strip()
+        if name == "":
+            continue
+        if name not in VALUATION_FIELDS:
+            raise ValueError("unknown valuation field {name}".format(name=name))
+        selected.add(name)
+    if len(selected) == 0:
+        raise ValueError("no valuation field")
+    return [field for field in VALUATION_FIELDS if field in selected]
+
+
+def pricing_engines(fields):
+    # the PRICING_ENGINES names filling the fields, in registry order; a field more than one engine fills
+    # (exerciseProbability) is left to an engine already needed, else to the first one
+    producers = [[name for name, engine_fields in PRICING_ENGINES.items() if field in engine_fields]
+                 for field in fields]
+    engines = {names[0] for names in producers if len(names) == 1}
+    for names in producers:
+        if len(names) > 1 and engines.isdisjoint(names):
+            engines.add(names[0])
+    return [name for name in PRICING_ENGINES if name in engines]
+
+
+@single_flight
 def get_option_date(symbol: str):
     ticker = yf.Ticker(symbol)
     return ticker.options
 
 
-def get_option_chain(symbol: str, min_next_days: int, max_next_days: int, min_volume: int, min_price: float,
-                     last_trade_days: int, specific_contract=None, proxy=None):
-    # option_chain dataframe column:
-    # calls, contractSymbol, lastTradeDate, strike, lastPrice, bid, ask,
-    # change, percentChange, volume, openInterest, impliedVolatility,
-    # inTheMoney, contractSize, currency
-    contracts = []
+@single_flight
+def get_option_chain_by_expiry(symbol: str, expiry_date: str):
+    ticker = yf.Ticker(symbol)
+    return ticker.option_chain(expiry_date)
 
+
+def parse_chain_filter(min_volume, min_price, last_trade_days, specific_contract=None):
+    # specific_contract: {call|put}_{expiry date}_{strike}
     specific_call_put = -1
     specific_expiry_date = None
     specific_strike = -1
@@ -40,10 +152,6 @@ def get_option_chain(symbol: str, min_next_days: int, max_next_days: int, min_vo
         specific_expiry_date = temp[1]
         specific_strike = float(temp[2])
 
-    now = datetime.now()
-    expiry_min_datetime = (now + timedelta(days=min_next_days)).date()
-    expiry_max_datetime = (now + timedelta(days=max_next_days)).date()
-
     last_trade_days_wo_weekend = last_trade_days
     weekday = datetime.today().isoweekday()
     if weekday == 7:
@@ -56,49 +164,120 @@ def get_option_chain(symbol: str, min_next_days: int, max_next_days: int, min_vo
     if last_trade_days_wo_weekend > 7:
         last_trade_days_wo_weekend += last_trade_days / 7 * 2
 
-    try:
-        ticker = yf.Ticker(symbol)
-        date_list = get_option_date(symbol)
-        for expiry_date in date_list:
-            if specific_expiry_date and expiry_date != specific_expiry_date:
-                continue
+    return {
+        "min_volume": min_volume,
+        "min_price": min_price,
+        # ISO dates compare the same as the dates themselves, so the formatted lastTradeDate column is filtered directly
+        "min_last_trade_date": (datetime.now() - timedelta(days=last_trade_days_wo_weekend)).date().isoformat(),
+        "specific_call_put": specific_call_put,
+        "specific_expiry_date": specific_expiry_date,
+        "specific_strike": specific_strike
+    }
+
+
+def parse_batch_specs(symbols: str):
+    # comma separated {symbol} or {symbol}_{call|put}_{expiry date}_{strike}, a repeated spec is valued once
+    specs = []
+    for spec in symbols.split(","):
+        spec = spec.strip()
+        if spec == "":
+            continue
+        symbol_args = spec.split("_", 1)
+        spec = (symbol_args[0], symbol_args[1] if len(symbol_args) > 1 else None)
+        if spec not in specs:
+            specs.append(spec)
+    return specs
+
+
+def option_expiry_dates(symbol: str, min_next_days: int, max_next_days: int, chain_filter):
+    now = datetime.now()
+    expiry_min_datetime = (now + timedelta(days=min_next_days)).date()
+    expiry_max_datetime = (now + timedelta(days=max_next_days)).date()
+
+    expiry_dates = []
+    for expiry_date in get_option_date(symbol):
+        if chain_filter["specific_expiry_date"] and expiry_date != chain_filter["specific_expiry_date"]:
+            continue
+
+        expiry_datetime = date.fromisoformat(expiry_date)
+        if expiry_max_datetime >= expiry_datetime >= expiry_min_datetime:
+            expiry_dates.append(expiry_date)
+
+    return expiry_dates
+
+
+def iter_option_chain_frames(symbol: str, min_next_days: int, max_next_days: int, chain_filter, proxy=None,
+                             expiry_dates=None):
+    if expiry_dates is None:
+        expiry_dates = option_expiry_dates(symbol, min_next_days, max_next_days, chain_filter)
+
+    for expiry_date in expiry_dates:
+        option_chain = get_option_chain_by_expiry(symbol, expiry_date)
+        if len(option_chain) == 0:
+            logging.warning("{symbol}-{expiry_date} option_chain length = 0".format(symbol=symbol,
+                                                                                    expiry_date=expiry_date))
+        yield expiry_date, option_chain
 
-            expiry_datetime = date.fromisoformat(expiry_date)
-            if expiry_max_datetime >= expiry_datetime >= expiry_min_datetime:
-                option_chain = ticker.option_chain(expiry_date)
-                if len(option_chain) == 0:
-                    logging.warning("{symbol}-{expiry_date} option_chain length = 0".format(symbol=symbol,
-                                                                                            expiry_date=expiry_date))
-
-                expiry_calls_puts = {"expiryDate": expiry_date, "calls": [], "puts": []}
-                calls_puts = [[], []]
-                for calls_puts_index in range(min(2, len(option_chain))):  # 0: calls, 1: puts
-                    d = option_chain[calls_puts_index]
-                    d.drop(d[d.volume < min_volume].index, inplace=True)
-                    d.drop(d[d.lastPrice < min_price].index, inplace=True)
-                    d.drop(d[pd.to_datetime(d.lastTradeDate).dt.date <
-                             (now - timedelta(days=last_trade_days_wo_weekend)).date()].index, inplace=True)
-                    d.dropna(subset=["lastTradeDate", "strike", "lastPrice", "bid", "ask", "change", "percentChange",
-                                     "volume", "openInterest", "impliedVolatility"], inplace=True)
-                    d["lastTradeDate"] = d["lastTradeDate"].apply(lambda x: x.strftime('%Y-%m-%d'))
-
-                    if specific_strike != -1:
-                        d.drop(d[(specific_strike < d.strike-0.00001) | (specific_strike > d.strike+0.00001)].index,
-                               inplace=True)
-
-                    calls_puts[calls_puts_index] = d.to_dict(orient='records')
-
-                if len(calls_puts[0]) > 0 or len(calls_puts[1]) > 0:
-                    if specific_call_put == 0:
-                        expiry_calls_puts["calls"] = calls_puts[0]
-                    elif specific_call_put == 1:
-                        expiry_calls_puts["puts"] = calls_puts[1]
-                    else:
-                        expiry_calls_puts["calls"] = calls_puts[0]
-                        expiry_calls_puts["puts"] = calls_puts[1]
-
-                    contracts.append(expiry_calls_puts)
 
+def filter_option_frame(d, kind, chain_filter, otm_stock_price=None):  # kind: call: 1, put: -1
+    # d may be shared with a concurrent request through single_flight, so it is only read here
+    # all the predicates are combined into one mask, the surviving rows are kept as numpy columns
+    last_trade_date = pd.to_datetime(d["lastTradeDate"]).dt.strftime('%Y-%m-%d')
+    mask = d[REQUIRED_COLUMNS].notna().all(axis=1).to_numpy() & \
+        (d["volume"].to_numpy() >= chain_filter["min_volume"]) & \
+        (d["lastPrice"].to_numpy() >= chain_filter["min_price"]) & \
+        (last_trade_date >= chain_filter["min_last_trade_date"]).to_numpy()
+
+    strike = d["strike"].to_numpy()
+    if chain_filter["specific_strike"] != -1:
+        mask &= np.abs(strike - chain_filter["specific_strike"]) <= 0.00001
+    if otm_stock_price is not None:
+        mask &= strike * kind >= otm_stock_price * kind
+
+    columns = {}
+    for column in d.columns:
+        values = last_trade_date if column == "lastTradeDate" else d[column]
+        columns[column] = values.to_numpy()[mask]
+
+    return columns
+
+
+def filter_option_chain(expiry_date, option_chain, chain_filter, otm_stock_price=None):
+    # option_chain dataframe column:
+    # calls, contractSymbol, lastTradeDate, strike, lastPrice, bid, ask,
+    # change, percentChange, volume, openInterest, impliedVolatility,
+    # inTheMoney, contractSize, currency
+    expiry_calls_puts = {"expiryDate": expiry_date, "calls": {}, "puts": {}}
+    for calls_puts_index in range(min(2, len(option_chain))):  # 0: calls, 1: puts
+        if chain_filter["specific_call_put"] != -1 and chain_filter["specific_call_put"] != calls_puts_index:
+            continue
+
+        kind = 1 if calls_puts_index == 0 else -1
+        expiry_calls_puts[CHAIN_SIDES[calls_puts_index]] = \
+            filter_option_frame(option_chain[calls_puts_index], kind, chain_filter, otm_stock_price)
+
+    if contract_count(expiry_calls_puts["calls"]) > 0 or contract_count(expiry_calls_puts["puts"]) > 0:
+        return expiry_calls_puts
+
+    return None
+
+
+def iter_option_chain(symbol: str, min_next_days: int, max_next_days: int, min_volume: int, min_price: float,
+                      last_trade_days: int, specific_contract=None, proxy=None):
+    # yield one expiry at a time, so the caller can start working on it before the remaining expiries are downloaded
+    chain_filter = parse_chain_filter(min_volume, min_price, last_trade_days, specific_contract)
+    for expiry_date, option_chain in iter_option_chain_frames(symbol, min_next_days, max_next_days, chain_filter,
+                                                              proxy):
+        expiry_calls_puts = filter_option_chain(expiry_date, option_chain, chain_filter)
+        if expiry_calls_puts is not None:
+            yield expiry_calls_puts
+
+
+def get_option_chain(symbol: str, min_next_days: int, max_next_days: int, min_volume: int, min_price: float,
+                     last_trade_days: int, specific_contract=None, proxy=None):
+    try:
+        contracts = list(iter_option_chain(symbol, min_next_days, max_next_days, min_volume, min_price,
+                                           last_trade_days, specific_contract, proxy))
     except Exception:
         logging.error(traceback.format_exc())
         return []
@@ -107,166 +286,486 @@ def get_option_chain(symbol: str, min_next_days: int, max_next_days: int, min_vo
     return contracts
 
 
-def calc_option_valuation(contracts, stock_price, volatility, risk_free_interest_rate=0.0152, dividends=0):
-    now = datetime.now().date()
-    for contract in contracts:
-        expiry_date = contract['expiryDate']
-        expiry_datetime = date.fromisoformat(expiry_date)
-        time_2_maturity_year = (np.busday_count(now, expiry_datetime)+1) / 252.0
-
-        def calc(call_put, kind):  # kind: call: 1, put: -1
-            call_put["valuationData"] = {"BSM_EWMAHisVol": -1, "MC_EWMAHisVol": -1, "BT_EWMAHisVol": -1}
-            call_put["valuationData"]["BSM_EWMAHisVol"] = formula.Option.bs(False, kind, stock_price, call_put['strike'],
-                                                                time_2_maturity_year, risk_free_interest_rate,
-                                                                volatility, dividends)
-            call_put["valuationData"]["MC_EWMAHisVol"] = formula.Option.mc(False, kind, stock_price, call_put['strike'],
-                                                               time_2_maturity_year, risk_free_interest_rate,
-                                                               volatility, dividends)
-            call_put["valuationData"]["BT_EWMAHisVol"] = formula.Option.bt(False, kind, stock_price, call_put['strike'],
-                                                               time_2_maturity_year, risk_free_interest_rate,
-                                                               volatility, dividends)
-
-            call_put["valuationData"]["delta"] = formula.Option.delta(kind, stock_price, call_put['strike'],
-                                                                time_2_maturity_year, risk_free_interest_rate,
-                                                                volatility, dividends)
-            call_put["valuationData"]["gamma"] = formula.Option.gamma(stock_price, call_put['strike'],
-                                                                time_2_maturity_year, risk_free_interest_rate,
-                                                                volatility, dividends)
-            call_put["valuationData"]["vega"] = formula.Option.vega(stock_price, call_put['strike'],
-                                                                time_2_maturity_year, risk_free_interest_rate,
-                                                                volatility, dividends)
-            call_put["valuationData"]["theta"] = formula.Option.theta(kind, stock_price, call_put['strike'],
-                                                                time_2_maturity_year, risk_free_interest_rate,
-                                                                volatility, dividends)
-            call_put["valuationData"]["rho"] = formula.Option.rho(kind, stock_price, call_put['strike'],
-                                                                time_2_maturity_year, risk_free_interest_rate,
-                                                                volatility, dividends)
-
-        for call in contract["calls"]:
-            if time_2_maturity_year <= 0:
-                continue
-            calc(call, 1)
+def contract_count(columns):
+    return len(columns["strike"]) if len(columns) > 0 else 0
 
-        for put in contract["puts"]:
-            if time_2_maturity_year <= 0:
-                continue
-            calc(put, -1)
 
-    #  logging.info(contracts)
+def prefetch(executor, iterator, deadline=None):
+    # run the iterator on an executor thread and hand each item over through a queue, so the consumer can work on
+    # early items while the later ones are still being produced; an error is re-raised in the consumer;
+    # deadline: a Deadline past which no more items are waited for, it is then marked truncated
+    q = queue.Queue()
+    stopped = threading.Event()
 
+    def producer():
+        try:
+            for item in iterator:
+                if stopped.is_set():
+                    break
+                q.put((item, None))
+        except Exception as ex:
+            q.put((None, ex))
+        finally:
+            q.put((None, None))
 
-def calc_kelly_criterion(stock_close_data, ewma_his_vol, contracts, calc_kelly_type, iteration):
-    now = datetime.now().date()
-    key = calc_kelly_type.name
+    executor.submit(producer)
+    try:
+        while True:
+            if deadline is not None and deadline.remaining() <= 0:
+                deadline.truncated = True
+                return
+            try:
+                item, ex = q.get(timeout=None if deadline is None else deadline.remaining())
+            except queue.Empty:
+                continue
+            if ex is not None:
+                raise ex
+            if item is None:
+                return
+            yield item
+    finally:
+        # the consumer is done or gone, don't fetch the rest
+        stopped.set()
+
+
+def time_to_maturity(now, expiry_date):
+    # in years of 252 business days
+    return (np.busday_count(now, date.fromisoformat(expiry_date)) + 1) / 252.0
+
+
+# the BSM engine's field formulas, of (kind, stock_price, strike, time_2_maturity_year, risk_free_interest_rate,
+# volatility, dividends)
+BSM_FORMULAS = {
+    "BSM_EWMAHisVol": lambda kind, *args: formula.Option.bs(False, kind, *args),
+    "delta": lambda kind, *args: formula.Option.delta(kind, *args),
+    "gamma": lambda kind, *args: formula.Option.gamma(*args),
+    "vega": lambda kind, *args: formula.Option.vega(*args),
+    "theta": lambda kind, *args: formula.Option.theta(kind, *args),
+    "rho": lambda kind, *args: formula.Option.rho(kind, *args)
+}
+
+
+def value_strikes_bsm(kind, strike, stock_price, time_2_maturity_year, volatility, risk_free_interest_rate=0.0152,
+                      dividends=0, fields=BSM_FIELDS):  # kind: call: 1, put: -1
+    # BSM and the greeks of fields, evaluated on the whole strike column
+    args = (stock_price, strike, time_2_maturity_year, risk_free_interest_rate, volatility, dividends)
+    return {field: as_column(BSM_FORMULAS[field](kind, *args), strike) for field in BSM_FIELDS if field in fields}
+
+
+def value_strikes(kind, strike, stock_price, time_2_maturity_year, volatility, risk_free_interest_rate=0.0152,
+                  dividends=0, mc_iteration=MC_ITERATION, bt_iteration=BT_ITERATION,
+                  fields=PRICING_FIELDS):  # kind: call: 1, put: -1
+    # the PRICING_FIELDS in fields: value_strikes_bsm, and MC and BT priced one strike at a time
+    bsm = value_strikes_bsm(kind, strike, stock_price, time_2_maturity_year, volatility, risk_free_interest_rate,
+                            dividends, fields)
+    output = {}
+    if "BSM_EWMAHisVol" in bsm:
+        output["BSM_EWMAHisVol"] = bsm.pop("BSM_EWMAHisVol")
+    if "MC_EWMAHisVol" in fields:
+        output["MC_EWMAHisVol"] = np.array([formula.Option.mc(False, kind, stock_price, k, time_2_maturity_year,
+                                                              risk_free_interest_rate, volatility, dividends,
+                                                              mc_iteration)
+                                            for k in strike.tolist()], dtype=np.float64)
+    if "BT_EWMAHisVol" in fields:
+        output["BT_EWMAHisVol"] = np.array([formula.Option.bt(False, kind, stock_price, k, time_2_maturity_year,
+                                                              risk_free_interest_rate, volatility, dividends,
+                                                              bt_iteration)
+                                            for k in strike.tolist()], dtype=np.float64)
+    output.update(bsm)
+    return output
 
-    mu = 0
-    if calc_kelly_type is CalcKellyType.KellyCriterion:
-        mu = formula.Common.compounded_return(stock_close_data)
 
-    expiry_days_dict = {}
-    for contract in contracts:
-        expiry_date = contract['expiryDate']
-        expiry_datetime = date.fromisoformat(expiry_date)
-        expiry_days_dict[expiry_date] = np.busday_count(now, expiry_datetime) + 1
+def pricing_inputs(stock_price, time_2_maturity_year, volatility, risk_free_interest_rate=0.0152, dividends=0):
+    # the model inputs of value_strikes after the strike, exact; only the pricing cache keys round them
+    return tuple(float(value)
+                 for value in (stock_price, time_2_maturity_year, volatility, risk_free_interest_rate, dividends))
+
+
+def get_priced(keys):
+    # the cached PRICING_FIELDS rows of the keys, None for the contracts to value
+    if PRICING_CACHE_SIZE <= 0:
+        return [None] * len(keys)
+
+    rows = []
+    with _pricing_cache_lock:
+        for key in keys:
+            row = _pricing_cache.get(key)
+            if row is not None:
+                _pricing_cache.move_to_end(key)
+            rows.append(row)
+        hits = sum(row is not None for row in rows)
+        _pricing_cache_counters["hits"] += hits
+        _pricing_cache_counters["misses"] += len(rows) - hits
+    return rows
+
+
+def put_priced(keys, valuation_data):
+    if PRICING_CACHE_SIZE <= 0:
+        return
+
+    rows = np.column_stack([valuation_data[field] for field in PRICING_FIELDS]).tolist()
+    with _pricing_cache_lock:
+        for key, row in zip(keys, rows):
+            _pricing_cache[key] = tuple(row)
+            _pricing_cache.move_to_end(key)
+        while len(_pricing_cache) > PRICING_CACHE_SIZE:
+            _pricing_cache.popitem(last=False)
+
+
+def pricing_cache_metrics():
+    with _pricing_cache_lock:
+        return dict(_pricing_cache_counters, entries=len(_pricing_cache), maxEntries=PRICING_CACHE_SIZE)
+
+
+metrics.register("pricingCache", pricing_cache_metrics)
+
+
+def priced_strikes(kind, strike, inputs, submit, cache=True, fields=PRICING_FIELDS):
+    # a future of value_strikes(kind, strike, *inputs, fields=fields): cached contracts are looked up, submit(strikes)
+    # values the others and returns a future of their valuationData, which is then cached unless cache is False or
+    # it lacks some of the PRICING_FIELDS
+    # keyed by the inputs rounded to PRICING_CACHE_DECIMALS, a miss is valued with the exact ones
+    key_inputs = [round(value, PRICING_CACHE_DECIMALS) for value in inputs]
+    keys = [(kind, key_inputs[0], round(k, PRICING_CACHE_DECIMALS), *key_inputs[1:]) for k in strike.tolist()]
+    rows = get_priced(keys)
+    missing = [i for i, row in enumerate(rows) if row is None]
+    output = Future()
+    if len(missing) == 0:
+        values = np.array(rows, dtype=np.float64)
+        output.set_result({field: values[:, i].copy() for i, field in enumerate(PRICING_FIELDS) if field in fields})
+        return output
+
+    def done(future):
+        if output.cancelled():
+            return
+        try:
+            valuation_data = future.result()
+        except Exception as ex:
+            output.set_exception(ex)
+            return
+
+        if cache and len(fields) == len(PRICING_FIELDS):
+            put_priced([keys[i] for i in missing], valuation_data)
+        if len(missing) == len(rows):
+            output.set_result(valuation_data)
+            return
+        values = np.array([row if row is not None else [np.nan] * len(PRICING_FIELDS) for row in rows],
+                          dtype=np.float64)
+        for field_index, field in enumerate(PRICING_FIELDS):
+            if field in fields:
+                values[missing, field_index] = valuation_data[field]
+        output.set_result({field: values[:, i].copy() for i, field in enumerate(PRICING_FIELDS) if field in fields})
+
+    submitted = submit(strike[missing])
+    submitted.add_done_callback(done)
+    # cancelled at a deadline, the strikes still waiting for the pool are dropped too
+    output.add_done_callback(lambda _: submitted.cancel() if output.cancelled() else None)
+    return output
 
-    max_days = max(expiry_days_dict.values())
 
-    if calc_kelly_type is not CalcKellyType.KellyCriterion_IV:
-        output = formula.Stock.price_simulation_by_mc(stock_close_data.iloc[-1], mu, ewma_his_vol,
-                                                      max_days+1, iteration=iteration)
-    for contract in contracts:
-        expiry_date = contract['expiryDate']
-        days = expiry_days_dict[expiry_date]
-        expiry_predict_prices_t = None
-        if calc_kelly_type is not CalcKellyType.KellyCriterion_IV:
-            expiry_predict_prices_t = output[:, days]
-
-        def kelly(call_put, kind, expiry_predict_prices_temp):  # kind: call: 1, put: -1
-            expiry_predict_prices = expiry_predict_prices_temp
-            if calc_kelly_type is CalcKellyType.KellyCriterion_IV:
-                iv = call_put['impliedVolatility']
-                output = formula.Stock.price_simulation_by_mc(stock_close_data.iloc[-1], 0,
-                                                              iv, days + 1, iteration=50000)
-                expiry_predict_prices = output[:, days]
-
-            strike = call_put['strike']
-            last_price = call_put['lastPrice']
-
-            """
-            for p_price in expiry_predict_prices:
-                if kind * p_price > kind * (strike + (kind * last_price)):
-                    gain_list.append(kind * (p_price - (strike + kind * last_price)))
-                elif kind * p_price > kind * strike:
-                    loss_list.append(kind * ((strike + kind * last_price) - p_price))
-                else:
-                    loss_list.append(last_price)
-            """
-            var1_list = np.where(kind * expiry_predict_prices > kind * (strike + (kind * last_price)),
-                                 kind * (expiry_predict_prices - (strike + kind * last_price)), 0)
-            var2_list = np.where((kind * expiry_predict_prices > kind * strike) &
-                                 (kind * expiry_predict_prices <= kind * (strike + (kind * last_price))),
-                                 kind * ((strike + kind * last_price) - expiry_predict_prices), 0)
-            fixed_list = np.where(kind * expiry_predict_prices <= kind * strike, last_price, 0)
-
-            call_put["valuationData"]["exerciseProbability"] = \
-                (np.count_nonzero(expiry_predict_prices) - np.count_nonzero(fixed_list)) * 1.0 / np.count_nonzero(expiry_predict_prices)
-
-            def calc(buy_sell, gain_list, loss_list):
-                gain_all = sum(gain_list)
-                loss_all = sum(loss_list)
-                p = np.count_nonzero(gain_list) * 1.0 / len(expiry_predict_prices)
-                q = np.count_nonzero(loss_list) * 1.0 / len(expiry_predict_prices)
-                if loss_all == 0:
-                    call_put["valuationData"][key + "_" + buy_sell] = p
-                else:
-                    b = gain_all / loss_all
-                    if b == 0:
-                        call_put["valuationData"][key + "_" + buy_sell] = -2147483648
-                    else:
-                        call_put["valuationData"][key + "_" + buy_sell] = p - (q / b)
+def as_column(value, like):
+    # formulas return a scalar (e.g. -1 for unsupported american put) or an array shaped like the strike column
+    return np.broadcast_to(np.asarray(value, dtype=np.float64), like.shape).copy()
 
-            calc("buy", var1_list, var2_list + fixed_list)
-            calc("sell", var2_list + fixed_list, var1_list)
 
-        for call in contract["calls"]:
-            kelly(call, 1, expiry_predict_prices_t)
+def kelly_strikes(kind, calc_kelly_type, strike, last_price, iv, expiry_predict_prices, stock_price, days,
+                  iv_iteration=KELLY_IV_ITERATION):
+    # kind: call: 1, put: -1; expiry_predict_prices is simulated here per strike for KellyCriterion_IV
+    key = calc_kelly_type.name
+    exercise_probability = np.empty(len(strike), dtype=np.float64)
+    kelly_buy = np.empty(len(strike), dtype=np.float64)
+    kelly_sell = np.empty(len(strike), dtype=np.float64)
+
+    for i, (k, price, v) in enumerate(zip(strike.tolist(), last_price.tolist(), iv.tolist())):
+        if calc_kelly_type is CalcKellyType.KellyCriterion_IV:
+            output = formula.Stock.price_simulation_by_mc(stock_price, 0, v, days + 1, iteration=iv_iteration)
+            expiry_predict_prices = output[:, days]
+
+        """
+        for p_price in expiry_predict_prices:
+            if kind * p_price > kind * (strike + (kind * last_price)):
+                gain_list.append(kind * (p_price - (strike + kind * last_price)))
+            elif kind * p_price > kind * strike:
+                loss_list.append(kind * ((strike + kind * last_price) - p_price))
+            else:
+                loss_list.append(last_price)
+        """
+        var1_list = np.where(kind * expiry_predict_prices > kind * (k + (kind * price)),
+                             kind * (expiry_predict_prices - (k + kind * price)), 0)
+        var2_list = np.where((kind * expiry_predict_prices > kind * k) &
+                             (kind * expiry_predict_prices <= kind * (k + (kind * price))),
+                             kind * ((k + kind * price) - expiry_predict_prices), 0)
+        fixed_list = np.where(kind * expiry_predict_prices <= kind * k, price, 0)
+
+        exercise_probability[i] = \
+            (np.count_nonzero(expiry_predict_prices) - np.count_nonzero(fixed_list)) * 1.0 / np.count_nonzero(expiry_predict_prices)
+
+        def calc(gain_list, loss_list):
+            gain_all = sum(gain_list)
+            loss_all = sum(loss_list)
+            p = np.count_nonzero(gain_list) * 1.0 / len(expiry_predict_prices)
+            q = np.count_nonzero(loss_list) * 1.0 / len(expiry_predict_prices)
+            if loss_all == 0:
+                return p
+            else:
+                b = gain_all / loss_all
+                if b == 0:
+                    return -2147483648
+                else:
+                    return p - (q / b)
+
+        kelly_buy[i] = calc(var1_list, var2_list + fixed_list)
+        kelly_sell[i] = calc(var2_list + fixed_list, var1_list)
+
+    return {"exerciseProbability": exercise_probability, key + "_buy": kelly_buy, key + "_sell": kelly_sell}
+
+
+def strike_chunks(n):
+    return [(start, min(start + VALUATION_CHUNK_SIZE, n)) for start in range(0, n, VALUATION_CHUNK_SIZE)]
+
+
+def submit_cpu(deadline, fn, *args, **kwargs):
+    # executors.submit_cpu, without waiting for a queue slot past the deadline
+    if deadline is None:
+        return executors.submit_cpu(fn, *args, **kwargs)
+    return executors.submit_cpu_within(deadline.remaining(), fn, *args, **kwargs)
+
+
+def merge_chunks(contract, tasks, deadline=None):
+    # write the chunk results of [(side, start, stop, fields, future)] into the expiry's valuationData columns;
+    # a chunk not done or not even queued by the deadline is cancelled and its fields left NaN, the set of those
+    # fields is returned
+    timed_out = set()
+    for side, start, stop, fields, future in tasks:
+        valuation_data = contract[side].setdefault("valuationData", {})
+        try:
+            result = future.result(timeout=None if deadline is None else deadline.remaining())
+        except (FutureTimeoutError, executors.ExecutorBusy):
+            future.cancel()
+            result = {key: np.nan for key in fields}
+            timed_out.update(fields)
+        for key, value in result.items():
+            if key not in valuation_data:
+                valuation_data[key] = np.full(contract_count(contract[side]), np.nan)
+            valuation_data[key][start:stop] = value
+    return timed_out
+
+
+def submit_expiry_valuation(contract, stock_price, volatility, bsm_only=False, shrink=1, deadline=None,
+                            fields=PRICING_FIELDS):
+    # cut one expiry into strike chunks valued on the process pool, merge_chunks() collects them;
+    # bsm_only: just BSM and the greeks, whole columns valued in the caller, with a deadline or without MC and BT in
+    # fields those first, then the chunks; shrink: MC and BT with that many times fewer paths and steps, not kept in
+    # the pricing cache; fields: the PRICING_FIELDS to value
+    time_2_maturity_year = time_to_maturity(datetime.now().date(), contract['expiryDate'])
+    tasks = []
+    if time_2_maturity_year <= 0:
+        return tasks
+
+    inputs = pricing_inputs(stock_price, time_2_maturity_year, volatility)
+    bsm_fields = [field for field in BSM_FIELDS if field in fields]
+    chunk_fields = [field for field in PRICING_FIELDS if field in fields]
+    bsm_only = bsm_only or len(chunk_fields) == len(bsm_fields)
+    if (bsm_only or deadline is not None) and len(bsm_fields) > 0:
+        for side, kind in zip(CHAIN_SIDES, [1, -1]):
+            if contract_count(contract[side]) > 0:
+                tasks.append((side, 0, contract_count(contract[side]), bsm_fields, executors.run_inline(
+                    value_strikes_bsm, kind, contract[side]['strike'], *inputs, fields=bsm_fields)))
+    if bsm_only:
+        return tasks
+
+    timeout_fields = [field for field in chunk_fields if deadline is None or field not in BSM_FIELDS]
+    options = {} if shrink == 1 else {"mc_iteration": MC_ITERATION // shrink, "bt_iteration": BT_ITERATION // shrink}
+    if len(chunk_fields) < len(PRICING_FIELDS):
+        options["fields"] = chunk_fields
+    for side, kind in zip(CHAIN_SIDES, [1, -1]):
+        for start, stop in strike_chunks(contract_count(contract[side])):
+            # only the contracts not in the pricing cache go to the pool
+            tasks.append((side, start, stop, timeout_fields, priced_strikes(
+                kind, contract[side]['strike'][start:stop], inputs,
+                lambda strike, kind=kind: submit_cpu(deadline, value_strikes, kind, strike, *inputs, **options),
+                cache=shrink == 1, fields=chunk_fields)))
+    return tasks
+
+
+def kelly_strikes_task(kind, calc_kelly_type, strike, last_price, iv, simulations, row, stock_price, days,
+                       iv_iteration=KELLY_IV_ITERATION):
+    # process pool task, the simulated prices at expiry are read from shared memory
+    try:
+        return kelly_strikes(kind, calc_kelly_type, strike, last_price, iv,
+                             None if simulations is None else simulations.array[row], stock_price, days, iv_iteration)
+    finally:
+        if simulations is not None:
+            simulations.close()
+
+
+def simulate_expiry_prices(stock_close_data, ewma_his_vol, expiry_days, calc_kelly_types, iteration):
+    # the simulated prices at each expiry of the simulated kelly types, in type order, row t * len(expiry_days) + i
+    # of the shared array is type t at expiry_days[i]
+    simulated_types = [t for t in calc_kelly_types if t is not CalcKellyType.KellyCriterion_IV]
+    if len(simulated_types) == 0:
+        return None
+
+    simulations = executors.SharedArray((len(simulated_types) * len(expiry_days), iteration))
+    for t, calc_kelly_type in enumerate(simulated_types):
+        mu = 0
+        if calc_kelly_type is CalcKellyType.KellyCriterion:
+            mu = formula.Common.compounded_return(stock_close_data)
+        output = formula.Stock.price_simulation_by_mc(stock_close_data.iloc[-1], mu, ewma_his_vol,
+                                                      max(expiry_days) + 1, iteration=iteration)
+        simulations.array[t * len(expiry_days):(t + 1) * len(expiry_days)] = output[:, expiry_days].T
+        del output
 
-        for put in contract["puts"]:
-            kelly(put, -1, expiry_predict_prices_t)
+    return simulations
 
 
-def filter_out_otm(contracts, stock_price):
-    for contract in contracts:
-        def filter_contract(call_put, kind):  # kind: call: 1, put: -1
-            return call_put["strike"] * kind >= stock_price * kind
+def submit_expiry_kelly(contract, calc_kelly_types, simulations, expiry_index, expiry_count, stock_price, days,
+                        iv_iteration=KELLY_IV_ITERATION, deadline=None):
+    # cut one expiry into strike chunks of every kelly type, in type order so merge_chunks() leaves
+    # exerciseProbability of the last type
+    tasks = []
+    simulated = 0
+    for calc_kelly_type in calc_kelly_types:
+        row = None
+        if calc_kelly_type is not CalcKellyType.KellyCriterion_IV:
+            row = simulated * expiry_count + expiry_index
+            simulated += 1
+
+        for side, kind in zip(CHAIN_SIDES, [1, -1]):
+            call_put = contract[side]
+            for start, stop in strike_chunks(contract_count(call_put)):
+                tasks.append((side, start, stop, kelly_fields([calc_kelly_type]), submit_cpu(
+                    deadline, kelly_strikes_task, kind, calc_kelly_type, call_put['strike'][start:stop],
+                    call_put['lastPrice'][start:stop], call_put['impliedVolatility'][start:stop],
+                    None if row is None else simulations, row, stock_price, days, iv_iteration)))
+    return tasks
+
+
+def merge_expiry(expiry_calls_puts, degraded, tasks, deadline=None):
+    degraded = degraded | merge_chunks(expiry_calls_puts, tasks, deadline)
+    if len(degraded) > 0:
+        expiry_calls_puts["degraded"] = sorted(degraded, key=BSM_ONLY_SKIPPED_FIELDS.index)
+        # a skipped field is null, also when nothing else was valued
+        for side in CHAIN_SIDES:
+            valuation_data = expiry_calls_puts[side].setdefault("valuationData", {})
+            for field in expiry_calls_puts["degraded"]:
+                valuation_data.setdefault(field, np.full(contract_count(expiry_calls_puts[side]), np.nan))
+    return expiry_calls_puts
+
+
+def iter_options_chain_quotes_valuation(symbol, min_next_days, max_next_days, min_volume, min_price, last_trade_days,
+                                        ewma_his_vol_period, ewma_his_vol_lambda, only_otm, specific_contract, proxy,
+                                        stock_src="yahoo", calc_kelly_iv=False, iteration=100000, bsm_only=False,
+                                        deadline=None, fields=None):
+    # yield (stock_price, extra_info, ewma_his_vol, expiry_calls_puts) for each valued expiry in expiry order,
+    # an expiry is yielded as soon as its process pool tasks are done while the later ones are still fetched;
+    # bsm_only: the cheap valuation under load, without MC, BT and the kelly criterions (BSM_ONLY_SKIPPED_FIELDS);
+    # deadline: a Deadline the valuation is shrunk or cut short to meet, expiries not fetched by then are left out
+    # and the deadline marked truncated;
+    # an expiry valued with fewer iterations or without some fields lists them in expiry_calls_puts["degraded"];
+    # fields: the VALUATION_FIELDS to value, only their pricing engines run; by default all but KellyCriterion_IV's,
+    # which calc_kelly_iv adds
+    chain_filter = parse_chain_filter(min_volume, min_price, last_trade_days, specific_contract)
+    if fields is None:
+        engines = [name for name in PRICING_ENGINES if calc_kelly_iv or name != CalcKellyType.KellyCriterion_IV.name]
+    else:
+        engines = pricing_engines(fields)
+    pricing_fields = PRICING_FIELDS if fields is None else [field for field in PRICING_FIELDS if field in fields]
+    calc_kelly_types = [calc_kelly_type for calc_kelly_type in CalcKellyType if calc_kelly_type.name in engines]
+    requested_kelly_fields = kelly_fields(calc_kelly_types)
+    if bsm_only:
+        calc_kelly_types = []
+    kelly_shrink = 1
+
+    # the stock history and the option chain are independent, fetch them at the same time
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="valuation-fetch")
+    pending = collections.deque()
+    stock_data = extra_info = ewma_his_vol = stock_price = simulations = None
+    try:
+        stock_history_future = executor.submit(stock.get_stock_history, symbol, "1y", proxy, stock_src)
+        expiry_dates = option_expiry_dates(symbol, min_next_days, max_next_days, chain_filter)
+        now = datetime.now().date()
+        expiry_days = [np.busday_count(now, date.fromisoformat(expiry_date)) + 1 for expiry_date in expiry_dates]
+
+        for expiry_date, option_chain in prefetch(executor, iter_option_chain_frames(
+                symbol, min_next_days, max_next_days, chain_filter, proxy, expiry_dates), deadline):
+            if stock_data is None:
+                try:
+                    stock_data, extra_info = stock_history_future.result(
+                        timeout=None if deadline is None else deadline.remaining())
+                except FutureTimeoutError:
+                    deadline.truncated = True
+                    break
+                ewma_his_vol = formula.Volatility.ewma_historical_volatility(data=stock_data["Close"],
+                                                                             period=ewma_his_vol_period,
+                                                                             p_lambda=ewma_his_vol_lambda)
+                stock_price = stock_data["Close"].iloc[-1]
+                if deadline is not None and deadline.mode() == Deadline.SKIP:
+                    calc_kelly_types = []
+                elif deadline is not None and deadline.mode() == Deadline.SHRINK:
+                    kelly_shrink = DEADLINE_SHRINK_FACTOR
+                # simulated once up to the last candidate expiry, so each expiry's kelly can start on arrival
+                simulations = simulate_expiry_prices(stock_data["Close"], ewma_his_vol, expiry_days,
+                                                     calc_kelly_types, max(iteration // kelly_shrink, 1))
+
+            expiry_calls_puts = filter_option_chain(expiry_date, option_chain, chain_filter,
+                                                    stock_price if only_otm else None)
+            if expiry_calls_puts is None:
+                continue
 
-        contract["calls"] = [call for call in contract["calls"] if filter_contract(call, 1)]
-        contract["puts"] = [put for put in contract["puts"] if filter_contract(put, -1)]
+            # value the expiry on the process pool while the next one is fetched
+            i = expiry_dates.index(expiry_date)
+            mode = deadline.mode() if deadline is not None else Deadline.FULL
+            skip = bsm_only or mode == Deadline.SKIP
+            shrink = DEADLINE_SHRINK_FACTOR if mode == Deadline.SHRINK else 1
+            degraded = set()
+            if skip or shrink > 1:
+                degraded.update(field for field in ["MC_EWMAHisVol", "BT_EWMAHisVol"] if field in pricing_fields)
+            if skip or shrink > 1 or kelly_shrink > 1 or len(calc_kelly_types) == 0:
+                degraded.update(requested_kelly_fields)
+            tasks = submit_expiry_valuation(expiry_calls_puts, stock_price, ewma_his_vol, skip, shrink, deadline,
+                                            pricing_fields)
+            if not skip:
+                tasks += submit_expiry_kelly(expiry_calls_puts, calc_kelly_types, simulations, i,
+                                             len(expiry_dates), stock_price, expiry_days[i],
+                                             max(KELLY_IV_ITERATION // max(shrink, kelly_shrink), 1), deadline)
+            pending.append((expiry_calls_puts, degraded, tasks))
+            while len(pending) > 0 and all(task[-1].done() for task in pending[0][2]):
+                expiry_calls_puts = merge_expiry(*pending.popleft(), deadline)
+                yield stock_price, extra_info, ewma_his_vol, expiry_calls_puts
+
+        while len(pending) > 0:
+            expiry_calls_puts = merge_expiry(*pending.popleft(), deadline)
+            yield stock_price, extra_info, ewma_his_vol, expiry_calls_puts
+
+    finally:
+        for _, _, tasks in pending:
+            for task in tasks:
+                task[-1].cancel()
+        if simulations is not None:
+            simulations.release()
+        # past a deadline a fetch still running finishes on its own, the valuation doesn't wait for it
+        executor.shutdown(wait=deadline is None, cancel_futures=True)
 
 
 def options_chain_quotes_valuation(symbol, min_next_days, max_next_days, min_volume, min_price, last_trade_days,
                                    ewma_his_vol_period, ewma_his_vol_lambda, only_otm, specific_contract, proxy,
-                                   stock_src="yahoo", calc_kelly_iv=False, iteration=100000):
-    contracts = get_option_chain(symbol, min_next_days, max_next_days, min_volume, min_price, last_trade_days,
-                                 specific_contract, proxy)
-    if len(contracts) == 0:
+                                   stock_src="yahoo", calc_kelly_iv=False, iteration=100000, bsm_only=False,
+                                   deadline=None, fields=None):
+    contracts = []
+    stock_price = extra_info = ewma_his_vol = None
+    try:
+        for stock_price, extra_info, ewma_his_vol, expiry_calls_puts in iter_options_chain_quotes_valuation(
+                symbol, min_next_days, max_next_days, min_volume, min_price, last_trade_days, ewma_his_vol_period,
+                ewma_his_vol_lambda, only_otm, specific_contract, proxy, stock_src, calc_kelly_iv, iteration,
+                bsm_only, deadline, fields):
+            contracts.append(expiry_calls_puts)
+    except Exception:
+        logging.error(traceback.format_exc())
         return None, None, None, None
 
-    stock_data, extra_info = stock.get_stock_history(symbol, "1y", proxy, stock_src)
-    ewma_his_vol = formula.Volatility.ewma_historical_volatility(data=stock_data["Close"], period=ewma_his_vol_period,
-                                                                 p_lambda=ewma_his_vol_lambda)
-    stock_price = stock_data["Close"].iloc[-1]
-
-    if only_otm:
-        filter_out_otm(contracts, stock_price)
-
-    calc_option_valuation(contracts, stock_price, ewma_his_vol)
-
-    # calc kelly criterion
-    calc_kelly_criterion(stock_data["Close"], ewma_his_vol, contracts, CalcKellyType.KellyCriterion, iteration)
-    calc_kelly_criterion(stock_data["Close"], ewma_his_vol, contracts, CalcKellyType.KellyCriterion_MU_0, iteration)
-    if calc_kelly_iv:
-        calc_kelly_criterion(stock_data["Close"], ewma_his_vol, contracts, CalcKellyType.KellyCriterion_IV, iteration)
+    if len(contracts) == 0:
+        return None, None, None, None
 
     return stock_price, extra_info, ewma_his_vol, contracts
 
@@ -297,9 +796,9 @@ def get_option_pcr(symbol: str, range_days: int):
                 "totalOpenInterest": 0,
                 "expiryDate": expiry_date
             }
-            for op in contract[op_type]:
-                c["totalVolume"] += op["volume"]
-                c["totalOpenInterest"] += op["openInterest"]
+            if contract_count(contract[op_type]) > 0:
+                c["totalVolume"] = contract[op_type]["volume"].sum()
+                c["totalOpenInterest"] = contract[op_type]["openInterest"].sum()
             output[op_type]["detail"].append(c)
 
         push_contract("calls")
@@ -1,19 +1,22 @@
+import os
+import time
+import threading
+import collections
 import traceback
 import logging
-import time
 import json
-import csv
+import io
+import itertools
 from enum import Enum
 from datetime import date, datetime, timedelta
 
 import numpy as np
 import yfinance as yf
 import pandas as pd
-from bs4 import BeautifulSoup
-from lxml import etree
 
 from models import formula
-from utils import web
+from utils import web, scraping, crawler, executors
+from utils.singleflight import single_flight, async_single_flight
 
 
 class PriceSimulationType(Enum):
@@ -23,43 +26,42 @@ class PriceSimulationType(Enum):
     MANUAL_ALL = 4
 
 
-def is_float(value):
-    try:
-        float(value)
-        return True
-    except ValueError:
-        return False
-
-
 def get_stock(symbol):
     return yf.Ticker(symbol)
 
 
-def get_stock_data_from_marketwatch(symbol, days):
+def marketwatch_query_url(symbol, days):
     now = datetime.now()
     period_days = now - timedelta(days=days)
     end_date = now.strftime("%m/%d/%Y") + "%20" + now.strftime("%H:%M:%S")
     start_date = period_days.strftime("%m/%d/%Y") + "%20" + period_days.strftime("%H:%M:%S")
-    query_url = "https://www.marketwatch.com/investing/stock/" + symbol + "/downloaddatapartial?startdate=" + start_date + "&enddate=" + end_date + "&daterange=d30&frequency=p1d&csvdownload=true&downloadpartial=false&newdates=false"
+    return "https://www.marketwatch.com/investing/stock/" + symbol + "/downloaddatapartial?startdate=" + start_date + "&enddate=" + end_date + "&daterange=d30&frequency=p1d&csvdownload=true&downloadpartial=false&newdates=false"
+
+
+def marketwatch_column(column):
+    # a column read_csv left as strings has a non-numeric cell ("-", "N/A"), only that cell becomes NaN
+    if not pd.api.types.is_numeric_dtype(column):
+        column = pd.to_numeric(column.str.replace(',', '', regex=False), errors='coerce')
+    return column.astype(np.float64)
+
 
+def parse_marketwatch_csv(content):
+    # Date,Open,High,Low,Close,Volume, newest first, quoted numbers use thousands separators ("2,134")
+    stock_data_df = pd.read_csv(io.StringIO(content), thousands=',')
+    # inferring the date format is several times faster than an explicit format= here
+    stock_data_df.index = pd.DatetimeIndex(stock_data_df.pop('Date'), name='Date')
+    stock_data_df = stock_data_df.iloc[::-1].apply(marketwatch_column)
+    if not stock_data_df.index.is_monotonic_increasing:
+        stock_data_df = stock_data_df.sort_index()
+    return stock_data_df
+
+
+def get_stock_data_from_marketwatch(symbol, days):
     try:
-        ret, content = web.send_request(query_url)
+        ret, content = web.send_request(marketwatch_query_url(symbol, days))
         if ret == 0:
             # logging.info(content)
-            lines = content.splitlines()
-            read_csv = csv.reader(lines)
-            headers = next(read_csv)
-            output = []
-            for row in read_csv:
-                d = {}
-                for i in range(len(headers)):
-                    v = row[i].replace(',', '')  # 2,134 -> 2134
-                    if is_float(v):
-                        v = float(v)
-                    d[headers[i]] = v
-                output.append(d)
-
-            return output
+            return parse_marketwatch_csv(content)
         else:
             logging.error('send_request failed: {ret}'.format(ret=ret))
 
@@ -69,28 +71,41 @@ def get_stock_data_from_marketwatch(symbol, days):
     return None
 
 
+async def get_stock_data_from_marketwatch_async(symbol, days):
+    try:
+        ret, content = await web.send_request_async(marketwatch_query_url(symbol, days))
+        if ret == 0:
+            return parse_marketwatch_csv(content)
+        else:
+            logging.error('send_request_async failed: {ret}'.format(ret=ret))
+
+    except Exception:
+        logging.error(traceback.format_exc())
+
+    return None
+
+
+def marketwatch_period_days(period):
+    if period == "1mo":
+        return 30
+    elif period == "3mo":
+        return 91
+    elif period == "6mo":
+        return 187
+    elif period == "1y":
+        return 365
+    else:
+        raise ValueError("period is invalid")
+
+
+@single_flight
 def get_stock_history(symbol, period, proxy=None, stock_src="yahoo"):
     try:
         extra_info = {"earningsDate": ""}
         if stock_src == "marketwatch":
-            if period == "1mo":
-                days = 30
-            elif period == "3mo":
-                days = 91
-            elif period == "6mo":
-                days = 187
-            elif period == "1y":
-                days = 365
-            else:
-                raise ValueError("period is invalid")
-            stock_data = get_stock_data_from_marketwatch(symbol, days)
-            if stock_data and len(stock_data) > 0:
-                # convert to dataframe
-                stock_data_df = pd.DataFrame.from_records(stock_data)
-                stock_data_df = stock_data_df[::-1]  # reverse order
-                stock_data_df = stock_data_df.set_index(pd.DatetimeIndex(stock_data_df['Date']))
-                stock_data_df.drop(columns=['Date'], inplace=True)
-                return stock_data_df, extra_info
+            stock_data = get_stock_data_from_marketwatch(symbol, marketwatch_period_days(period))
+            if stock_data is not None and len(stock_data) > 0:
+                return stock_data, extra_info
         else:
             ticker = yf.Ticker(symbol)
             extra_info["earningsDate"] = ""
@@ -121,21 +136,73 @@ def get_stock_history(symbol, period, proxy=None, stock_src="yahoo"):
     return None, None
 
 
+# seconds a history's validators are trusted without fetching it again, and how many histories are remembered
+STOCK_HISTORY_VALIDATOR_TTL = float(os.environ.get("STOCK_HISTORY_VALIDATOR_TTL", "60"))
+STOCK_HISTORY_VALIDATOR_SIZE = int(os.environ.get("STOCK_HISTORY_VALIDATOR_SIZE", "4096"))
+
+_history_validators = collections.OrderedDict()  # (symbol, period, stock_src) -> (monotonic time, version, last bar)
+_history_validators_lock = threading.Lock()
+
+
+def stock_history_version(symbol, period, stock_src, stock_data):
+    # (version, last bar timestamp) of a history: the last bar's values are part of the version, today's bar changes
+    # until the close; the version is remembered for the conditional requests of the next seconds
+    last = stock_data.iloc[-1]
+    version = (len(stock_data), stock_data.index[-1].isoformat(),
+               tuple(float(last[column]) for column in ["Open", "High", "Low", "Close", "Volume"]))
+    with _history_validators_lock:
+        _history_validators[(symbol, period, stock_src)] = (time.monotonic(), version, stock_data.index[-1])
+        _history_validators.move_to_end((symbol, period, stock_src))
+        while len(_history_validators) > STOCK_HISTORY_VALIDATOR_SIZE:
+            _history_validators.popitem(last=False)
+    return version, stock_data.index[-1]
+
+
+def recent_stock_history_version(symbol, period, stock_src):
+    # the (version, last bar timestamp) seen within STOCK_HISTORY_VALIDATOR_TTL seconds, or None
+    with _history_validators_lock:
+        validators = _history_validators.get((symbol, period, stock_src))
+    if validators is None or time.monotonic() - validators[0] > STOCK_HISTORY_VALIDATOR_TTL:
+        return None
+    return validators[1], validators[2]
+
+
+@async_single_flight
+async def get_stock_history_async(symbol, period, proxy=None, stock_src="yahoo"):
+    if stock_src != "marketwatch":
+        # yfinance has no async api, keep it off the event loop on the bounded io executor
+        return await executors.io.run(get_stock_history, symbol, period, proxy, stock_src)
+
+    try:
+        extra_info = {"earningsDate": ""}
+        stock_data = await get_stock_data_from_marketwatch_async(symbol, marketwatch_period_days(period))
+        if stock_data is not None and len(stock_data) > 0:
+            return stock_data, extra_info
+    except Exception:
+        logging.error(traceback.format_exc())
+
+    return None, None
+
+
 def price_simulation_mean_by_mc(symbol, days, ewma_his_vol_lambda, ewma_his_vol_period, iteration, proxy=None, stock_src="yahoo"):
     stock_data, extra_info = get_stock_history(symbol, "1y", proxy, stock_src)
     ewma_his_vol = formula.Volatility.ewma_historical_volatility(data=stock_data["Close"], period=ewma_his_vol_period,
                                                                  p_lambda=ewma_his_vol_lambda)
 
     mu = formula.Common.compounded_return(stock_data["Close"])
-    output = formula.Stock.price_simulation_by_mc(stock_data["Close"][-1], mu, ewma_his_vol, days, iteration=iteration)
+    output = formula.Stock.price_simulation_by_mc(stock_data["Close"].iloc[-1], mu, ewma_his_vol, days,
+                                                  iteration=iteration)
     final_price = output[:, -1]
     return final_price.mean()
 
 
-def price_simulation_all_by_mc(symbol, days, ewma_his_vol_lambda, ewma_his_vol_period, iteration,
-                               mu_vol_type=PriceSimulationType.AUTO_GEN_MU_VOL, mu=0, ewma_his_vol=0, proxy=None,
-                               stock_src="yahoo"):
+def price_simulation_params(symbol, ewma_his_vol_lambda, ewma_his_vol_period,
+                            mu_vol_type=PriceSimulationType.AUTO_GEN_MU_VOL, mu=0, ewma_his_vol=0, proxy=None,
+                            stock_src="yahoo"):
+    # (last close, mu, volatility) a simulation starts from, None if there is no history
     stock_data, extra_info = get_stock_history(symbol, "1y", proxy, stock_src)
+    if stock_data is None or len(stock_data) == 0:
+        return None
 
     if mu_vol_type is PriceSimulationType.AUTO_GEN_VOL or mu_vol_type is PriceSimulationType.AUTO_GEN_MU_VOL:
         ewma_his_vol = formula.Volatility.ewma_historical_volatility(data=stock_data["Close"],
@@ -145,158 +212,86 @@ def price_simulation_all_by_mc(symbol, days, ewma_his_vol_lambda, ewma_his_vol_p
     if mu_vol_type is PriceSimulationType.AUTO_GEN_MU or mu_vol_type is PriceSimulationType.AUTO_GEN_MU_VOL:
         mu = formula.Common.compounded_return(stock_data["Close"])
 
-    output = formula.Stock.price_simulation_by_mc(stock_data["Close"][-1], mu, ewma_his_vol, days, iteration=iteration)
-    return output
+    return stock_data["Close"].iloc[-1], mu, ewma_his_vol
 
 
-def get_ex_dividend_list():
-    logging.info('get_ex_dividend_list start')
-    url = 'https://www.dividend.com/api/t2/body.html/'
-    headers = {
-        'sec-ch-ua': 'Google Chrome";v="105", "Not)A;Brand";v="8", "Chromium";v="105',
-        'Accept': 'application/json, text/plain, */*',
-        'DNT': '1',
-        'Content-Type': 'application/json;charset=UTF-8',
-        'sec-ch-ua-mobile': '?0',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/105.0.0.0 Safari/537.36',
-        'sec-ch-ua-platform': 'Windows',
-        'Origin': 'https://www.dividend.com',
-        'Sec-Fetch-Site': 'same-origin',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Dest': 'empty',
-        'Referer': 'https://www.dividend.com/ex-dividend-dates/',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Accept-Language': 'en-US,en;q=0.9,zh-TW;q=0.8,zh;q=0.7'
-    }
+def price_simulation_all_by_mc(symbol, days, ewma_his_vol_lambda, ewma_his_vol_period, iteration,
+                               mu_vol_type=PriceSimulationType.AUTO_GEN_MU_VOL, mu=0, ewma_his_vol=0, proxy=None,
+                               stock_src="yahoo"):
+    params = price_simulation_params(symbol, ewma_his_vol_lambda, ewma_his_vol_period, mu_vol_type, mu, ewma_his_vol,
+                                     proxy, stock_src)
+    if params is None:
+        return None
 
-    output = {'data': []}
-    max_page = 100
+    s0, mu, ewma_his_vol = params
+    output = formula.Stock.price_simulation_by_mc(s0, mu, ewma_his_vol, days, iteration=iteration)
+    return output
 
-    for p in range(1, max_page):
-        payload = '{"uuid":"Merged-SEOTable","default_filters":[{"filterKey":"ShareClass","value":["Commons"],"filterType":"FilterShareClass","filterCollection":["CollectionMergedStocks"],"esType":"keyword"}],"tab":"TblTabDivMergedExDiv",' \
-                  '"page":' + str(p) +\
-            ',"collection":"CollectionMergedStocks","sort_by":{"PayoutNextExDate":"asc"},"theme":"FIN::L1(Dividend Income)","modal_key":null,"modal_keyword":null,"special_theme":"EX_DATE_YEAR_FROM_NOW","ad_unit_full_path":"/2143012/Div/Theme/ExDate","no_content_tray_ads_in_table":false}'
-        ret, content = web.send_post(url, headers, payload)
-        if ret == 0:
-            # logging.info(content)
-            # mp-table-body
-            soup = BeautifulSoup(content, "html.parser")
-            dom = etree.HTML(str(soup))
-            rows = dom.xpath('//div[@class="mp-table-body-row"]')
-            if len(rows) == 0:
-                break
 
-            for row in rows:
-                # r = etree.tostring(row, pretty_print=True)
-                cells = [elem for elem in row.iter() if elem is not row]
-                div_i = 0
-                # NAME | YIELD | DIV | FREQ | DEC-DATE | EX-DATE | PAY-DATE | AMOUNT | LAST_AMOUNT
-                row_output = {"symbol": "", "link": "", "ex_dividend_date": ""}
-                for i, _ in enumerate(cells):
-                    if cells[i].tag == 'div':
-                        div_i += 1
-
-                    if div_i == 2 and row_output['symbol'] == "":
-                        row_output['link'] = "https://www.dividend.com" + cells[i+1].attrib['href']
-                        row_output['symbol'] = cells[i+4].text
-                    if div_i == 6 and row_output['ex_dividend_date'] == "":  # EX-DATE
-                        month_day = cells[i+1].text.split('/')
-                        year = cells[i+2].text
-                        ymd = date(int(year), int(month_day[0]), int(month_day[1]))
-                        row_output["ex_dividend_date"] = ymd.strftime('%Y-%m-%d')
-
-                        logging.info('get ' + row_output['symbol'] + ' ex-dividend done')
-                        break
-
-                output['data'].append(row_output)
-        else:
-            logging.error('send_post failed or done: {ret}'.format(ret=ret))
-            break
+PRICE_SIMULATION_PERCENTILES = [5, 25, 50, 75, 95]
 
-        time.sleep(1)
 
-    logging.info('get_ex_dividend_list end')
-    return output
+def price_simulation_summary(s0, mu, ewma_his_vol, days, iteration, percentiles=PRICE_SIMULATION_PERCENTILES):
+    # per day percentile bands and mean of the simulated prices, one day of paths in memory at a time;
+    # returns (bands of shape (len(percentiles), days + 1), mean of shape (days + 1,))
+    bands = np.empty((len(percentiles), days + 1))
+    mean = np.empty(days + 1)
+    for day, prices in enumerate(formula.Stock.iter_price_simulation_by_mc(s0, mu, ewma_his_vol, days,
+                                                                           iteration=iteration)):
+        bands[:, day] = np.percentile(prices, percentiles)
+        mean[day] = prices.mean()
+    return bands, mean
 
 
-def get_all_dividend_list():
-    logging.info('get_all_dividend_list start')
-    url = 'https://www.dividend.com/api/t2/body.html/'
-    headers = {
-        'sec-ch-ua': 'Google Chrome";v="105", "Not)A;Brand";v="8", "Chromium";v="105',
-        'Accept': 'application/json, text/plain, */*',
-        'DNT': '1',
-        'Content-Type': 'application/json;charset=UTF-8',
-        'sec-ch-ua-mobile': '?0',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/105.0.0.0 Safari/537.36',
-        'sec-ch-ua-platform': 'Windows',
-        'Origin': 'https://www.dividend.com',
-        'Sec-Fetch-Site': 'same-origin',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Dest': 'empty',
-        'Referer': 'https://www.dividend.com/dividend-stock-screener/',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Accept-Language': 'en-US,en;q=0.9,zh-TW;q=0.8,zh;q=0.7'
-    }
+def npy_header(dtype, shape, fortran_order=False):
+    # the .npy header for an array written out after it in chunks
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                  "fortran_order": fortran_order, "shape": tuple(shape)})
+    return header.getvalue()
 
-    output = {'data': []}
-    max_page = 100
 
-    for p in range(1, max_page):
-        payload = '{"uuid":"Merged-SEOTable","default_filters":[{"filterKey":"ShareClass","value":["Commons"],"filterType":"FilterShareClass","filterCollection":["CollectionMergedStocks"],"esType":"keyword"}],"tab":"TblTabDivMergedOverviewSEO",' \
-                  '"page":' + str(p) +\
-                  ',"collection":"CollectionMergedStocks","sort_by":{"MarketCap":"desc"},"theme":"FIN::L1(Dividend Income)_&_STRUC::L1(Stock)","modal_key":null,"modal_keyword":null,"special_theme":"","ad_unit_full_path":"/2143012/Div/Theme/Screener","no_content_tray_ads_in_table":false}'
-        ret, content = web.send_post(url, headers, payload)
-        if ret == 0:
-            # logging.info(content)
-            # mp-table-body
-            soup = BeautifulSoup(content, "html.parser")
-            dom = etree.HTML(str(soup))
-            rows = dom.xpath('//div[@class="mp-table-body-row"]')
-            if len(rows) == 0:
-                break
+def simulate_price_days(prices, mu, ewma_his_vol, days):
+    # a process pool task: the next days of the paths from the prices of the last day, as float32 bytes one day after
+    # the other, and the prices of the new last day
+    blocks = []
+    for prices in itertools.islice(formula.Stock.iter_price_simulation_by_mc(prices, mu, ewma_his_vol, days,
+                                                                             iteration=len(prices)), 1, None):
+        blocks.append(prices.astype(np.float32).tobytes())
+    return b"".join(blocks), prices
 
-            for row in rows:
-                # r = etree.tostring(row, pretty_print=True)
-                cells = [elem for elem in row.iter() if elem is not row]
-                div_i = 0
-                row_output = {"symbol": "", "link": "", "ex_dividend_date": ""}
-                for i, _ in enumerate(cells):
-                    if cells[i].tag == 'div':
-                        div_i += 1
-                    if div_i == 2 and row_output['symbol'] == "":
-                        row_output['link'] = "https://www.dividend.com" + cells[i+1].attrib['href']
-                        row_output['symbol'] = cells[i+4].text
-                    if div_i == 6 and row_output['ex_dividend_date'] == "":  # EX-DATE
-                        month_day = cells[i+1].text.split('/')
-                        year = cells[i+2].text
-                        if year.isdigit() is False or month_day[0].isdigit() is False or month_day[1].isdigit() is False:
-                            row_output["ex_dividend_date"] = "-"
-                        else:
-                            ymd = date(int(year), int(month_day[0]), int(month_day[1]))
-                            row_output["ex_dividend_date"] = ymd.strftime('%Y-%m-%d')
-                        logging.info('get ' + row_output['symbol'] + ' ex-dividend done')
-                        break
-
-                output['data'].append(row_output)
-        else:
-            logging.error('send_post failed or done: {ret}'.format(ret=ret))
-            break
 
-        time.sleep(1)
+def iter_price_simulation_npy(s0, mu, ewma_his_vol, days, iteration, chunk_size=1 << 20):
+    # the (iteration, days + 1) float32 path matrix as .npy bytes in chunks of about chunk_size; it is stored in
+    # fortran order, so each simulated day is written out as is and the matrix is never held in memory; the days of
+    # a chunk are simulated on the process pool
+    prices = s0 * np.ones(iteration)
+    header = npy_header(np.float32, (iteration, days + 1), fortran_order=True)
+    yield header + prices.astype(np.float32).tobytes()
+    days_per_chunk = max(chunk_size // (iteration * 4), 1)
+    for day in range(0, days, days_per_chunk):
+        chunk, prices = executors.submit_cpu(simulate_price_days, prices, mu, ewma_his_vol,
+                                             min(days_per_chunk, days - day)).result()
+        yield chunk
 
-    logging.info('get_all_dividend_list end')
-    return output
 
+DIVIDEND_COM_LIST_URL = 'https://www.dividend.com/api/t2/body.html/'
+DIVIDEND_COM_DATA_SET_URL = 'https://www.dividend.com/api/data_set/'
+DIVIDEND_COM_MAX_PAGE = 100
+# dividend.com crawl settings, can be overridden by env
+DIVIDEND_COM_CONCURRENCY = int(os.environ.get("DIVIDEND_COM_CONCURRENCY", "4"))  # list pages in flight
+DIVIDEND_COM_RATE = float(os.environ.get("DIVIDEND_COM_RATE", "2"))  # requests per second, shared by all fetches
 
-def get_dividend_history_by_dividend_com(referer):
-    logging.info('get_dividend_history start')
-    url = ' https://www.dividend.com/api/data_set/'
-    headers = {
+dividend_com_budget = crawler.RateBudget(DIVIDEND_COM_RATE)
+
+
+def dividend_com_headers(referer, accept='application/json, text/plain, */*',
+                         content_type='application/json;charset=UTF-8'):
+    return {
         'sec-ch-ua': 'Google Chrome";v="105", "Not)A;Brand";v="8", "Chromium";v="105',
-        'Accept': 'application/json',
+        'Accept': accept,
         'DNT': '1',
-        'Content-Type': 'application/json',
+        'Content-Type': content_type,
         'sec-ch-ua-mobile': '?0',
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/105.0.0.0 Safari/537.36',
         'sec-ch-ua-platform': 'Windows',
@@ -309,24 +304,60 @@ def get_dividend_history_by_dividend_com(referer):
         'Accept-Language': 'en-US,en;q=0.9,zh-TW;q=0.8,zh;q=0.7'
     }
 
+
+def ex_dividend_list_payload(page):
+    return '{"uuid":"Merged-SEOTable","default_filters":[{"filterKey":"ShareClass","value":["Commons"],"filterType":"FilterShareClass","filterCollection":["CollectionMergedStocks"],"esType":"keyword"}],"tab":"TblTabDivMergedExDiv",' \
+           '"page":' + str(page) +\
+           ',"collection":"CollectionMergedStocks","sort_by":{"PayoutNextExDate":"asc"},"theme":"FIN::L1(Dividend Income)","modal_key":null,"modal_keyword":null,"special_theme":"EX_DATE_YEAR_FROM_NOW","ad_unit_full_path":"/2143012/Div/Theme/ExDate","no_content_tray_ads_in_table":false}'
+
+
+def all_dividend_list_payload(page):
+    return '{"uuid":"Merged-SEOTable","default_filters":[{"filterKey":"ShareClass","value":["Commons"],"filterType":"FilterShareClass","filterCollection":["CollectionMergedStocks"],"esType":"keyword"}],"tab":"TblTabDivMergedOverviewSEO",' \
+           '"page":' + str(page) +\
+           ',"collection":"CollectionMergedStocks","sort_by":{"MarketCap":"desc"},"theme":"FIN::L1(Dividend Income)_&_STRUC::L1(Stock)","modal_key":null,"modal_keyword":null,"special_theme":"","ad_unit_full_path":"/2143012/Div/Theme/Screener","no_content_tray_ads_in_table":false}'
+
+
+def dividend_history_payload(referer):
     if referer[-1] == '/':
         url_slug = referer.split('/')[-2]
     else:
         url_slug = referer.split('/')[-1]
 
+    return '{"tm":"3-ticker-payout-history-full-screen","r":"ES::DividendStock::Stock#HPQ--NYSE",' \
+           '"slug":"' + url_slug + \
+           '","default_tab":"overview","only":["meta","data","thead"]}'
+
+
+def parse_dividend_list_page(content):
+    output = []
+    for href, symbol, month_day, year in scraping.dividend_com_rows(content):
+        row_output = {"symbol": "", "link": "", "ex_dividend_date": ""}
+        if symbol is not None:
+            row_output['link'] = "https://www.dividend.com" + (href or "")
+            row_output['symbol'] = symbol
+        if month_day is not None and year is not None:  # EX-DATE
+            month_day = month_day.split('/')
+            if len(month_day) != 2 or year.isdigit() is False or month_day[0].isdigit() is False or \
+                    month_day[1].isdigit() is False:
+                row_output["ex_dividend_date"] = "-"
+            else:
+                ymd = date(int(year), int(month_day[0]), int(month_day[1]))
+                row_output["ex_dividend_date"] = ymd.strftime('%Y-%m-%d')
+            logging.info('get ' + row_output['symbol'] + ' ex-dividend done')
+
+        output.append(row_output)
+
+    return output
+
+
+def parse_dividend_history(content):
     output = {'data': []}
-    payload = '{"tm":"3-ticker-payout-history-full-screen","r":"ES::DividendStock::Stock#HPQ--NYSE",' \
-              '"slug":"' + url_slug + \
-              '","default_tab":"overview","only":["meta","data","thead"]}'
-    ret, content = web.send_post(url, headers, payload)
-    if ret == 0:
-        # logging.info(content)
-        resp = json.loads(content)
-        if 'data' not in resp:
-            logging.error('no data in resp: {resp}'.format(resp=resp))
-        else:
-            for dividend in resp['data']:
-                """
+    resp = json.loads(content)
+    if 'data' not in resp:
+        logging.error('no data in resp: {resp}'.format(resp=resp))
+    else:
+        for dividend in resp['data']:
+            """
 "year": "2025e",
 "calendar_year_payout": "-",
 "calendar_year_payout_growth": "-",
@@ -339,12 +370,101 @@ def get_dividend_history_by_dividend_com(referer):
 "payment_frequency": "Quarterly",
 "days_to_recovery": "-",
 "close_on_ex_date": "0.35%"
-                """
-                row_output = {"adjusted_amount": float(dividend["adjusted_amount"].replace('$', '')),
-                              "declared_date": dividend["declared_date"], "ex_date": dividend["ex_date"], 
-                              "payment_types": dividend["payment_types"], "type": dividend["type"], 
-                              "payment_frequency": dividend["payment_frequency"]}
-                output['data'].append(row_output)
+            """
+            row_output = {"adjusted_amount": float(dividend["adjusted_amount"].replace('$', '')),
+                          "declared_date": dividend["declared_date"], "ex_date": dividend["ex_date"],
+                          "payment_types": dividend["payment_types"], "type": dividend["type"],
+                          "payment_frequency": dividend["payment_frequency"]}
+            output['data'].append(row_output)
+
+    return output
+
+
+def load_dividend_list(path):
+    # previous run's output for the incremental mode, None if it is missing or broken
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            previous = json.loads(f.read())
+        if 'data' in previous:
+            return previous
+    except FileNotFoundError:
+        logging.info('no previous dividend list: {path}'.format(path=path))
+    except Exception:
+        logging.error(traceback.format_exc())
+
+    return None
+
+
+def dividend_list_key(row):
+    return row['symbol'], row['ex_dividend_date']
+
+
+def dividend_list_consumer(output, previous=None):
+    # collect pages in order, stop at the first failed or empty page;
+    # in incremental mode also stop after the first page whose rows were all seen in the previous run
+    seen = set() if previous is None else set(dividend_list_key(row) for row in previous['data'])
+
+    def consume(page, result):
+        ret, content = result
+        if ret != 0:
+            logging.error('send_post failed or done: {ret}'.format(ret=ret))
+            return False
+        rows = parse_dividend_list_page(content)
+        if len(rows) == 0:
+            return False
+        output['data'] += rows
+        if len(seen) > 0 and all(dividend_list_key(row) in seen for row in rows):
+            logging.info('page {page} was seen in the previous run, stop'.format(page=page))
+            return False
+        return True
+
+    return consume
+
+
+def merge_dividend_list(output, previous):
+    # crawled rows first, then the previous run's rows of the symbols not crawled again
+    if previous is not None:
+        symbols = set(row['symbol'] for row in output['data'])
+        output['data'] += [row for row in previous['data'] if row['symbol'] not in symbols]
+    return output
+
+
+def get_dividend_list(headers, payload_func, previous=None):
+    output = {'data': []}
+
+    def fetch(p):
+        return web.send_post(DIVIDEND_COM_LIST_URL, headers, payload_func(p))
+
+    crawler.crawl_pages(fetch, dividend_list_consumer(output, previous), DIVIDEND_COM_MAX_PAGE,
+                        concurrency=DIVIDEND_COM_CONCURRENCY, budget=dividend_com_budget)
+    return merge_dividend_list(output, previous)
+
+
+def get_ex_dividend_list(previous=None):
+    logging.info('get_ex_dividend_list start')
+    output = get_dividend_list(dividend_com_headers('https://www.dividend.com/ex-dividend-dates/'),
+                               ex_dividend_list_payload, previous)
+    logging.info('get_ex_dividend_list end')
+    return output
+
+
+def get_all_dividend_list(previous=None):
+    logging.info('get_all_dividend_list start')
+    output = get_dividend_list(dividend_com_headers('https://www.dividend.com/dividend-stock-screener/'),
+                               all_dividend_list_payload, previous)
+    logging.info('get_all_dividend_list end')
+    return output
+
+
+def get_dividend_history_by_dividend_com(referer):
+    logging.info('get_dividend_history start')
+    output = {'data': []}
+    headers = dividend_com_headers(referer, accept='application/json', content_type='application/json')
+    dividend_com_budget.wait()
+    ret, content = web.send_post(DIVIDEND_COM_DATA_SET_URL, headers, dividend_history_payload(referer))
+    if ret == 0:
+        # logging.info(content)
+        output = parse_dividend_history(content)
     else:
         logging.info('send_post failed or done: {ret}'.format(ret=ret))
 
@@ -354,28 +474,24 @@ def get_dividend_history_by_dividend_com(referer):
 
 def get_dividend_history_by_yahoo(symbol):
     logging.info('get_dividend_history_by_yahoo start')
-    data_dict = {}
-    output_dict = {}
-    data = get_stock(symbol)
-    dividends = data.dividends.to_dict()
-    for key, value in dividends.items():
-        data_dict[key.strftime('%Y-%m-%d')] = {}
-
-    history = data.history(period="max", interval="1d").to_dict()
-    for ohlcv_key, ohlcv_val in history.items():
-        for key, value in ohlcv_val.items():
-            d = key.strftime('%Y-%m-%d')
-            if ohlcv_key != 'Dividends' or d in data_dict:
-                if d not in output_dict:
-                    output_dict[d] = {}
-                if ohlcv_key == 'Dividends' or ohlcv_key == 'Volume' or ohlcv_key == 'Close':
-                    output_dict[d][ohlcv_key] = value
-
     output = {"data": []}
-    for key, value in output_dict.items():
-        row_output = {"date": key}
-        row_output.update(value)
-        output["data"].append(row_output)
+    data = get_stock(symbol)
+    dividend_dates = data.dividends.index
+    history = data.history(period="max", interval="1d")
+    if len(history) > 0:
+        # format the dates once, a date appearing twice keeps its last bar
+        dates = history.index.strftime('%Y-%m-%d')
+        keep = ~dates.duplicated(keep='last')
+        history = history[keep]
+        dates = dates[keep]
+        # Dividends is only kept on the ex-dividend dates
+        has_dividend = dates.isin(pd.DatetimeIndex(dividend_dates).strftime('%Y-%m-%d'))
+        columns = [c for c in ['Close', 'Volume', 'Dividends'] if c in history.columns]
+        keys = ['date'] + columns
+        short_keys = [k for k in keys if k != 'Dividends']
+        # Dividends is the last column, zip() with the short keys drops it
+        output["data"] = [dict(zip(keys if d else short_keys, row)) for d, row in
+                          zip(has_dividend.tolist(), zip(dates.tolist(), *[history[c].tolist() for c in columns]))]
 
     logging.info('get_dividend_history_by_yahoo end')
     return output
@@ -12,7 +12,7 @@ from fastapi.testclient import TestClient
 from urllib.parse import urlencode
 
 from main import app
-from models.stock import get_ex_dividend_list
+from models.stock import get_ex_dividend_list, load_dividend_list
 from utils import web
 
 
@@ -187,11 +187,15 @@ if __name__ == "__main__":
     parser.add_argument("-d", "-data-source", dest="data_source", default="marketwatch")
     parser.add_argument("-c", "-calc-kelly-iv", dest="calc_kelly_iv", action="store_true")
     parser.add_argument("-m", "-max-next-days", dest="max_next_days", default="40")
+    parser.add_argument("-u", "-incremental-ex-dividend", dest="incremental_ex_dividend", action="store_true")
     args = parser.parse_args()
 
     logging.basicConfig(level=args.log_level)
 
-    ex_dividend_date_list = get_ex_dividend_list()
+    previous_ex_dividend_date_list = None
+    if args.incremental_ex_dividend:
+        previous_ex_dividend_date_list = load_dividend_list(output_folder / 'ex_dividend_date_list.json')
+    ex_dividend_date_list = get_ex_dividend_list(previous_ex_dividend_date_list)
     logging.info(ex_dividend_date_list)
     with open(output_folder / 'ex_dividend_date_list.json', 'w', encoding='utf-8') as f:
         f.write(json.dumps(ex_dividend_date_list, separators=(',', ':')))
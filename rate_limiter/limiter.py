@@ -1,4 +1,16 @@
+import os
+import tempfile
+
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
-app_limiter = Limiter(key_func=get_remote_address)
+from rate_limiter import storage  # registers the sqlite:// storage scheme
+
+
+# shared by the gunicorn workers on the host by default, e.g. redis://host:6379 across hosts or memory:// per worker
+RATE_LIMIT_STORAGE_URI = os.environ.get(
+    "RATE_LIMIT_STORAGE_URI", "sqlite://" + os.path.join(tempfile.gettempdir(), "norn-rate-limit.db"))
+
+# while the shared storage is unreachable, each worker counts in memory
+app_limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE_URI,
+                      in_memory_fallback_enabled=True)
@@ -0,0 +1,88 @@
+import os
+import time
+import sqlite3
+import threading
+import urllib.parse
+
+from limits.storage import Storage
+
+
+class SQLiteStorage(Storage):
+    # fixed window counters in a sqlite file, shared by the worker processes on the host, e.g.
+    # sqlite:///tmp/norn-rate-limit.db; each thread of each process has its own connection
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri, wrap_exceptions=False, timeout=5.0, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.path = urllib.parse.urlparse(uri).path
+        self.timeout = float(timeout)
+        self._local = threading.local()
+        with self._transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS counters "
+                               "(key TEXT PRIMARY KEY, value INTEGER NOT NULL, expiry REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS counters_expiry ON counters (expiry)")
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        if getattr(self._local, "pid", None) != os.getpid():
+            # the parent's connection is not used after a fork
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM counters WHERE expiry <= ?", (now,))
+            connection.execute("INSERT INTO counters (key, value, expiry) VALUES (?, ?, ?) "
+                               "ON CONFLICT (key) DO UPDATE SET value = value + excluded.value",
+                               (key, amount, now + expiry))
+            return connection.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()[0]
+
+    def get(self, key):
+        row = self._connection().execute("SELECT value FROM counters WHERE key = ? AND expiry > ?",
+                                          (key, time.time())).fetchone()
+        return row[0] if row is not None else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self._connection().execute("SELECT expiry FROM counters WHERE key = ? AND expiry > ?",
+                                          (key, now)).fetchone()
+        return row[0] if row is not None else now
+
+    def check(self):
+        try:
+            self._connection().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self._transaction() as connection:
+            return connection.execute("DELETE FROM counters").rowcount
+
+    def clear(self, key):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM counters WHERE key = ?", (key,))
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so a read-modify-write isn't interleaved with another process
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
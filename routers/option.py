@@ -1,23 +1,32 @@
+import os
+import math
 import time
-import threading
+import asyncio
+import logging
+import tempfile
+import functools
+import traceback
 
 from typing import List, Optional
 from fastapi import FastAPI, APIRouter, HTTPException, Request, Response
-from fastapi.websockets import WebSocket
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from fastapi.websockets import WebSocket, WebSocketDisconnect
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, create_model
 
 from rate_limiter import limiter
 from models import option, stock
+from utils import admission, executors, http_cache, metrics, result_cache, serialization, singleflight
 
 
 class ValuationData(BaseModel):
     BSM_EWMAHisVol: float
-    MC_EWMAHisVol: float
-    BT_EWMAHisVol: float
-    KellyCriterion_buy: float
-    KellyCriterion_sell: float
-    KellyCriterion_MU_0_sell: float
-    KellyCriterion_MU_0_buy: float
+    MC_EWMAHisVol: Optional[float] = None
+    BT_EWMAHisVol: Optional[float] = None
+    KellyCriterion_buy: Optional[float] = None
+    KellyCriterion_sell: Optional[float] = None
+    KellyCriterion_MU_0_sell: Optional[float] = None
+    KellyCriterion_MU_0_buy: Optional[float] = None
     KellyCriterion_IV_buy: Optional[float] = None
     KellyCriterion_IV_sell: Optional[float] = None
     exerciseProbability: Optional[float] = None
@@ -68,6 +77,23 @@ class OptionsChainQuotesValuationResponse(BaseModel):
     contracts: List[OptionsChainQuotesData]
 
 
+class WsProgressMessage(BaseModel):
+    type: str = "progress"
+    expiryCount: int
+    elapsedSeconds: float
+
+
+class WsSummaryMessage(BaseModel):
+    type: str = "summary"
+    symbol: str
+    stockPrice: Optional[float] = None
+    stockExtraInfo: Optional[StockExtraInfo] = None
+    EWMA_historicalVolatility: Optional[float] = None
+    expiryCount: int
+    contractCount: int
+    elapsedSeconds: float
+
+
 class OptionsVolumeOpenInterestData(BaseModel):
     totalVolume: int
     totalOpenInterest: int
@@ -95,8 +121,146 @@ router = APIRouter(
 
 ws = FastAPI()
 
+@functools.lru_cache(maxsize=64)
+def side_model(fields=None):
+    # OptionsChainBaseData whose valuationData has only the fields (a tuple) of a methods= or fields= request
+    if fields is None:
+        return OptionsChainBaseData
+    valuation_data = create_model("ValuationData", **{name: (field.annotation, field)
+                                                      for name, field in ValuationData.model_fields.items()
+                                                      if name in fields})
+    return create_model("OptionsChainBaseData", __base__=OptionsChainBaseData,
+                        valuationData=(Optional[valuation_data], None))
+
+
+def contracts_to_response(contracts, layout="records", fields=None):
+    # internal chain columns to OptionsChainQuotesData shaped dicts, without a pydantic model per contract
+    # layout: records, a list of OptionsChainBaseData per side; columnar, a list per OptionsChainBaseData field;
+    # a degraded expiry also lists the valuationData fields valued with fewer iterations or left null in "degraded";
+    # fields: the valuationData fields to keep, all by default
+    side_to_response = serialization.LAYOUTS[layout]
+    model = side_model(None if fields is None else tuple(fields))
+    output = []
+    for contract in contracts:
+        output.append({"expiryDate": contract["expiryDate"],
+                       "calls": side_to_response(model, contract["calls"]),
+                       "puts": side_to_response(model, contract["puts"])})
+        if "degraded" in contract:
+            output[-1]["degraded"] = contract["degraded"]
+    return output
+
 
-@router.get("/quote", tags=["quote"], response_model=OptionsChainQuotesResponse)
+def degraded_fields(contracts):
+    fields = {field for contract in contracts for field in contract.get("degraded", [])}
+    return [field for field in option.BSM_ONLY_SKIPPED_FIELDS if field in fields]
+
+
+def quotes_valuation_response(symbol, stock_price=None, extra_info=None, ewma_his_vol=None, contracts=(),
+                              layout="records", fields=None):
+    # an OptionsChainQuotesValuationResponse shaped dict
+    return {"symbol": symbol, "stockPrice": stock_price,
+            "stockExtraInfo": StockExtraInfo(**extra_info).model_dump() if extra_info is not None else None,
+            "EWMA_historicalVolatility": ewma_his_vol,
+            "contracts": contracts_to_response(contracts, layout, fields)}
+
+
+# symbols a batch request values at the same time, and the most symbols it may ask for
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_SYMBOLS = int(os.environ.get("BATCH_MAX_SYMBOLS", "50"))
+# seconds between progress frames while a streaming websocket waits for the next expiry
+WS_PROGRESS_INTERVAL = float(os.environ.get("WS_PROGRESS_INTERVAL", "1.0"))
+# the quote-valuation routes share a rate limit in units of a valuation with the default parameters: the strikes
+# priced grow with the expiry window, the kelly simulations with the iterations too, calc_kelly_iv simulates per strike
+VALUATION_RATE_LIMIT = os.environ.get("VALUATION_RATE_LIMIT", "100/minute")
+VALUATION_COST_DAYS = float(os.environ.get("VALUATION_COST_DAYS", "40"))
+VALUATION_COST_ITERATION = float(os.environ.get("VALUATION_COST_ITERATION", "100000"))
+VALUATION_COST_KELLY_IV = float(os.environ.get("VALUATION_COST_KELLY_IV", "4"))
+VALUATION_MAX_COST = int(os.environ.get("VALUATION_MAX_COST", "100"))  # no request costs more than the whole limit
+# encoded quote-valuation responses shared by the workers on the host, 0 bytes disables it
+VALUATION_CACHE_DIR = os.environ.get("VALUATION_CACHE_DIR",
+                                     os.path.join(tempfile.gettempdir(), "norn-valuation-cache"))
+VALUATION_CACHE_MAX_BYTES = int(os.environ.get("VALUATION_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+VALUATION_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("VALUATION_CACHE_MAX_ENTRY_BYTES", str(16 * 1024 * 1024)))
+
+valuation_cache = result_cache.DiskLRUCache(VALUATION_CACHE_DIR, VALUATION_CACHE_MAX_BYTES,
+                                            VALUATION_CACHE_MAX_ENTRY_BYTES)
+metrics.register("valuationCache", valuation_cache.metrics)
+
+
+def quotes_valuation_cache_key(symbol, *params):
+    # the parameters as parsed, so the spelling and order of the query don't matter, and the version of the
+    # upstream data; proxy only changes the route to the data, it's not a parameter
+    return ("quote-valuation", http_cache.data_version(), symbol.strip(), *params)
+
+
+def valuation_cost(query_params, specific_contract=None):
+    # a request's units, its parameters are parsed leniently: invalid ones are rejected after the limit anyway
+    def number(name, default):
+        try:
+            return float(query_params.get(name, default))
+        except (TypeError, ValueError):
+            return default
+
+    try:
+        fields = option.parse_valuation_fields(query_params.get("methods"), query_params.get("fields"))
+    except ValueError:
+        fields = None
+    # BSM and the greeks alone are evaluated on whole columns, without the process pool
+    if specific_contract or query_params.get("specific_contract") or \
+            (fields is not None and all(field in option.BSM_FIELDS for field in fields)):
+        return 1
+
+    days = max(number("max_next_days", 40) - number("min_next_days", 0), 1) / VALUATION_COST_DAYS
+    cost = days * (1 + max(number("iteration", 100000), 0) / VALUATION_COST_ITERATION) / 2
+    if fields is not None:
+        kelly_iv = "KellyCriterion_IV" in option.pricing_engines(fields)
+    else:
+        kelly_iv = str(query_params.get("calc_kelly_iv", "")).lower() in ["1", "true", "t", "yes", "y", "on"]
+    if kelly_iv:
+        cost *= VALUATION_COST_KELLY_IV
+    return min(max(math.ceil(cost), 1), VALUATION_MAX_COST)
+
+
+def quote_valuation_cost(request: Request):
+    return valuation_cost(request.query_params)
+
+
+def quote_valuation_batch_cost(request: Request):
+    specs = option.parse_batch_specs(request.query_params.get("symbols", ""))
+    return min(max(sum(valuation_cost(request.query_params, specific_contract) for _, specific_contract in specs), 1),
+               VALUATION_MAX_COST)
+
+
+def degraded_headers(ticket, fields=None):
+    # names the valuationData fields (of those asked for) a degraded valuation left null
+    skipped = [field for field in option.BSM_ONLY_SKIPPED_FIELDS if fields is None or field in fields]
+    if ticket.mode != admission.DEGRADED or len(skipped) == 0:
+        return {}
+    return valuation_degraded_headers(skipped)
+
+
+def stream_headers(ticket, fields, deadline):
+    # a stream with a deadline may be degraded or cut short after its headers are sent
+    headers = degraded_headers(ticket, fields)
+    return headers if deadline is None else dict(headers, **http_cache.NO_STORE)
+
+
+def valuation_degraded_headers(fields):
+    # a shared cache must not answer later requests, made when there is capacity, with the degraded valuation
+    return dict(http_cache.NO_STORE, **{"X-Valuation-Degraded": ",".join(fields)})
+
+
+async def released(ticket, chunks):
+    # the admitted work is in flight until the stream ends
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        ticket.release()
+
+
+@router.get("/quote", tags=["quote"], response_model=OptionsChainQuotesResponse,
+            response_class=serialization.NumpyJSONResponse)
 @limiter.app_limiter.limit("100/minute")
 async def options_chain_quotes(request: Request, response: Response, symbol: str, min_next_days: Optional[int] = 0,
                                max_next_days: Optional[int] = 40,
@@ -104,22 +268,27 @@ async def options_chain_quotes(request: Request, response: Response, symbol: str
                                min_price: Optional[float] = 0,
                                last_trade_days: Optional[int] = 3,
                                specific_contract: Optional[str] = None,
-                               proxy: Optional[str] = None):
-    if not symbol:
+                               proxy: Optional[str] = None,
+                               layout: Optional[str] = "records"):
+    if not symbol or layout not in serialization.LAYOUTS:
         raise HTTPException(status_code=400, detail="Invalid request parameter")
 
-    contracts = option.get_option_chain(symbol, min_next_days, max_next_days, min_volume, min_price, last_trade_days,
-                                        specific_contract, proxy)
+    contracts = await executors.io.run(option.get_option_chain, symbol, min_next_days, max_next_days, min_volume,
+                                       min_price, last_trade_days, specific_contract, proxy)
     if len(contracts) == 0:
-        return {"symbol": symbol, "contracts": []}
+        # it may be a failed fetch
+        return serialization.NumpyJSONResponse({"symbol": symbol, "stockPrice": None, "stockExtraInfo": None,
+                                                "contracts": []}, headers=http_cache.NO_STORE)
 
-    stock_data, extra_info = stock.get_stock_history(symbol, "1d")
-    return {"symbol": symbol, "stockPrice": stock_data["Close"].iloc[-1],
-            "stockExtraInfo": extra_info, "contracts": contracts}
+    stock_data, extra_info = await stock.get_stock_history_async(symbol, "1d")
+    output = quotes_valuation_response(symbol, stock_data["Close"].iloc[-1], extra_info, None, contracts, layout)
+    del output["EWMA_historicalVolatility"]
+    return serialization.NumpyJSONResponse(output)
 
 
-@router.get("/quote-valuation", tags=["quote"], response_model=OptionsChainQuotesValuationResponse)
-@limiter.app_limiter.limit("100/minute")
+@router.get("/quote-valuation", tags=["quote"], response_model=OptionsChainQuotesValuationResponse,
+            response_class=serialization.NumpyJSONResponse)
+@limiter.app_limiter.shared_limit(VALUATION_RATE_LIMIT, scope="valuation", cost=quote_valuation_cost)
 async def options_chain_quotes_valuation(request: Request, response: Response, symbol: str,
                                          min_next_days: Optional[int] = 0, max_next_days: Optional[int] = 40,
                                          min_volume: Optional[int] = 10,
@@ -132,19 +301,192 @@ async def options_chain_quotes_valuation(request: Request, response: Response, s
                                          proxy: Optional[str] = None,
                                          stock_src: Optional[str] = "yahoo",
                                          calc_kelly_iv: Optional[bool] = False,
-                                         iteration: Optional[int] = 100000):
-    if not symbol:
+                                         iteration: Optional[int] = 100000,
+                                         format: Optional[str] = "json",
+                                         layout: Optional[str] = "records",
+                                         degrade: Optional[bool] = True,
+                                         deadline_ms: Optional[int] = None,
+                                         methods: Optional[str] = None,
+                                         fields: Optional[str] = None):
+    # under load the valuation is admitted BSM-only (X-Valuation-Degraded), or with degrade=false rejected with a 503;
+    # deadline_ms: MC, BT and the kelly criterions are shrunk or skipped to answer in time, see option.Deadline, and
+    # expiries not fetched by then are left out (X-Valuation-Truncated, an ndjson stream just ends);
+    # methods, fields: comma separated option.PRICING_ENGINES and valuationData fields, only those engines run and
+    # valuationData has only their fields and the fields named (calc_kelly_iv is then ignored)
+    try:
+        valuation_fields = option.parse_valuation_fields(methods, fields)
+    except ValueError:
         raise HTTPException(status_code=400, detail="Invalid request parameter")
-
-    stock_price, extra_info, ewma_his_vol, contracts = \
-        option.options_chain_quotes_valuation(symbol, min_next_days, max_next_days, min_volume, min_price,
-                                              last_trade_days, ewma_his_vol_period, ewma_his_vol_lambda, only_otm,
-                                              specific_contract, proxy, stock_src, calc_kelly_iv, iteration)
-    if contracts is None or len(contracts) == 0:
-        return {"symbol": symbol, "contracts": []}
-
-    return {"symbol": symbol, "stockPrice": stock_price, "stockExtraInfo": extra_info,
-            "EWMA_historicalVolatility": ewma_his_vol, "contracts": contracts}
+    if not symbol or format not in ["json", "ndjson"] or layout not in serialization.LAYOUTS or \
+            (deadline_ms is not None and deadline_ms <= 0):
+        raise HTTPException(status_code=400, detail="Invalid request parameter")
+    deadline = option.Deadline(deadline_ms / 1000) if deadline_ms is not None else None
+
+    if format == "ndjson":
+        ticket = admission.valuation.acquire(valuation_cost(request.query_params), degrade)
+        items = executors.io.iterate(ticket.iterate(option.iter_options_chain_quotes_valuation(
+            symbol, min_next_days, max_next_days, min_volume, min_price, last_trade_days, ewma_his_vol_period,
+            ewma_his_vol_lambda, only_otm, specific_contract, proxy, stock_src, calc_kelly_iv, iteration,
+            ticket.mode == admission.DEGRADED, deadline, valuation_fields)))
+        # released by the stream, or after the response if the stream never started
+        return StreamingResponse(released(ticket, ndjson_quotes_valuation(symbol, items, layout, valuation_fields)),
+                                 media_type="application/x-ndjson",
+                                 headers=stream_headers(ticket, valuation_fields, deadline),
+                                 background=BackgroundTask(ticket.release))
+
+    key = quotes_valuation_cache_key(symbol, min_next_days, max_next_days, min_volume, min_price, last_trade_days,
+                                     ewma_his_vol_period, ewma_his_vol_lambda, only_otm, specific_contract,
+                                     stock_src, calc_kelly_iv, iteration, layout,
+                                     None if valuation_fields is None else tuple(valuation_fields))
+    # file reads and writes stay off the event loop
+    body = await executors.io.run(valuation_cache.get, key)
+    if body is not None:
+        return Response(body, media_type="application/json", headers={"X-Cache": "HIT"})
+
+    async def value():
+        with admission.valuation.admit(valuation_cost(request.query_params), degrade) as ticket:
+            stock_price, extra_info, ewma_his_vol, contracts = \
+                await executors.io.run(ticket.timed(option.options_chain_quotes_valuation), symbol, min_next_days,
+                                       max_next_days, min_volume, min_price, last_trade_days, ewma_his_vol_period,
+                                       ewma_his_vol_lambda, only_otm, specific_contract, proxy, stock_src,
+                                       calc_kelly_iv, iteration, ticket.mode == admission.DEGRADED, deadline,
+                                       valuation_fields)
+        if contracts is None or len(contracts) == 0:
+            # not cached, it may be a failed fetch
+            return serialization.dumps(quotes_valuation_response(symbol)), http_cache.NO_STORE
+
+        output = serialization.dumps(quotes_valuation_response(symbol, stock_price, extra_info, ewma_his_vol,
+                                                               contracts, layout, valuation_fields))
+        degraded = degraded_fields(contracts)
+        truncated = deadline is not None and deadline.truncated
+        if len(degraded) == 0 and not truncated:
+            # a full valuation answers any deadline
+            await executors.io.run(valuation_cache.put, key, output)
+            return output, {}
+        headers = valuation_degraded_headers(degraded) if len(degraded) > 0 else dict(http_cache.NO_STORE)
+        if truncated:
+            # the expiries after the last one listed were not fetched by the deadline
+            headers["X-Valuation-Truncated"] = "true"
+        return output, headers
+
+    # the same request in flight on this worker is admitted and valued once
+    body, headers = await singleflight.async_group.do((key, degrade, deadline_ms), value)
+    return Response(body, media_type="application/json", headers=dict(headers, **{"X-Cache": "MISS"}))
+
+
+@router.get("/quote-valuation-batch", tags=["quote"])
+@limiter.app_limiter.shared_limit(VALUATION_RATE_LIMIT, scope="valuation", cost=quote_valuation_batch_cost)
+async def options_chain_quotes_valuation_batch(request: Request, response: Response, symbols: str,
+                                               min_next_days: Optional[int] = 0, max_next_days: Optional[int] = 40,
+                                               min_volume: Optional[int] = 10,
+                                               min_price: Optional[float] = 0,
+                                               last_trade_days: Optional[int] = 3,
+                                               ewma_his_vol_period: Optional[int] = 21,
+                                               ewma_his_vol_lambda: Optional[float] = 0.94,
+                                               only_otm: Optional[bool] = False,
+                                               proxy: Optional[str] = None,
+                                               stock_src: Optional[str] = "yahoo",
+                                               calc_kelly_iv: Optional[bool] = False,
+                                               iteration: Optional[int] = 100000,
+                                               degrade: Optional[bool] = True,
+                                               deadline_ms: Optional[int] = None,
+                                               methods: Optional[str] = None,
+                                               fields: Optional[str] = None):
+    # symbols: comma separated {symbol} or {symbol}_{specific_contract}, with the other parameters shared;
+    # streams a line per symbol as soon as it is valued: the quote-valuation response with specificContract and error
+    try:
+        valuation_fields = option.parse_valuation_fields(methods, fields)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid request parameter")
+    specs = option.parse_batch_specs(symbols)
+    if len(specs) == 0 or len(specs) > BATCH_MAX_SYMBOLS or (deadline_ms is not None and deadline_ms <= 0):
+        raise HTTPException(status_code=400, detail="Invalid request parameter")
+    # one deadline for the whole batch
+    deadline = option.Deadline(deadline_ms / 1000) if deadline_ms is not None else None
+
+    # admitted as a whole, under load every symbol is valued BSM-only
+    ticket = admission.valuation.acquire(quote_valuation_batch_cost(request), degrade)
+
+    def value(symbol, specific_contract):
+        return ticket.iterate(option.iter_options_chain_quotes_valuation(
+            symbol, min_next_days, max_next_days, min_volume, min_price, last_trade_days, ewma_his_vol_period,
+            ewma_his_vol_lambda, only_otm, specific_contract, proxy, stock_src, calc_kelly_iv, iteration,
+            ticket.mode == admission.DEGRADED, deadline, valuation_fields))
+
+    return StreamingResponse(released(ticket, ndjson_quotes_valuation_batch(specs, value, valuation_fields)),
+                             media_type="application/x-ndjson",
+                             headers=stream_headers(ticket, valuation_fields, deadline),
+                             background=BackgroundTask(ticket.release))
+
+
+async def quotes_valuation_batch_item(symbol, specific_contract, items, fields=None):
+    stock_price = extra_info = ewma_his_vol = None
+    contracts = []
+    try:
+        async for stock_price, extra_info, ewma_his_vol, expiry_calls_puts in items:
+            contracts.append(expiry_calls_puts)
+
+    except Exception as ex:
+        # reported in the symbol's line, the rest of the batch goes on
+        logging.error(traceback.format_exc())
+        return dict(quotes_valuation_response(symbol), specificContract=specific_contract,
+                    error=str(ex) or type(ex).__name__)
+
+    finally:
+        await items.aclose()
+
+    return dict(quotes_valuation_response(symbol, stock_price, extra_info, ewma_his_vol, contracts, fields=fields),
+                specificContract=specific_contract, error=None)
+
+
+async def ndjson_quotes_valuation_batch(specs, value, fields=None):
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(symbol, specific_contract):
+        async with semaphore:
+            # the batch is admitted as a whole, a symbol started later waits for the io executor
+            return await quotes_valuation_batch_item(
+                symbol, specific_contract, executors.io.iterate(value(symbol, specific_contract), admitted=True),
+                fields)
+
+    tasks = [asyncio.ensure_future(run(symbol, specific_contract)) for symbol, specific_contract in specs]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield serialization.dumps_line(await task)
+
+    finally:
+        # the client is gone, a cancelled symbol stops fetching after its current expiry
+        for task in tasks:
+            task.cancel()
+
+
+async def ndjson_quotes_valuation(symbol, items, layout="records", fields=None):
+    # a header line with the stock data once the first expiry is valued, then a line per expiry; a stream cut short
+    # by a failure ends with an {"error": ...} line, like a failed symbol's line of a batch
+    header = None
+    error = None
+    try:
+        async for stock_price, extra_info, ewma_his_vol, expiry_calls_puts in items:
+            if header is None:
+                header = quotes_valuation_response(symbol, stock_price, extra_info, ewma_his_vol)
+                del header["contracts"]
+                yield serialization.dumps_line(header)
+            yield serialization.dumps_line(contracts_to_response([expiry_calls_puts], layout, fields)[0])
+
+    except Exception as ex:
+        # the status is sent already, the client learns of the failure from the last line
+        logging.error(traceback.format_exc())
+        error = str(ex) or type(ex).__name__
+
+    finally:
+        await items.aclose()
+
+    if header is None:
+        header = quotes_valuation_response(symbol)
+        del header["contracts"]
+        yield serialization.dumps_line(header)
+    if error is not None:
+        yield serialization.dumps_line({"error": error})
 
 
 @ws.websocket("/option/quote-valuation")
@@ -161,40 +503,83 @@ async def ws_options_chain_quotes_valuation(websocket: WebSocket, symbol: str,
                                             stock_src: Optional[str] = "yahoo",
                                             calc_kelly_iv: Optional[bool] = False,
                                             iteration: Optional[int] = 100000,
-                                            with_heartbeat: Optional[bool] = True):
-
-    class RunThread(threading.Thread):
-        output = None
-
-        def __init__(self):
-            threading.Thread.__init__(self)
-
-        def run(self):
-            stock_price, extra_info, ewma_his_vol, contracts = \
-                option.options_chain_quotes_valuation(symbol, min_next_days, max_next_days, min_volume, min_price,
-                                                      last_trade_days, ewma_his_vol_period, ewma_his_vol_lambda,
-                                                      only_otm, specific_contract, proxy, stock_src, calc_kelly_iv,
-                                                      iteration)
-            if contracts is None or len(contracts) == 0:
-                self.output = {"symbol": symbol, "contracts": []}
-            else:
-                self.output = {"symbol": symbol, "stockPrice": stock_price, "stockExtraInfo": extra_info,
-                               "EWMA_historicalVolatility": ewma_his_vol, "contracts": contracts}
-
+                                            with_heartbeat: Optional[bool] = True,
+                                            stream: Optional[bool] = False):
+    # with_heartbeat is kept for old clients, nothing waits for their heartbeat anymore;
+    # admitted like the HTTP routes: under load valued BSM-only (the expiries list their "degraded" fields), or closed
+    # with 1013 (try again later)
     await websocket.accept()
-    t = RunThread()
-    t.start()
-    while True:
-        if not t.is_alive():
-            # don't pass t.output directly, may occur "Object of type longdouble is not JSON serializable"
-            await websocket.send_json(OptionsChainQuotesValuationResponse(**t.output).model_dump())
-            break
-        if with_heartbeat:
-            _ = await websocket.receive_text()
-        else:
-            time.sleep(1.0)
-
-    await websocket.close()
+    try:
+        ticket = admission.valuation.acquire(valuation_cost(websocket.query_params))
+    except admission.Overloaded as ex:
+        await websocket.close(code=1013, reason=str(ex))
+        return
+
+    try:
+        if not stream:
+            stock_price, extra_info, ewma_his_vol, contracts = await executors.io.run(
+                ticket.timed(option.options_chain_quotes_valuation), symbol, min_next_days, max_next_days, min_volume,
+                min_price, last_trade_days, ewma_his_vol_period, ewma_his_vol_lambda, only_otm, specific_contract,
+                proxy, stock_src, calc_kelly_iv, iteration, ticket.mode == admission.DEGRADED)
+            output = quotes_valuation_response(symbol)
+            if contracts is not None and len(contracts) > 0:
+                output = quotes_valuation_response(symbol, stock_price, extra_info, ewma_his_vol, contracts)
+            await websocket.send_text(serialization.dumps(output).decode())
+            await websocket.close()
+            return
+
+        # stream: a frame per valued expiry, progress frames while waiting, a summary at the end
+        start_time = time.perf_counter()
+        items = executors.io.iterate(ticket.iterate(option.iter_options_chain_quotes_valuation(
+            symbol, min_next_days, max_next_days, min_volume, min_price, last_trade_days, ewma_his_vol_period,
+            ewma_his_vol_lambda, only_otm, specific_contract, proxy, stock_src, calc_kelly_iv, iteration,
+            ticket.mode == admission.DEGRADED)))
+        summary = {"symbol": symbol, "expiryCount": 0, "contractCount": 0}
+        next_expiry = None
+        try:
+            while True:
+                next_expiry = asyncio.ensure_future(anext(items, None))
+                while True:
+                    try:
+                        item = await asyncio.wait_for(asyncio.shield(next_expiry), WS_PROGRESS_INTERVAL)
+                        break
+                    except asyncio.TimeoutError:
+                        await websocket.send_json(WsProgressMessage(
+                            expiryCount=summary["expiryCount"],
+                            elapsedSeconds=time.perf_counter() - start_time).model_dump())
+                next_expiry = None
+                if item is None:
+                    break
+
+                stock_price, extra_info, ewma_his_vol, expiry_calls_puts = item
+                summary.update({"stockPrice": stock_price, "stockExtraInfo": extra_info,
+                                "EWMA_historicalVolatility": ewma_his_vol})
+                summary["expiryCount"] += 1
+                summary["contractCount"] += \
+                    option.contract_count(expiry_calls_puts["calls"]) + option.contract_count(expiry_calls_puts["puts"])
+                await websocket.send_text(serialization.dumps({"type": "expiry",
+                                                               "data": contracts_to_response([expiry_calls_puts])[0]})
+                                          .decode())
+
+        except WebSocketDisconnect:
+            logging.info('{symbol} websocket disconnected'.format(symbol=symbol))
+            return
+
+        except Exception:
+            logging.error(traceback.format_exc())
+
+        finally:
+            if next_expiry is not None:
+                next_expiry.cancel()
+                await asyncio.gather(next_expiry, return_exceptions=True)
+            await items.aclose()
+
+        await websocket.send_json(WsSummaryMessage(elapsedSeconds=time.perf_counter() - start_time,
+                                                   **summary).model_dump())
+        await websocket.close()
+
+    finally:
+        ticket.release()
 
 
 @router.get("/get-option-pcr", tags=["put-call-ratio"], response_model=OptionsPutCallRatioResponse)
@@ -204,5 +589,5 @@ async def get_option_pcr(request: Request, response: Response, symbol: str,
     if not symbol:
         raise HTTPException(status_code=400, detail="Invalid request parameter")
 
-    output = option.get_option_pcr(symbol, range_days)
+    output = await executors.io.run(option.get_option_pcr, symbol, range_days)
     return output
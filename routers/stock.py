@@ -1,10 +1,13 @@
+import os
 import sys
 from typing import List, Optional, Dict, Union
 from fastapi import APIRouter, HTTPException, Request, Response, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from rate_limiter import limiter
-from models import stock
+from models import stock, formula
+from utils import executors, serialization, http_cache
 
 
 class StockHistoryData(BaseModel):
@@ -50,32 +53,81 @@ router = APIRouter(
     tags=["stock"]
 )
 
+# path limits of /stock/price-simulation-by-mc: format=json encodes the whole matrix as lists, format=npy streams it
+# a day at a time and format=summary keeps only a day of paths
+MC_JSON_MAX_DAYS = int(os.environ.get("MC_JSON_MAX_DAYS", "252"))
+MC_JSON_MAX_ITERATION = int(os.environ.get("MC_JSON_MAX_ITERATION", "100"))
+MC_MAX_DAYS = int(os.environ.get("MC_MAX_DAYS", "1260"))
+MC_MAX_ITERATION = int(os.environ.get("MC_MAX_ITERATION", "100000"))
 
-@router.get("/history", tags=["stock"], response_model=StockHistoryResponse)
+
+@router.get("/history", tags=["stock"], response_model=StockHistoryResponse,
+            response_class=serialization.NumpyJSONResponse)
 @limiter.app_limiter.limit("100/minute")
 async def stock_history(request: Request, response: Response, symbol: str, period: Optional[str] = "1y",
-                        proxy: Optional[str] = None, stock_src: Optional[str] = "yahoo"):
-    if not symbol:
+                        proxy: Optional[str] = None, stock_src: Optional[str] = "yahoo",
+                        layout: Optional[str] = "records"):
+    # layout: records, a StockHistoryData per bar; columnar, a list per StockHistoryData field;
+    # the ETag follows the last bar, a matching If-None-Match is answered with 304 before any fetch within
+    # STOCK_HISTORY_VALIDATOR_TTL seconds of the last one, and before formatting and encoding after it
+    if not symbol or layout not in serialization.LAYOUTS:
         raise HTTPException(status_code=400, detail="Invalid request parameter")
 
-    output, extra_info = stock.get_stock_history(symbol, period, proxy, stock_src)
-    output['Date'] = output.index
-    output['Date'] = output['Date'].apply(lambda x: x.strftime('%Y-%m-%d'))
-    return {"symbol": symbol, "data": output.to_dict(orient='records')}
+    validators = stock.recent_stock_history_version(symbol, period, stock_src)
+    if validators is not None:
+        not_modified = history_not_modified(request, symbol, period, stock_src, layout, *validators)
+        if not_modified is not None:
+            return not_modified
+
+    output, extra_info = await stock.get_stock_history_async(symbol, period, proxy, stock_src)
+    if output is None or len(output) == 0:
+        raise HTTPException(status_code=400, detail="stock history not found.")
+
+    validators = stock.stock_history_version(symbol, period, stock_src, output)
+    not_modified = history_not_modified(request, symbol, period, stock_src, layout, *validators)
+    if not_modified is not None:
+        return not_modified
+
+    # the history frame may be shared with concurrent requests, only read it
+    columns = {column: output[column].to_numpy() for column in output.columns}
+    columns["Date"] = output.index.strftime('%Y-%m-%d').to_numpy()
+    return serialization.NumpyJSONResponse({"symbol": symbol,
+                                            "data": serialization.LAYOUTS[layout](StockHistoryData, columns)},
+                                           headers=history_headers(symbol, period, stock_src, layout, *validators))
+
+
+def history_headers(symbol, period, stock_src, layout, version, last_bar):
+    return {"ETag": http_cache.etag(symbol, period, stock_src, layout, version),
+            "Last-Modified": http_cache.http_date(last_bar)}
+
+
+def history_not_modified(request, symbol, period, stock_src, layout, version, last_bar):
+    # a 304 response if the client has this version already, else None
+    headers = history_headers(symbol, period, stock_src, layout, version, last_bar)
+    if http_cache.if_none_match(request.headers, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return None
 
 
 @router.get("/price-simulation-by-mc", tags=["stock"], response_model=StockPriceSimulationByMCResponse)
 @limiter.app_limiter.limit("100/minute")
 async def price_simulation_by_mc(request: Request, response: Response, symbol: str,
-                                 days: Optional[int] = Query(30, ge=1, le=252),
+                                 days: Optional[int] = Query(30, ge=1, le=MC_MAX_DAYS),
                                  ewma_his_vol_period: Optional[int] = 21,
                                  ewma_his_vol_lambda: Optional[float] = 0.94,
-                                 iteration: Optional[int] = Query(10, ge=1, le=100),
+                                 iteration: Optional[int] = Query(10, ge=1, le=MC_MAX_ITERATION),
                                  mu: Optional[float] = None,
                                  vol: Optional[float] = None,
-                                 proxy: Optional[str] = None, stock_src: Optional[str] = "yahoo"):
-    if not symbol:
+                                 proxy: Optional[str] = None, stock_src: Optional[str] = "yahoo",
+                                 format: Optional[str] = "json"):
+    # format: json, the path matrix and the mean as lists; npy, the float32 path matrix streamed as a .npy file;
+    # summary, {"percentiles": [5, 25, 50, 75, 95], "bands": a list of days per percentile, "mean": a list of days}
+    if not symbol or format not in ["json", "npy", "summary"]:
         raise HTTPException(status_code=400, detail="Invalid request parameter")
+    if format == "json" and (days > MC_JSON_MAX_DAYS or iteration > MC_JSON_MAX_ITERATION):
+        raise HTTPException(status_code=422, detail="format=json allows days <= {days} and iteration <= {iteration}, "
+                                                    "use format=npy or format=summary".format(
+                                                        days=MC_JSON_MAX_DAYS, iteration=MC_JSON_MAX_ITERATION))
 
     mu_vol_type = stock.PriceSimulationType.MANUAL_ALL
     if mu is None and vol is None:
@@ -85,9 +137,25 @@ async def price_simulation_by_mc(request: Request, response: Response, symbol: s
     elif vol is None:
         mu_vol_type = stock.PriceSimulationType.AUTO_GEN_VOL
 
-    o = stock.price_simulation_all_by_mc(symbol, days, ewma_his_vol_lambda, ewma_his_vol_period, iteration,
-                                         mu_vol_type, mu, vol, proxy=proxy, stock_src=stock_src)
-
+    params = await executors.io.run(stock.price_simulation_params, symbol, ewma_his_vol_lambda, ewma_his_vol_period,
+                                    mu_vol_type, mu, vol, proxy=proxy, stock_src=stock_src)
+    if params is None:
+        raise HTTPException(status_code=400, detail="stock history not found.")
+    s0, mu, vol = params
+
+    if format == "npy":
+        return StreamingResponse(executors.io.iterate(stock.iter_price_simulation_npy(s0, mu, vol, days, iteration)),
+                                 media_type="application/octet-stream",
+                                 headers={"Content-Disposition": 'attachment; filename="{symbol}.npy"'.format(
+                                     symbol=symbol)})
+
+    # the monte carlo is CPU bound, on the process pool instead of holding io threads the fetches need
+    if format == "summary":
+        bands, mean = await executors.cpu.run(stock.price_simulation_summary, s0, mu, vol, days, iteration)
+        return serialization.NumpyJSONResponse({"percentiles": stock.PRICE_SIMULATION_PERCENTILES, "bands": bands,
+                                                "mean": mean})
+
+    o = await executors.cpu.run(formula.Stock.price_simulation_by_mc, s0, mu, vol, days, iteration=iteration)
     return {'data': o.tolist(), 'mean': o.mean(axis=0).tolist()}
 
 
@@ -97,7 +165,7 @@ async def stock_benford_law(request: Request, response: Response, symbol: str):
     if not symbol:
         raise HTTPException(status_code=400, detail="Invalid request parameter")
 
-    output = stock.calc_stock_benford_probs(symbol)
+    output = await executors.io.run(stock.calc_stock_benford_probs, symbol)
     if output is None:
         raise HTTPException(status_code=400, detail="calc_stock_benford_probs failed or data not found.")
 
@@ -0,0 +1,67 @@
+import sys
+import time
+import pathlib
+
+import numpy as np
+from bs4 import BeautifulSoup
+from lxml import etree
+
+from routers import option as option_router
+from utils import scraping, serialization
+
+
+# opt-in benchmarks, they print the timings instead of asserting them on a shared CI machine:
+# python -m test.benchmark [name ...]
+FIXTURES = pathlib.Path(__file__).parent / "fixtures"
+
+
+def seconds(fn, *args, duration=0.5):
+    # per call
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        fn(*args)
+        n += 1
+    return (time.perf_counter() - start) / n
+
+
+def double_parse(content):
+    # the previous approach: BeautifulSoup, serialize, re-parse with lxml
+    return etree.HTML(str(BeautifulSoup(content, "html.parser")))
+
+
+def bench_scraping():
+    for name, fn in [("dividend_com_list.html", scraping.dividend_com_rows),
+                     ("macrotrends_employees.html", scraping.macrotrends_table_rows)]:
+        content = (FIXTURES / name).read_text(encoding="utf-8")
+        old, new = seconds(double_parse, content), seconds(fn, content)
+        print(f"{name}: double parse {1 / old:.0f} pages/s, single parse {1 / new:.0f} pages/s")
+
+
+def bench_serialization():
+    # 10 expiries x 2 sides x 100 strikes, pydantic models against columns + orjson
+    from test.utils.test_serialization import chain, contracts_to_records
+    contracts = chain(10, 100)
+    extra_info = {"earningsDate": "", "exDividendDate": ""}
+
+    def validated():
+        return option_router.OptionsChainQuotesValuationResponse(
+            symbol="X", stockPrice=np.float64(100.5), stockExtraInfo=extra_info,
+            EWMA_historicalVolatility=np.float64(0.25),
+            contracts=contracts_to_records(contracts)).model_dump_json().encode()
+
+    def encoded(layout):
+        return serialization.NumpyJSONResponse(option_router.quotes_valuation_response(
+            "X", np.float64(100.5), extra_info, np.float64(0.25), contracts, layout)).body
+
+    print("2000 contracts: pydantic {a:.1f} ms".format(a=seconds(validated) * 1000))
+    for layout in serialization.LAYOUTS:
+        print("2000 contracts: {layout} {size} bytes {ms:.1f} ms".format(
+            layout=layout, size=len(encoded(layout)), ms=seconds(encoded, layout) * 1000))
+
+
+BENCHMARKS = {"scraping": bench_scraping, "serialization": bench_serialization}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name]()
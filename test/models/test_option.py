@@ -0,0 +1,316 @@
+import copy
+import threading
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+from pytest import approx
+
+from models import option
+from utils import executors
+
+
+def chain():
+    today = datetime.now().date()
+    contracts = []
+    # two and four weeks, the same business days whatever the weekday
+    for days in (14, 28):
+        expiry = {"expiryDate": (today + timedelta(days=days)).isoformat()}
+        for side in option.CHAIN_SIDES:
+            strike = np.arange(95.0, 105.0, 2.5)
+            expiry[side] = {"strike": strike, "lastPrice": np.linspace(6.0, 0.5, len(strike)),
+                            "impliedVolatility": np.linspace(0.2, 0.4, len(strike))}
+        contracts.append(expiry)
+    close = pd.Series(100 * np.exp(np.cumsum(np.random.default_rng(1).normal(0, 0.01, 252))))
+    # the strikes around the money
+    return contracts, close * 100 / close.iloc[-1]
+
+
+def value_prices(contracts, close, volatility):
+    tasks = [(contract, option.submit_expiry_valuation(contract, close.iloc[-1], volatility))
+             for contract in contracts]
+    for contract, expiry_tasks in tasks:
+        option.merge_chunks(contract, expiry_tasks)
+
+
+def value_chain(contracts, close, volatility):
+    value_prices(contracts, close, volatility)
+    now = datetime.now().date()
+    expiry_days = [np.busday_count(now, date.fromisoformat(contract["expiryDate"])) + 1 for contract in contracts]
+    calc_kelly_types = list(option.CalcKellyType)
+    simulations = option.simulate_expiry_prices(close, volatility, expiry_days, calc_kelly_types, 2000)
+    try:
+        tasks = [option.submit_expiry_kelly(contract, calc_kelly_types, simulations, i, len(contracts), close.iloc[-1],
+                                            expiry_days[i]) for i, contract in enumerate(contracts)]
+        for contract, expiry_tasks in zip(contracts, tasks):
+            option.merge_chunks(contract, expiry_tasks)
+    finally:
+        simulations.release()
+
+
+# the first expiry's calls valued with np.random.seed(0), MC and the kelly criterions drawn in the caller
+EXPECTED_CALLS = {
+    "BSM_EWMAHisVol": [5.7602116093807325, 3.959336321781315, 2.532568286577522, 1.4981308659369503],
+    "MC_EWMAHisVol": [5.7681360698468875, 3.9586156638176755, 2.5301247342931044, 1.4979949803639498],
+    "BT_EWMAHisVol": [5.759885466954177, 3.9598127415041997, 2.531943513696669, 1.4983373727765688],
+    "delta": [0.805183388048055, 0.6721498391064543, 0.5167206887810254, 0.36240676409392925],
+    "gamma": [0.04396276848199396, 0.05762703997517935, 0.06359325592400566, 0.059824941833929376],
+    "vega": [0.05757029205975398, 0.07546398091987772, 0.08327688275762644, 0.07834218573490752],
+    "theta": [-0.2091956935026774, -0.2689365383218144, -0.2936388557479373, -0.2744931051752876],
+    "rho": [0.03263251583927271, 0.0276115922014883, 0.02144978200423711, 0.015165396864206973],
+    "exerciseProbability": [0.8871, 0.66462, 0.48762, 0.36614],
+    "KellyCriterion_buy": [-0.6715547215775779, -0.7739168995661844, -0.6077391306931553, -0.003778140180682732],
+    "KellyCriterion_sell": [0.4177037546072927, 0.4816556707361467, 0.48981538918966727, 0.010736715602066793],
+    "KellyCriterion_MU_0_buy": [-0.24974357854725687, -0.33343542921480096, -0.26492776627447967,
+                                0.11420062196662417],
+    "KellyCriterion_MU_0_sell": [0.2107778390689249, 0.28115240643078426, 0.28540760382688823, -0.4173767323814208],
+    "KellyCriterion_IV_buy": [-0.5684538460102209, -0.46984275589960295, -0.12426604496642252, 0.24486164464717283],
+    "KellyCriterion_IV_sell": [0.35161228315782633, 0.3507869344275343, 0.1656292540265037, -1.5899015739080435],
+}
+
+
+def test_parse_batch_specs():
+    assert option.parse_batch_specs("T, WFC,,T,T_call_2024-06-21_20") == [("T", None), ("WFC", None),
+                                                                          ("T", "call_2024-06-21_20")]
+
+
+def test_chain_valuation(monkeypatch):
+    monkeypatch.setattr(option, "VALUATION_CHUNK_SIZE", 3)
+    # none of the values may come from the pricing cache
+    monkeypatch.setattr(option, "PRICING_CACHE_SIZE", 0)
+    monkeypatch.setattr(executors, "cpu", executors.BoundedExecutor("cpu", 0, 0, None))
+    contracts, close = chain()
+    np.random.seed(0)
+    value_chain(contracts, close, 0.3)
+
+    valuation_data = contracts[0]["calls"]["valuationData"]
+    assert list(valuation_data) == list(EXPECTED_CALLS)
+    for key, value in EXPECTED_CALLS.items():
+        assert valuation_data[key].tolist() == approx(value, rel=1e-9)
+    # priced with the exact inputs, the pricing cache only rounds its keys
+    time_2_maturity_year = option.time_to_maturity(datetime.now().date(), contracts[0]["expiryDate"])
+    assert valuation_data["BSM_EWMAHisVol"].tolist() == \
+        [option.formula.Option.bs(False, 1, close.iloc[-1], k, time_2_maturity_year, 0.0152, 0.3, 0)
+         for k in contracts[0]["calls"]["strike"].tolist()]
+    # an american put has no BSM or MC valuation
+    assert contracts[1]["puts"]["valuationData"]["BSM_EWMAHisVol"].tolist() == [-1.0] * 4
+
+
+def test_chain_valuation_process_pool(monkeypatch):
+    monkeypatch.setattr(option, "VALUATION_CHUNK_SIZE", 3)
+    monkeypatch.setattr(option, "PRICING_CACHE_SIZE", 0)
+    monkeypatch.setattr(executors, "cpu", executors.BoundedExecutor("cpu", 2, 2, executors.new_process_pool))
+    contracts, close = chain()
+    value_chain(contracts, close, 0.3)
+    executors.cpu.shutdown()
+
+    valuation_data = contracts[0]["calls"]["valuationData"]
+    for key in ["BSM_EWMAHisVol", "BT_EWMAHisVol", "delta", "gamma", "vega", "theta", "rho"]:
+        assert valuation_data[key].tolist() == approx(EXPECTED_CALLS[key])
+    assert valuation_data["MC_EWMAHisVol"].tolist() == approx(EXPECTED_CALLS["MC_EWMAHisVol"], abs=0.5)
+    for contract in contracts:
+        for side in option.CHAIN_SIDES:
+            for key in ["KellyCriterion_buy", "KellyCriterion_MU_0_sell", "KellyCriterion_IV_buy",
+                        "exerciseProbability"]:
+                assert len(contract[side]["valuationData"][key]) == len(contract[side]["strike"])
+
+
+def patch_fetch(monkeypatch):
+    today = datetime.now().date()
+    expiry_dates = [(today + timedelta(days=days)).isoformat() for days in (10, 24, 60)]
+
+    def frame(strike):
+        return pd.DataFrame({"contractSymbol": ["X%d" % k for k in strike], "lastTradeDate": pd.Timestamp.now(),
+                             "strike": strike, "lastPrice": 1.0, "bid": 1.0, "ask": 1.0, "change": 0.0,
+                             "percentChange": 0.0, "volume": 100, "openInterest": 100, "impliedVolatility": 0.3})
+
+    def get_option_chain_by_expiry(symbol, expiry_date):
+        # the second expiry has no contract left after the filters
+        return frame([95.0, 100.0, 105.0]), frame([]) if expiry_date == expiry_dates[1] else frame([100.0])
+
+    _, close = chain()
+    monkeypatch.setattr(option, "get_option_date", lambda symbol: expiry_dates)
+    monkeypatch.setattr(option, "get_option_chain_by_expiry", get_option_chain_by_expiry)
+    monkeypatch.setattr(option.stock, "get_stock_history",
+                        lambda *args: (pd.DataFrame({"Close": close}), {"earningsDate": "", "exDividendDate": ""}))
+    monkeypatch.setattr(option.formula.Option, "bt", lambda *args: 1.0)
+    monkeypatch.setattr(executors, "cpu", executors.BoundedExecutor("cpu", 0, 0, None))
+    return expiry_dates, close
+
+
+def test_iter_options_chain_quotes_valuation(monkeypatch):
+    expiry_dates, close = patch_fetch(monkeypatch)
+
+    output = list(option.iter_options_chain_quotes_valuation("X", 0, 40, 10, 0, 3, 21, 0.94, False, None, None,
+                                                             iteration=1000))
+    # the last expiry is out of max_next_days
+    assert [item[3]["expiryDate"] for item in output] == expiry_dates[:2]
+    stock_price, extra_info, ewma_his_vol, contract = output[0]
+    assert stock_price == close.iloc[-1]
+    assert list(contract["calls"]["valuationData"]) == ["BSM_EWMAHisVol", "MC_EWMAHisVol", "BT_EWMAHisVol", "delta",
+                                                        "gamma", "vega", "theta", "rho", "exerciseProbability",
+                                                        "KellyCriterion_buy", "KellyCriterion_sell",
+                                                        "KellyCriterion_MU_0_buy", "KellyCriterion_MU_0_sell"]
+    assert option.contract_count(output[1][3]["puts"]) == 0
+
+    # a consumer may stop early
+    iterator = option.iter_options_chain_quotes_valuation("X", 0, 90, 10, 0, 3, 21, 0.94, False, None, None,
+                                                          iteration=1000)
+    assert next(iterator)[3]["expiryDate"] == expiry_dates[0]
+    iterator.close()
+
+
+def test_deadline(monkeypatch):
+    monkeypatch.setattr(option, "VALUATION_CHUNK_SIZE", 3)
+    assert option.Deadline(60).mode() == option.Deadline.FULL
+    assert option.Deadline(0).mode() == option.Deadline.SKIP
+
+    # a chunk still running at the deadline is left NaN
+    contracts, close = chain()
+    running = option.Future()
+    tasks = option.submit_expiry_valuation(contracts[0], close.iloc[-1], 0.3, bsm_only=True) + \
+        [("calls", 0, 3, ["MC_EWMAHisVol"], running)]
+    assert option.merge_chunks(contracts[0], tasks, option.Deadline(0)) == {"MC_EWMAHisVol"}
+    assert running.cancelled()
+    assert np.isnan(contracts[0]["calls"]["valuationData"]["MC_EWMAHisVol"]).all()
+    assert not np.isnan(contracts[0]["calls"]["valuationData"]["BSM_EWMAHisVol"]).any()
+
+    # too little time left once the chain arrives, BSM only
+    expiry_dates, close = patch_fetch(monkeypatch)
+    monkeypatch.setattr(option, "DEADLINE_SHRINK_FRACTION", 2)
+    monkeypatch.setattr(option, "DEADLINE_SKIP_FRACTION", 2)
+    output = list(option.iter_options_chain_quotes_valuation("X", 0, 40, 10, 0, 3, 21, 0.94, False, None, None,
+                                                             iteration=1000, deadline=option.Deadline(60)))
+    contract = output[0][3]
+    assert contract["degraded"] == ["MC_EWMAHisVol", "BT_EWMAHisVol", "KellyCriterion_buy", "KellyCriterion_sell",
+                                    "KellyCriterion_MU_0_buy", "KellyCriterion_MU_0_sell", "exerciseProbability"]
+    assert list(contract["calls"]["valuationData"]) == option.BSM_FIELDS + contract["degraded"]
+    assert np.isnan(contract["calls"]["valuationData"]["MC_EWMAHisVol"]).all()
+
+    # shrunk, every field valued with fewer iterations
+    monkeypatch.setattr(option, "DEADLINE_SKIP_FRACTION", 0)
+    output = list(option.iter_options_chain_quotes_valuation("X", 0, 40, 10, 0, 3, 21, 0.94, False, None, None,
+                                                             iteration=1000, deadline=option.Deadline(60)))
+    contract = output[0][3]
+    assert set(contract["calls"]["valuationData"]) == set(option.PRICING_FIELDS + contract["degraded"])
+    assert not np.isnan(contract["calls"]["valuationData"]["MC_EWMAHisVol"]).any()
+
+
+def test_deadline_truncated(monkeypatch):
+    expiry_dates, close = patch_fetch(monkeypatch)
+    get_option_chain_by_expiry = option.get_option_chain_by_expiry
+    release = threading.Event()
+    fetched = []
+
+    def slow_get_option_chain_by_expiry(symbol, expiry_date):
+        if expiry_date != expiry_dates[0]:
+            release.wait(10)
+        fetched.append(expiry_date)
+        return get_option_chain_by_expiry(symbol, expiry_date)
+
+    monkeypatch.setattr(option, "get_option_chain_by_expiry", slow_get_option_chain_by_expiry)
+    # the expiries fetched by the deadline are answered without waiting for the rest
+    deadline = option.Deadline(0.5)
+    output = list(option.iter_options_chain_quotes_valuation("X", 0, 90, 10, 0, 3, 21, 0.94, False, None, None,
+                                                             iteration=1000, deadline=deadline))
+    assert fetched == expiry_dates[:1]
+    release.set()
+    assert [item[3]["expiryDate"] for item in output] == expiry_dates[:1]
+    assert deadline.truncated
+
+    # nothing fetched in time
+    deadline = option.Deadline(0)
+    assert list(option.iter_options_chain_quotes_valuation("X", 0, 90, 10, 0, 3, 21, 0.94, False, None, None,
+                                                           deadline=deadline)) == []
+    assert deadline.truncated
+
+
+def test_parse_valuation_fields():
+    assert option.parse_valuation_fields() is None
+    assert option.parse_valuation_fields(fields="delta, BSM_EWMAHisVol") == ["BSM_EWMAHisVol", "delta"]
+    assert option.parse_valuation_fields("MC,KellyCriterion", "rho") == \
+        ["rho", "MC_EWMAHisVol", "KellyCriterion_buy", "KellyCriterion_sell", "exerciseProbability"]
+    for methods, fields in [("NOPE", None), (None, "nope"), ("", "")]:
+        with pytest.raises(ValueError):
+            option.parse_valuation_fields(methods, fields)
+
+    assert option.pricing_engines(["BSM_EWMAHisVol", "KellyCriterion_IV_buy", "exerciseProbability"]) == \
+        ["BSM", "KellyCriterion_IV"]
+    assert option.pricing_engines(["exerciseProbability"]) == ["KellyCriterion"]
+
+
+def test_valuation_fields(monkeypatch):
+    expiry_dates, close = patch_fetch(monkeypatch)
+
+    def not_requested(*args, **kwargs):
+        raise AssertionError("engine not requested")
+
+    # only the BSM formulas asked for, nothing on the pool, no simulation
+    for name in ["mc", "bt", "gamma", "vega", "theta", "rho"]:
+        monkeypatch.setattr(option.formula.Option, name, not_requested)
+    monkeypatch.setattr(option.formula.Stock, "price_simulation_by_mc", not_requested)
+    output = list(option.iter_options_chain_quotes_valuation("X", 0, 40, 10, 0, 3, 21, 0.94, False, None, None,
+                                                             fields=["BSM_EWMAHisVol", "delta"]))
+    for _, _, _, contract in output:
+        assert "degraded" not in contract
+        for side in option.CHAIN_SIDES:
+            if option.contract_count(contract[side]) > 0:
+                assert list(contract[side]["valuationData"]) == ["BSM_EWMAHisVol", "delta"]
+
+    # a kelly field runs its engine only
+    monkeypatch.undo()
+    patch_fetch(monkeypatch)
+    monkeypatch.setattr(option.formula.Option, "mc", not_requested)
+    contract = next(option.iter_options_chain_quotes_valuation("X", 0, 40, 10, 0, 3, 21, 0.94, False, None, None,
+                                                               iteration=1000,
+                                                               fields=["BT_EWMAHisVol", "KellyCriterion_MU_0_buy"]))[3]
+    assert list(contract["calls"]["valuationData"]) == ["BT_EWMAHisVol", "exerciseProbability",
+                                                        "KellyCriterion_MU_0_buy", "KellyCriterion_MU_0_sell"]
+
+
+def test_pricing_cache(monkeypatch):
+    monkeypatch.setattr(option, "VALUATION_CHUNK_SIZE", 3)
+    monkeypatch.setattr(option, "PRICING_CACHE_SIZE", 16)
+    monkeypatch.setattr(option, "_pricing_cache", option.collections.OrderedDict())
+    monkeypatch.setattr(option, "_pricing_cache_counters", {"hits": 0, "misses": 0})
+    monkeypatch.setattr(executors, "cpu", executors.BoundedExecutor("cpu", 0, 0, None))
+    submitted = []
+    value_strikes = option.value_strikes
+
+    def counted(kind, strike, *args):
+        submitted.extend(strike.tolist())
+        return value_strikes(kind, strike, *args)
+
+    monkeypatch.setattr(option, "value_strikes", counted)
+    expected, close = chain()
+    contracts = copy.deepcopy(expected)
+    value_prices(expected, close, 0.3)
+    assert len(submitted) == 16 and len(option._pricing_cache) == 16
+
+    # the later expiry's 97.5 call is valued again, inside a chunk of cached contracts
+    del option._pricing_cache[max(key for key in option._pricing_cache if key[0] == 1 and key[2] == 97.5)]
+    submitted.clear()
+    tasks = [option.submit_expiry_valuation(contract, close.iloc[-1], 0.3) for contract in contracts]
+    for contract, expiry_tasks in zip(contracts, tasks):
+        option.merge_chunks(contract, expiry_tasks)
+    assert submitted == [97.5]
+    for a, b in zip(expected, contracts):
+        for side in option.CHAIN_SIDES:
+            for key, value in a[side]["valuationData"].items():
+                assert b[side]["valuationData"][key].dtype == np.float64
+                if key == "MC_EWMAHisVol" and a is expected[1] and side == "calls":
+                    value = np.delete(value, 1)
+                    b[side]["valuationData"][key] = np.delete(b[side]["valuationData"][key], 1)
+                np.testing.assert_array_equal(value, b[side]["valuationData"][key])
+    assert {key: option.pricing_cache_metrics()[key] for key in ["hits", "misses", "entries"]} == \
+        {"hits": 15, "misses": 17, "entries": 16}
+
+    # bounded, the least recently valued are dropped
+    monkeypatch.setattr(option, "PRICING_CACHE_SIZE", 12)
+    option._pricing_cache.clear()
+    value_prices(copy.deepcopy(expected), close, 0.3)
+    assert len(option._pricing_cache) == 12
+    # the first expiry's calls
+    assert len({key[3] for key in option._pricing_cache if key[0] == 1}) == 1
+    assert len({key[3] for key in option._pricing_cache if key[0] == -1}) == 2
@@ -1,7 +1,13 @@
+import asyncio
+import io
+
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
+import pytest
 
-from models import stock
+from models import stock, formula
+from utils import executors
 
 
 def test_get_stock():
@@ -60,6 +66,35 @@ def test_get_all_dividend_list():
         assert output['data'][0]['symbol'] is not None
 
 
+def test_get_dividend_list_incremental(monkeypatch):
+    def row(symbol, ex_date):
+        return {"symbol": symbol, "link": "https://www.dividend.com/" + symbol, "ex_dividend_date": ex_date}
+
+    pages = {1: [row("A", "2026-01-02"), row("B", "2026-01-03")],
+             2: [row("C", "2026-01-04"), row("D", "2026-01-05")],
+             3: [row("E", "2026-01-06")]}
+    requested = []
+
+    def send_post(url, headers, req_data):
+        page = int(req_data)
+        requested.append(page)
+        return 0, page
+
+    monkeypatch.setattr(stock.web, "send_post", send_post)
+    monkeypatch.setattr(stock, "parse_dividend_list_page", lambda page: pages.get(page, []))
+    monkeypatch.setattr(stock, "dividend_com_budget", stock.crawler.RateBudget(0))
+
+    output = stock.get_dividend_list({}, str)
+    assert [r["symbol"] for r in output["data"]] == ["A", "B", "C", "D", "E"]
+
+    # A moved its ex-date, page 2 is unchanged so the crawl stops there and E comes from the previous run
+    previous = {"data": [row("A", "2025-10-01"), row("B", "2026-01-03"), row("C", "2026-01-04"),
+                         row("D", "2026-01-05"), row("E", "2026-01-06")]}
+    output = stock.get_dividend_list({}, str, previous)
+    assert [(r["symbol"], r["ex_dividend_date"]) for r in output["data"]] == \
+           [("A", "2026-01-02"), ("B", "2026-01-03"), ("C", "2026-01-04"), ("D", "2026-01-05"), ("E", "2026-01-06")]
+
+
 def test_get_dividend_history_by_dividend_com():
     output = stock.get_dividend_history_by_dividend_com("https://www.dividend.com/stocks/consumer-discretionary/retail-discretionary/automotive-retailers/aap-advance-auto-parts/")
     assert output is not None
@@ -88,6 +123,86 @@ def test_get_stock_history_marketwatch():
         assert len(output) > 0
 
 
+def test_get_stock_history_marketwatch_async():
+    output, extra_info = asyncio.run(stock.get_stock_history_async("T", "1y", proxy=None, stock_src="marketwatch"))
+    print(f"Output: {output}")
+    if output is not None:
+        assert len(output) > 0
+
+
+def test_get_stock_history_async_bounded(monkeypatch):
+    # yahoo history runs on the bounded io executor, a full one is rejected instead of queued
+    monkeypatch.setattr(stock, "get_stock_history", lambda *args: (pd.DataFrame({"Close": [1.0]}), {}))
+    monkeypatch.setattr(stock.executors, "io", stock.executors.BoundedExecutor("io", 1, 0,
+                                                                                stock.executors.new_thread_pool))
+    output, extra_info = asyncio.run(stock.get_stock_history_async("T", "1y"))
+    assert output["Close"].tolist() == [1.0]
+
+    release = stock.executors.threading.Event()
+    stock.executors.io.submit(release.wait)
+    try:
+        with pytest.raises(stock.executors.ExecutorBusy):
+            asyncio.run(stock.get_stock_history_async("T", "1y"))
+    finally:
+        release.set()
+        stock.executors.io.shutdown()
+
+
+def test_parse_marketwatch_csv():
+    content = 'Date,Open,High,Low,Close,Volume\n' \
+              '01/03/2024,"1,001.5",1010,990,"1,005.25","2,134,567"\n' \
+              '01/02/2024,990,1000,980,995,"1,234"\n'
+    output = stock.parse_marketwatch_csv(content)
+    assert list(output.columns) == ["Open", "High", "Low", "Close", "Volume"]
+    assert output.index.is_monotonic_increasing
+    assert output.index[0].strftime('%Y-%m-%d') == "2024-01-02"
+    assert output["Close"].iloc[-1] == 1005.25
+    assert output["Volume"].iloc[-1] == 2134567.0
+    assert all(dtype == np.float64 for dtype in output.dtypes)
+
+    # a bad cell doesn't drop the history
+    output = stock.parse_marketwatch_csv(content + '01/01/2024,-,N/A,980,"1,001",0\n')
+    assert len(output) == 3
+    assert np.isnan(output["Open"].iloc[0]) and np.isnan(output["High"].iloc[0])
+    assert output["Open"].iloc[-1] == 1001.5 and output["Close"].iloc[0] == 1001.0
+
+
+def test_price_simulation_npy_and_summary(monkeypatch):
+    # the days are simulated in the caller, with its random state
+    monkeypatch.setattr(executors, "cpu", executors.BoundedExecutor("cpu", 0, 0, None))
+    np.random.seed(1)
+    expected = formula.Stock.price_simulation_by_mc(100.0, 0.1, 0.3, 20, iteration=50)
+
+    np.random.seed(1)
+    # a small chunk size splits the header and the days over several chunks
+    chunks = list(stock.iter_price_simulation_npy(100.0, 0.1, 0.3, 20, 50, chunk_size=300))
+    assert len(chunks) > 1
+    output = np.load(io.BytesIO(b"".join(chunks)))
+    assert output.shape == (50, 21) and output.dtype == np.float32
+    np.testing.assert_array_equal(output, expected.astype(np.float32))
+
+    np.random.seed(1)
+    bands, mean = stock.price_simulation_summary(100.0, 0.1, 0.3, 20, 50)
+    np.testing.assert_allclose(bands, np.percentile(expected, stock.PRICE_SIMULATION_PERCENTILES, axis=0))
+    np.testing.assert_allclose(mean, expected.mean(axis=0))
+
+
+def test_stock_history_version(monkeypatch):
+    index = pd.date_range("2024-01-02", periods=3, freq="B", tz="America/New_York")
+    history = pd.DataFrame({"Open": 1.0, "High": 2.0, "Low": 0.5, "Close": [1.0, 1.5, 1.2], "Volume": 100},
+                           index=index)
+    version, last_bar = stock.stock_history_version("TEST", "1y", "yahoo", history)
+    assert last_bar == index[-1]
+    assert stock.recent_stock_history_version("TEST", "1y", "yahoo") == (version, last_bar)
+
+    # today's bar moves until the close
+    history.loc[index[-1], "Close"] = 1.3
+    assert stock.stock_history_version("TEST", "1y", "yahoo", history)[0] != version
+
+    monkeypatch.setattr(stock, "STOCK_HISTORY_VALIDATOR_TTL", 0)
+    assert stock.recent_stock_history_version("TEST", "1y", "yahoo") is None
+
+
 def test_price_simulation_mean_by_mc():
     output = stock.price_simulation_mean_by_mc("T", 252, 0.92, 21, 100000, stock_src="yahoo")
     assert output is not None
@@ -118,6 +233,25 @@ def test_get_dividend_history_by_yahoo():
     print(output)
 
 
+def test_get_dividend_history_by_yahoo_records(monkeypatch):
+    index = pd.DatetimeIndex(["2024-01-02 00:00", "2024-01-03 00:00", "2024-01-04 00:00", "2024-01-04 15:30"],
+                             tz="America/New_York")
+    bars = pd.DataFrame({"Open": 1.0, "Close": [10.0, 11.0, 12.0, 12.5], "Volume": [100, 200, 300, 400],
+                         "Dividends": [0.0, 0.25, 0.0, 0.0], "Stock Splits": 0.0}, index=index)
+
+    class Ticker:
+        dividends = bars["Dividends"][bars["Dividends"] > 0]
+
+        def history(self, **kwargs):
+            return bars
+
+    monkeypatch.setattr(stock, "get_stock", lambda symbol: Ticker())
+    output = stock.get_dividend_history_by_yahoo("T")
+    assert output == {"data": [{"date": "2024-01-02", "Close": 10.0, "Volume": 100},
+                               {"date": "2024-01-03", "Close": 11.0, "Volume": 200, "Dividends": 0.25},
+                               {"date": "2024-01-04", "Close": 12.5, "Volume": 400}]}
+
+
 def test_calc_reports_benford_probs():
     ticker = stock.get_stock("T")
     income_stmt = ticker.income_stmt
@@ -0,0 +1,42 @@
+import time
+import threading
+
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+
+from rate_limiter import storage
+
+
+def test_sqlite_storage(tmp_path):
+    uri = "sqlite://" + str(tmp_path / "rate-limit.db")
+    store = storage_from_string(uri)
+    assert isinstance(store, storage.SQLiteStorage) and store.check()
+    assert store.incr("a", 1, 3) == 3
+    assert store.incr("a", 1, 2) == 5
+    assert store.get("a") == 5 and store.get("b") == 0
+    assert store.get_expiry("a") > time.time()
+    time.sleep(1.1)
+    assert store.get("a") == 0 and store.incr("a", 1) == 1
+    store.clear("a")
+    assert store.get("a") == 0
+
+
+def test_sqlite_storage_shared(tmp_path):
+    # two workers on the same file spend one budget
+    uri = "sqlite://" + str(tmp_path / "rate-limit.db")
+    workers = [FixedWindowRateLimiter(storage_from_string(uri)) for _ in range(2)]
+    limit = parse("100/minute")
+    granted = []
+
+    def hit(limiter):
+        for _ in range(30):
+            granted.append(limiter.hit(limit, "client", cost=5))
+
+    threads = [threading.Thread(target=hit, args=(limiter,)) for limiter in workers for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert granted.count(True) == 20
+    assert workers[0].storage.reset() == 1
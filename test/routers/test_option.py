@@ -1,14 +1,85 @@
+import json
 import time
 import threading
 import asyncio
 
+import pytest
 from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
 
 from main import app
+from routers import option
 
 client = TestClient(app)
 
 
+def test_valuation_cost():
+    assert option.valuation_cost({}) == 1
+    assert option.valuation_cost({"iteration": "1000000"}) == 6
+    assert option.valuation_cost({"iteration": "1000000", "max_next_days": "120", "calc_kelly_iv": "true"}) == 66
+    assert option.valuation_cost({"iteration": "1000000", "specific_contract": "call_2024-06-21_20"}) == 1
+    assert option.valuation_cost({"iteration": "100000000"}) == option.VALUATION_MAX_COST
+    assert option.valuation_cost({"iteration": "x", "max_next_days": "0"}) == 1
+    # BSM alone is cheap, calc_kelly_iv only counts without a selection
+    assert option.valuation_cost({"iteration": "1000000", "methods": "BSM"}) == 1
+    assert option.valuation_cost({"iteration": "1000000", "fields": "delta", "calc_kelly_iv": "true"}) == 1
+    assert option.valuation_cost({"iteration": "1000000", "methods": "MC", "calc_kelly_iv": "true"}) == 6
+    assert option.valuation_cost({"iteration": "1000000", "fields": "KellyCriterion_IV_buy"}) == 22
+
+
+def test_failed_fetch_not_cached(monkeypatch):
+    # an upstream failure answers 200 with no contracts, shared caches must not keep it
+    monkeypatch.setattr(option.option, "get_option_chain", lambda *args: [])
+    monkeypatch.setattr(option.option, "options_chain_quotes_valuation", lambda *args: (None, None, None, []))
+    for url in ["/option/quote?symbol=FAILED", "/option/quote-valuation?symbol=FAILED"]:
+        response = client.get(url)
+        assert response.status_code == 200 and response.json()["contracts"] == []
+        assert response.headers["Cache-Control"] == "no-store"
+
+
+def test_degraded_not_cached(monkeypatch):
+    contracts = [{"expiryDate": "2024-06-21", "calls": {}, "puts": {}, "degraded": ["MC_EWMAHisVol"]}]
+    monkeypatch.setattr(option.option, "options_chain_quotes_valuation", lambda *args: (1.0, None, 0.2, contracts))
+    response = client.get("/option/quote-valuation?symbol=DEGRADED")
+    assert response.status_code == 200
+    assert response.headers["X-Valuation-Degraded"] == "MC_EWMAHisVol"
+    assert response.headers["Cache-Control"] == "no-store"
+
+    def truncated(*args):
+        # the deadline passed before the later expiries were fetched
+        args[15].truncated = True
+        return 1.0, None, 0.2, [{"expiryDate": "2024-06-21", "calls": {}, "puts": {}}]
+
+    monkeypatch.setattr(option.option, "options_chain_quotes_valuation", truncated)
+    for _ in range(2):
+        response = client.get("/option/quote-valuation?symbol=TRUNCATED&deadline_ms=1000")
+        assert response.headers["X-Valuation-Truncated"] == "true" and response.headers["X-Cache"] == "MISS"
+        assert response.headers["Cache-Control"] == "no-store"
+    monkeypatch.setattr(option.option, "iter_options_chain_quotes_valuation", lambda *args: iter(()))
+    response = client.get("/option/quote-valuation?symbol=TRUNCATED&deadline_ms=1000&format=ndjson")
+    assert response.headers["Cache-Control"] == "no-store"
+
+    class Ticket:
+        mode = option.admission.DEGRADED
+
+    assert option.degraded_headers(Ticket(), ["BSM_EWMAHisVol"]) == {}
+    assert option.degraded_headers(Ticket(), ["MC_EWMAHisVol"]) == \
+        {"X-Valuation-Degraded": "MC_EWMAHisVol", "Cache-Control": "no-store"}
+
+
+def test_ndjson_failure_reported(monkeypatch):
+    def failing(*args):
+        yield 1.0, None, 0.2, {"expiryDate": "2024-06-21", "calls": {}, "puts": {}}
+        raise RuntimeError("chain fetch failed")
+
+    monkeypatch.setattr(option.option, "iter_options_chain_quotes_valuation", failing)
+    response = client.get("/option/quote-valuation?symbol=FAILING&format=ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line.get("expiryDate") for line in lines[1:-1]] == ["2024-06-21"]
+    # a stream cut short says so, a complete one has no error line
+    assert lines[-1] == {"error": "chain fetch failed"}
+
+
 def test_options_chain_quotes():
     response = client.get("/option/quote?symbol=INTC")
     assert response.status_code == 200
@@ -26,6 +97,82 @@ def test_options_chain_quotes_valuation():
     assert len(output["contracts"][0]['calls']) > 0 or len(output["contracts"][0]['puts']) > 0
 
 
+def test_options_chain_quotes_valuation_columnar():
+    response = client.get("/option/quote-valuation?symbol=WFC&layout=columnar")
+    assert response.status_code == 200
+    output = response.json()
+    calls = output["contracts"][0]["calls"]
+    print(calls)
+    assert len(calls["strike"]) == len(calls["lastPrice"]) == len(calls["valuationData"]["BSM_EWMAHisVol"])
+
+
+def test_options_chain_quotes_valuation_ndjson():
+    response = client.get("/option/quote-valuation?symbol=WFC&format=ndjson")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    print(lines[0])
+    assert lines[0]["symbol"] == "WFC" and lines[0]["stockPrice"] > 0
+    assert len(lines) > 1 and all("expiryDate" in line for line in lines[1:])
+
+
+def test_options_chain_quotes_valuation_fields():
+    response = client.get("/option/quote-valuation?symbol=WFC&methods=BSM&fields=MC_EWMAHisVol")
+    assert response.status_code == 200
+    output = response.json()
+    print(output["contracts"][0]["calls"][0])
+    assert list(output["contracts"][0]["calls"][0]["valuationData"]) == ["BSM_EWMAHisVol", "MC_EWMAHisVol", "delta",
+                                                                          "gamma", "vega", "theta", "rho"]
+    assert client.get("/option/quote-valuation?symbol=WFC&methods=nope").status_code == 400
+
+
+def test_options_chain_quotes_valuation_deadline():
+    response = client.get("/option/quote-valuation?symbol=WFC&deadline_ms=1")
+    assert response.status_code == 200
+    output = response.json()
+    print(response.headers.get("X-Valuation-Degraded"), response.headers.get("X-Valuation-Truncated"))
+    # answered with what was valued by then, never kept by a shared cache
+    assert response.headers["Cache-Control"] == "no-store"
+    assert all("MC_EWMAHisVol" in contract["degraded"] for contract in output["contracts"])
+    assert client.get("/option/quote-valuation?symbol=WFC&deadline_ms=0").status_code == 400
+
+
+def test_options_chain_quotes_valuation_batch():
+    response = client.get("/option/quote-valuation-batch?symbols=T,WFC,NOT-A-SYMBOL&iteration=10000")
+    assert response.status_code == 200
+    output = {line["symbol"]: line for line in map(json.loads, response.text.splitlines())}
+    print(output)
+    assert sorted(output) == ["NOT-A-SYMBOL", "T", "WFC"]
+    assert len(output["T"]["contracts"]) > 0 and output["T"]["error"] is None
+    assert len(output["NOT-A-SYMBOL"]["contracts"]) == 0
+
+
+def test_ws_admission(monkeypatch):
+    bsm_only = []
+
+    def valuation(*args):
+        bsm_only.append(args[14])
+        return None, None, None, []
+
+    monkeypatch.setattr(option.option, "options_chain_quotes_valuation", valuation)
+    for max_in_flight, closed in [(2, None), (1, 1013)]:
+        controller = option.admission.AdmissionController("valuation", 1, max_in_flight, 2, 10, 0.2)
+        monkeypatch.setattr(option.admission, "valuation", controller)
+        held = controller.acquire(1)
+        with client.websocket_connect("/ws/option/quote-valuation?symbol=BUSY") as websocket:
+            if closed is None:
+                # valued BSM-only while another valuation is in flight
+                assert websocket.receive_json()["contracts"] == []
+            else:
+                with pytest.raises(WebSocketDisconnect) as ex:
+                    websocket.receive_json()
+                assert ex.value.code == closed
+        held.release()
+        # the websocket's ticket is released too
+        assert controller.metrics()["inFlight"] == 0
+    assert bsm_only == [True]
+
+
 def test_ws_options_chain_quotes_valuation():
     with client.websocket_connect("/ws/option/quote-valuation?symbol=T&with_heartbeat=false") as websocket:
         output = websocket.receive_json()
@@ -34,6 +181,21 @@ def test_ws_options_chain_quotes_valuation():
         print(output)
 
 
+def test_ws_options_chain_quotes_valuation_stream():
+    with client.websocket_connect("/ws/option/quote-valuation?symbol=T&stream=true") as websocket:
+        expiry_count = 0
+        while True:
+            output = websocket.receive_json()
+            assert output["type"] in ["progress", "expiry", "summary"]
+            if output["type"] == "expiry":
+                expiry_count += 1
+                assert len(output["data"]["calls"]) > 0 or len(output["data"]["puts"]) > 0
+            if output["type"] == "summary":
+                break
+        assert output["expiryCount"] == expiry_count
+        print(output)
+
+
 def test_get_option_pcr():
     response = client.get("/option/get-option-pcr?symbol=INTC&range_days=365")
     assert response.status_code == 200
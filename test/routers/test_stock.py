@@ -1,3 +1,6 @@
+import io
+
+import numpy as np
 from fastapi.testclient import TestClient
 
 from main import app
@@ -11,12 +14,40 @@ def test_stock_history():
     print(response.json())
 
 
+def test_stock_history_not_modified():
+    response = client.get("/stock/history?symbol=T&layout=columnar")
+    assert response.status_code == 200
+    assert len(response.json()["data"]["Date"]) == len(response.json()["data"]["Close"]) > 0
+    etag = response.headers["ETag"]
+    assert response.headers["Last-Modified"]
+
+    response = client.get("/stock/history?symbol=T&layout=columnar", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
 def test_price_simulation_by_mc():
     response = client.get("/stock/price-simulation-by-mc?symbol=T")
     assert response.status_code == 200
     print(response.json())
 
 
+def test_price_simulation_by_mc_npy_and_summary():
+    response = client.get("/stock/price-simulation-by-mc?symbol=T&days=504&iteration=10000&format=npy")
+    assert response.status_code == 200
+    output = np.load(io.BytesIO(response.content))
+    assert output.shape == (10000, 505) and output.dtype == np.float32
+
+    response = client.get("/stock/price-simulation-by-mc?symbol=T&days=504&iteration=10000&format=summary")
+    assert response.status_code == 200
+    output = response.json()
+    assert output["percentiles"] == [5, 25, 50, 75, 95]
+    assert len(output["bands"]) == 5 and len(output["bands"][0]) == len(output["mean"]) == 505
+
+    # the path matrix as json stays limited
+    assert client.get("/stock/price-simulation-by-mc?symbol=T&days=504").status_code == 422
+
+
 def test_stock_benford_law():
     response = client.get("/stock/benford-law?symbol=T")
     assert response.status_code == 200
@@ -1,6 +1,7 @@
 from fastapi.testclient import TestClient
 
 from main import app
+from utils import executors
 
 client = TestClient(app)
 
@@ -15,3 +16,10 @@ def test_ws_hello_norn():
     with client.websocket_connect("/ws") as websocket:
         data = websocket.receive_json()
         assert data == {"msg": "Hello Norn"}
+
+
+def test_shutdown_drains_executors():
+    with TestClient(app) as shutdown_client:
+        assert shutdown_client.get("/").status_code == 200
+        executors.io.submit(sum, [1, 2]).result()
+    assert executors.io._executor is None
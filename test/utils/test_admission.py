@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+from utils import admission, executors
+
+
+def controller():
+    return admission.AdmissionController("test", degrade_in_flight=4, max_in_flight=6, degrade_queue_wait=0.05,
+                                         max_queue_wait=1, alpha=1)
+
+
+def test_admission_in_flight():
+    valuation = controller()
+    # idle, admitted in full whatever it costs
+    big = valuation.acquire(10)
+    assert big.mode == admission.FULL
+    big.release()
+    big.release()
+    assert valuation.metrics()["inFlight"] == 0
+
+    full = valuation.acquire(4)
+    degraded = [valuation.acquire(1) for _ in range(2)]
+    assert full.mode == admission.FULL and all(ticket.mode == admission.DEGRADED for ticket in degraded)
+    with pytest.raises(admission.Overloaded):
+        valuation.acquire(1)
+    with pytest.raises(executors.ExecutorBusy):
+        valuation.acquire(1, degrade=False)
+
+    metrics = valuation.metrics()
+    assert {key: metrics[key] for key in ["admitted", "degraded", "shed", "inFlight", "queueDepth"]} == \
+        {"admitted": 2, "degraded": 2, "shed": 2, "inFlight": 6, "queueDepth": 3}
+    for ticket in [full] + degraded:
+        ticket.release()
+    with valuation.admit(4) as ticket:
+        assert ticket.mode == admission.FULL
+    assert valuation.metrics()["inFlight"] == 0
+
+
+def test_admission_queue_wait():
+    valuation = controller()
+    first = valuation.acquire(1)
+    time.sleep(0.1)
+    assert list(first.iterate(iter([1, 2]))) == [1, 2]
+    assert valuation.metrics()["queueDepth"] == 0 and valuation.metrics()["queueWaitSeconds"] >= 0.1
+
+    # in flight work waits longer than degrade_queue_wait
+    second = valuation.acquire(1)
+    assert second.mode == admission.DEGRADED
+    assert second.timed(lambda x: x + 1)(1) == 2
+    first.release()
+    second.release()
+    # idle, the last wait doesn't count
+    assert valuation.acquire(1).mode == admission.FULL
@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import time
+
+from utils import crawler
+
+
+def test_rate_budget():
+    budget = crawler.RateBudget(50)
+    start = time.monotonic()
+    for _ in range(6):
+        budget.wait()
+    # the first slot is free, the next 5 are 20 ms apart
+    assert time.monotonic() - start >= 0.09
+
+
+def test_crawl_pages_in_order_and_stop_at_empty():
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, max
+    fetched = []
+
+    def fetch(page):
+        with lock:
+            fetched.append(page)
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        # later pages finish first
+        time.sleep(0.05 / page)
+        with lock:
+            in_flight[0] -= 1
+        return [] if page >= 6 else [page]
+
+    consumed = []
+
+    def consume(page, rows):
+        if len(rows) == 0:
+            return False
+        consumed.append(page)
+        return True
+
+    crawler.crawl_pages(fetch, consume, 100, concurrency=3)
+    assert consumed == [1, 2, 3, 4, 5]
+    assert in_flight[1] <= 3
+    # no more than a window of pages past the first empty one
+    assert max(fetched) < 6 + 3
+
+
+def test_crawl_pages_budget():
+    start = time.monotonic()
+    crawler.crawl_pages(lambda page: page, lambda page, result: True, 6, concurrency=5,
+                        budget=crawler.RateBudget(50))
+    assert time.monotonic() - start >= 0.07
+
+
+def test_crawl_pages_async():
+    async def fetch(page):
+        await asyncio.sleep(0.05 / page)
+        return [] if page >= 4 else [page]
+
+    consumed = []
+
+    def consume(page, rows):
+        if len(rows) == 0:
+            return False
+        consumed.append(page)
+        return True
+
+    asyncio.run(crawler.crawl_pages_async(fetch, consume, 100, concurrency=3, budget=crawler.RateBudget(100)))
+    assert consumed == [1, 2, 3]
@@ -0,0 +1,155 @@
+import asyncio
+import operator
+import threading
+
+import numpy as np
+import pytest
+
+from utils import executors
+
+
+def test_bounded_executor_rejects_when_full():
+    executor = executors.BoundedExecutor("test", 1, 1, executors.new_thread_pool)
+    release = threading.Event()
+    running = [executor.submit(release.wait), executor.submit(release.wait)]
+    with pytest.raises(executors.ExecutorBusy):
+        executor.submit(release.wait)
+    assert executor.pending() == 2
+
+    release.set()
+    for future in running:
+        future.result()
+    assert executor.pending() == 0
+    assert executor.submit(operator.add, 1, 2).result() == 3
+    executor.shutdown()
+
+
+def test_bounded_executor_inline():
+    executor = executors.BoundedExecutor("test", 0, 0, None)
+    assert executor.submit(operator.add, 1, 2).result() == 3
+    with pytest.raises(ZeroDivisionError):
+        executor.submit(operator.truediv, 1, 0).result()
+
+
+def test_bounded_executor_run():
+    executor = executors.BoundedExecutor("test", 2, 0, executors.new_thread_pool)
+
+    async def main():
+        return await asyncio.gather(executor.run(operator.add, 1, 2), executor.run(operator.mul, 2, 3))
+
+    assert asyncio.run(main()) == [3, 6]
+    executor.shutdown()
+
+
+def test_process_pool():
+    executor = executors.BoundedExecutor("test", 2, 2, executors.new_process_pool)
+    futures = [executor.submit(pow, 2, i) for i in range(4)]
+    assert [future.result() for future in futures] == [1, 2, 4, 8]
+    executor.shutdown()
+
+
+def test_bounded_executor_submit_wait():
+    executor = executors.BoundedExecutor("test", 1, 0, executors.new_thread_pool)
+    release = threading.Event()
+    first = executor.submit(release.wait)
+    threading.Timer(0.05, release.set).start()
+    # waits for the first task instead of raising ExecutorBusy
+    assert executor.submit_wait(operator.add, 1, 2).result() == 3
+    assert first.result() is True
+    executor.shutdown()
+
+
+def test_bounded_executor_submit_within():
+    executor = executors.BoundedExecutor("test", 1, 0, executors.new_thread_pool)
+    release = threading.Event()
+    first = executor.submit(release.wait)
+    with pytest.raises(executors.ExecutorBusy):
+        executor.submit_within(0.05, operator.add, 1, 2)
+    threading.Timer(0.05, release.set).start()
+    assert executor.submit_within(5, operator.add, 1, 2).result() == 3
+    assert first.result() is True
+    executor.shutdown()
+
+
+def test_bounded_executor_iterate():
+    executor = executors.BoundedExecutor("test", 1, 0, executors.new_thread_pool)
+    closed = threading.Event()
+
+    def numbers():
+        try:
+            yield from range(10)
+        finally:
+            closed.set()
+
+    async def main():
+        output = []
+        async for number in executor.iterate(numbers()):
+            if number == 3:
+                break
+            output.append(number)
+        return output
+
+    assert asyncio.run(main()) == [0, 1, 2]
+    # the consumer left early, the generator is closed on the executor
+    assert closed.wait(1)
+    executor.shutdown()
+
+
+def test_bounded_executor_iterate_waits():
+    executor = executors.BoundedExecutor("test", 1, 0, executors.new_thread_pool)
+    release = threading.Event()
+
+    async def main():
+        output = []
+        async for number in executor.iterate(iter(range(3))):
+            if number == 0:
+                # the pool fills up while the stream is running
+                blocked = executor.submit(release.wait)
+                asyncio.get_running_loop().call_later(0.05, release.set)
+            output.append(number)
+        return output, blocked
+
+    # a started stream waits for the slot instead of failing with ExecutorBusy
+    output, blocked = asyncio.run(main())
+    assert output == [0, 1, 2] and blocked.result() is True
+
+    async def rejected():
+        release.clear()
+        blocked = executor.submit(release.wait)
+        with pytest.raises(executors.ExecutorBusy):
+            async for _ in executor.iterate(iter(range(3))):
+                pass
+        release.set()
+        return blocked.result()
+
+    # the first next() is the admission
+    assert asyncio.run(rejected()) is True
+
+    async def admitted():
+        release.clear()
+        blocked = executor.submit(release.wait)
+        asyncio.get_running_loop().call_later(0.05, release.set)
+        return [number async for number in executor.iterate(iter(range(3)), admitted=True)], blocked.result()
+
+    assert asyncio.run(admitted()) == ([0, 1, 2], True)
+    executor.shutdown()
+
+
+def sum_rows(shared, row):
+    try:
+        return float(shared.array[row].sum())
+    finally:
+        shared.close()
+
+
+def test_shared_array_process_pool():
+    executor = executors.BoundedExecutor("test", 2, 2, executors.new_process_pool)
+    shared = executors.SharedArray((3, 1000))
+    shared.array[...] = np.arange(3)[:, None]
+    try:
+        assert [executor.submit(sum_rows, shared, row).result() for row in range(3)] == [0.0, 1000.0, 2000.0]
+        # in the creating process close() keeps the block
+        assert sum_rows(shared, 2) == 2000.0
+    finally:
+        shared.release()
+        executor.shutdown()
@@ -0,0 +1,93 @@
+from datetime import datetime, timezone
+
+import pandas as pd
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from utils import http_cache
+
+
+def test_etag():
+    assert http_cache.etag("T", "1y") == http_cache.etag("T", "1y")
+    assert http_cache.etag("T", "1y") != http_cache.etag("T", "6mo")
+    assert http_cache.etag("T").startswith('W/"')
+
+
+def test_http_date():
+    assert http_cache.http_date(datetime(2024, 1, 2, 3, 4, 5)) == "Tue, 02 Jan 2024 03:04:05 GMT"
+    assert http_cache.http_date(pd.Timestamp("2024-01-02", tz="America/New_York")) == "Tue, 02 Jan 2024 05:00:00 GMT"
+    assert http_cache.http_date(datetime(2024, 1, 2, tzinfo=timezone.utc)) == "Tue, 02 Jan 2024 00:00:00 GMT"
+
+
+def test_if_none_match():
+    current = http_cache.etag("T")
+    assert http_cache.if_none_match({"if-none-match": current}, current)
+    # weak comparison, a list and *
+    assert http_cache.if_none_match({"if-none-match": '"other", ' + current[2:]}, current)
+    assert http_cache.if_none_match({"if-none-match": "*"}, current)
+    assert not http_cache.if_none_match({"if-none-match": '"other"'}, current)
+    assert not http_cache.if_none_match({}, current)
+
+
+def test_cache_control():
+    new_york = http_cache.MARKET_TIMEZONE
+    # monday 10:00, open
+    assert http_cache.cache_control("/option/quote", datetime(2024, 1, 8, 10, tzinfo=new_york)) == \
+        "public, max-age=60, stale-while-revalidate=30"
+    # monday 09:00, half an hour to the open
+    assert http_cache.seconds_to_market_open(datetime(2024, 1, 8, 9, tzinfo=new_york)) == 1800
+    assert "max-age=1800," in http_cache.cache_control("/option/quote", datetime(2024, 1, 8, 9, tzinfo=new_york))
+    # friday after the close until monday's open, capped
+    assert http_cache.seconds_to_market_open(datetime(2024, 1, 12, 17, tzinfo=new_york)) == (2 * 24 + 16.5) * 3600
+    assert "max-age=21600," in http_cache.cache_control("/stock/history",
+                                                        datetime(2024, 1, 12, 17, tzinfo=new_york))
+    # reports don't follow the session
+    assert "max-age=21600," in http_cache.cache_control("/stock/benford-law",
+                                                        datetime(2024, 1, 8, 10, tzinfo=new_york))
+
+
+def test_cache_control_middleware():
+    app = FastAPI()
+    app.add_middleware(http_cache.CacheControlMiddleware)
+
+    @app.get("/stock/echo")
+    async def echo(a: str, b: str):
+        return {"a": a, "b": b}
+
+    @app.get("/stock/stream")
+    async def stream():
+        return StreamingResponse(iter([b"1", b"2"]))
+
+    @app.get("/other")
+    async def other():
+        return {}
+
+    client = TestClient(app)
+    response = client.get("/stock/echo?a=1&b=2")
+    assert response.status_code == 200 and "max-age=" in response.headers["Cache-Control"]
+    etag = response.headers["ETag"]
+
+    # the same query in another order
+    response = client.get("/stock/echo?b=2&a=1", headers={"If-None-Match": etag})
+    assert response.status_code == 304 and response.content == b"" and response.headers["ETag"] == etag
+    assert client.get("/stock/echo?a=1&b=3", headers={"If-None-Match": etag}).status_code == 200
+
+    response = client.get("/stock/stream")
+    assert response.content == b"12" and "ETag" not in response.headers and "Cache-Control" in response.headers
+    assert "Cache-Control" not in client.get("/other").headers
+    assert "Cache-Control" not in client.get("/stock/echo").headers  # 422
+
+
+def test_data_version():
+    new_york = http_cache.MARKET_TIMEZONE
+    # the same within a CACHE_OPEN_MAX_AGE window of the session
+    assert http_cache.data_version(datetime(2024, 1, 8, 10, 0, 1, tzinfo=new_york)) == \
+        http_cache.data_version(datetime(2024, 1, 8, 10, 0, 59, tzinfo=new_york))
+    assert http_cache.data_version(datetime(2024, 1, 8, 10, 0, 59, tzinfo=new_york)) != \
+        http_cache.data_version(datetime(2024, 1, 8, 10, 1, 0, tzinfo=new_york))
+    # from friday's close until monday's open
+    assert http_cache.data_version(datetime(2024, 1, 5, 17, tzinfo=new_york)) == \
+        http_cache.data_version(datetime(2024, 1, 8, 9, tzinfo=new_york))
+    assert http_cache.data_version(datetime(2024, 1, 5, 17, tzinfo=new_york)) != \
+        http_cache.data_version(datetime(2024, 1, 4, 17, tzinfo=new_york))
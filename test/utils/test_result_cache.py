@@ -0,0 +1,54 @@
+import os
+
+from utils import result_cache
+
+
+def test_disk_lru_cache(tmp_path):
+    cache = result_cache.DiskLRUCache(str(tmp_path), max_bytes=300, max_entry_bytes=200, low_water=1)
+    assert cache.get(("T", 1)) is None
+    assert cache.put(("T", 1), b"a" * 100)
+    assert cache.get(("T", 1)) == b"a" * 100
+    # over the per entry budget
+    assert not cache.put(("T", 2), b"b" * 201)
+    assert cache.get(("T", 2)) is None
+
+    # another worker process on the same directory
+    other = result_cache.DiskLRUCache(str(tmp_path), max_bytes=300, max_entry_bytes=200)
+    assert other.get(("T", 1)) == b"a" * 100
+
+    assert cache.put(("T", 3), b"c" * 100)
+    assert cache.put(("T", 4), b"d" * 100)
+    # ("T", 3) is the least recently used
+    os.utime(cache._path(("T", 3)), (1, 1))
+    assert cache.put(("T", 5), b"e" * 100)
+    assert cache.get(("T", 3)) is None
+    assert cache.get(("T", 1)) == b"a" * 100
+
+    metrics = cache.metrics()
+    assert {key: metrics[key] for key in ["hits", "misses", "stores", "rejects", "evictions", "entries", "bytes"]} == \
+        {"hits": 2, "misses": 3, "stores": 4, "rejects": 1, "evictions": 1, "entries": 3, "bytes": 300}
+    assert metrics["hitBytes"] == 200 and metrics["storedBytes"] == 400
+
+
+def test_disk_lru_cache_high_water(tmp_path, monkeypatch):
+    cache = result_cache.DiskLRUCache(str(tmp_path), max_bytes=300, max_entry_bytes=200)
+    scans = []
+    entries = cache._entries
+    monkeypatch.setattr(cache, "_entries", lambda: scans.append(1) or entries())
+    for i in range(3):
+        assert cache.put(("T", i), b"a" * 100)
+    # only the first store scans the directory, the rest are counted
+    assert len(scans) == 1
+    assert cache.put(("T", 3), b"a" * 100)
+    # past max_bytes it is trimmed to the low water mark, the next store is under it
+    assert len(scans) == 2 and cache.metrics()["bytes"] == 200
+    assert cache.put(("T", 4), b"a" * 100)
+    assert len(scans) == 3
+
+
+def test_disk_lru_cache_disabled(tmp_path):
+    cache = result_cache.DiskLRUCache(str(tmp_path / "cache"), max_bytes=0, max_entry_bytes=200)
+    assert not cache.put(("T", 1), b"a")
+    assert cache.get(("T", 1)) is None
+    assert not os.path.exists(tmp_path / "cache")
+    assert cache.metrics()["entries"] == 0
@@ -0,0 +1,48 @@
+import pathlib
+
+from models import stock
+from utils import scraping
+
+
+FIXTURES = pathlib.Path(__file__).parent.parent / "fixtures"
+
+
+def _fixture(name):
+    return (FIXTURES / name).read_text(encoding="utf-8")
+
+
+def test_parse_html_empty():
+    assert scraping.parse_html("") is None
+    assert scraping.parse_html(None) is None
+    assert scraping.dividend_com_rows("") == []
+    assert scraping.macrotrends_table_rows("") is None
+
+
+def test_parse_html_xml_declaration():
+    dom = scraping.parse_html('<?xml version="1.0" encoding="utf-8"?><html><body><p>a</p></body></html>')
+    assert dom.xpath('//p')[0].text == "a"
+
+
+def test_dividend_com_rows():
+    rows = scraping.dividend_com_rows(_fixture("dividend_com_list.html"))
+    assert len(rows) == 50
+    assert rows[0] == ("/stocks/financials/banks/emu-alpha-corp/", "EMU", "02/27", "2025")
+    assert rows[17][2:] == ("-", "-")
+
+
+def test_parse_dividend_list_page():
+    output = stock.parse_dividend_list_page(_fixture("dividend_com_list.html"))
+    assert len(output) == 50
+    assert output[0] == {"symbol": "EMU", "link": "https://www.dividend.com/stocks/financials/banks/emu-alpha-corp/",
+                         "ex_dividend_date": "2025-02-27"}
+    assert output[17]["ex_dividend_date"] == "-"
+    assert all(o["symbol"] != "" for o in output)
+
+
+def test_macrotrends_table_rows():
+    rows = scraping.macrotrends_table_rows(_fixture("macrotrends_employees.html"))
+    # header row has no td, only the first historical data table is used
+    assert rows[0] == []
+    assert rows[1] == ["2024", "164,000"]
+    assert len(rows) == 17
+    assert scraping.macrotrends_table_rows("<html><body><table></table></body></html>") is None
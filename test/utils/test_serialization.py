@@ -0,0 +1,136 @@
+import json
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from models import option
+from routers import option as option_router
+from utils import serialization
+
+
+class Greeks(BaseModel):
+    delta: float
+    gamma: Optional[float] = None
+
+
+class Contract(BaseModel):
+    lastTradeDate: str
+    volume: int
+    strike: float
+    greeks: Optional[Greeks] = None
+
+
+def test_dumps_numpy():
+    content = {"a": np.float64(1.5), "b": np.longdouble(0.25), "c": np.int64(3), "d": np.array([1.0, np.nan]),
+               "e": float("inf")}
+    assert json.loads(serialization.dumps(content)) == {"a": 1.5, "b": 0.25, "c": 3, "d": [1.0, None], "e": None}
+    assert serialization.dumps_line([1]) == b"[1]\n"
+
+
+def test_columns_to_model_records():
+    columns = {"contractSymbol": np.array(["X1", "X2"], dtype=object),
+               "lastTradeDate": np.array(["2024-01-02", "2024-01-03"], dtype=object),
+               "volume": np.array([10.0, 20.0]), "strike": np.array([100, 105]),
+               "greeks": {"delta": np.array([0.5, 0.25], dtype=np.longdouble)}}
+    # only the model's fields, cast to the field types, a missing optional column is None
+    assert serialization.columns_to_model_records(Contract, columns) == [
+        {"lastTradeDate": "2024-01-02", "volume": 10, "strike": 100.0, "greeks": {"delta": 0.5, "gamma": None}},
+        {"lastTradeDate": "2024-01-03", "volume": 20, "strike": 105.0, "greeks": {"delta": 0.25, "gamma": None}}]
+    del columns["greeks"]
+    assert serialization.columns_to_model_records(Contract, columns)[0]["greeks"] is None
+    assert serialization.columns_to_model_records(Contract, {}) == []
+
+
+def test_columns_to_model_columns():
+    columns = {"contractSymbol": np.array(["X1", "X2"], dtype=object),
+               "lastTradeDate": np.array(["2024-01-02", "2024-01-03"], dtype=object),
+               "volume": np.array([10.0, 20.0]), "strike": np.array([100, 105]),
+               "greeks": {"delta": np.array([0.5, np.nan])}}
+    output = serialization.columns_to_model_columns(Contract, columns)
+    assert list(output) == ["lastTradeDate", "volume", "strike", "greeks"]
+    assert output["volume"].dtype == np.int64 and output["strike"].dtype == np.float64
+    assert json.loads(serialization.dumps(output)) == {"lastTradeDate": ["2024-01-02", "2024-01-03"],
+                                                       "volume": [10, 20], "strike": [100.0, 105.0],
+                                                       "greeks": {"delta": [0.5, None], "gamma": None}}
+    assert serialization.columns_to_model_columns(Contract, {}) == {"lastTradeDate": [], "volume": [], "strike": [],
+                                                                    "greeks": None}
+
+
+def chain(expiry_count, strike_count):
+    rng = np.random.default_rng(0)
+    today = datetime.now().date()
+    contracts = []
+    for i in range(expiry_count):
+        contract = {"expiryDate": (today + timedelta(days=7 * i + 3)).isoformat()}
+        for side in option.CHAIN_SIDES:
+            columns = {"contractSymbol": np.array(["X%d" % k for k in range(strike_count)], dtype=object),
+                       "lastTradeDate": np.array([today.isoformat()] * strike_count, dtype=object),
+                       "strike": np.arange(strike_count) * 2.5 + 50}
+            for key in ["lastPrice", "bid", "ask", "change", "percentChange", "impliedVolatility"]:
+                columns[key] = rng.uniform(0, 20, strike_count)
+            for key in ["volume", "openInterest"]:
+                columns[key] = rng.integers(0, 1000, strike_count).astype(np.float64)
+            columns["valuationData"] = {key: rng.normal(0, 1, strike_count) for key in [
+                "BSM_EWMAHisVol", "MC_EWMAHisVol", "BT_EWMAHisVol", "delta", "gamma", "vega", "theta", "rho",
+                "exerciseProbability", "KellyCriterion_buy", "KellyCriterion_sell", "KellyCriterion_MU_0_buy",
+                "KellyCriterion_MU_0_sell"]}
+            columns["valuationData"]["delta"][0] = np.nan
+            contract[side] = columns
+        contracts.append(contract)
+    return contracts
+
+
+def columns_to_records(columns):
+    # the validated response model's input, the records the encoder writes straight from the columns
+    keys = [key for key in columns if key != "valuationData"]
+    records = [dict(zip(keys, row)) for row in zip(*[columns[key].tolist() for key in keys])]
+    if "valuationData" in columns:
+        valuation_keys = list(columns["valuationData"])
+        valuation_rows = zip(*[columns["valuationData"][key].tolist() for key in valuation_keys])
+        for record, row in zip(records, valuation_rows):
+            record["valuationData"] = dict(zip(valuation_keys, row))
+
+    return records
+
+
+def contracts_to_records(contracts):
+    return [{"expiryDate": contract["expiryDate"], "calls": columns_to_records(contract["calls"]),
+             "puts": columns_to_records(contract["puts"])} for contract in contracts]
+
+
+def test_quotes_valuation_response_matches_model():
+    # 10 expiries x 2 sides x 100 strikes
+    contracts = chain(10, 100)
+    extra_info = {"earningsDate": "", "exDividendDate": ""}
+
+    def validated():
+        return option_router.OptionsChainQuotesValuationResponse(
+            symbol="X", stockPrice=np.float64(100.5), stockExtraInfo=extra_info,
+            EWMA_historicalVolatility=np.float64(0.25),
+            contracts=contracts_to_records(contracts)).model_dump_json().encode()
+
+    def encoded():
+        return serialization.NumpyJSONResponse(option_router.quotes_valuation_response(
+            "X", np.float64(100.5), extra_info, np.float64(0.25), contracts)).body
+
+    assert encoded() == validated()
+
+    def columnar():
+        return serialization.NumpyJSONResponse(option_router.quotes_valuation_response(
+            "X", np.float64(100.5), extra_info, np.float64(0.25), contracts, "columnar")).body
+
+    assert len(columnar()) < len(encoded())
+
+
+def test_quotes_valuation_response_fields():
+    contracts = chain(2, 3)
+    output = json.loads(serialization.dumps(option_router.quotes_valuation_response(
+        "X", contracts=contracts, fields=["BSM_EWMAHisVol", "delta"])))
+    valuation_data = output["contracts"][0]["calls"][0]["valuationData"]
+    assert valuation_data == {"BSM_EWMAHisVol": contracts[0]["calls"]["valuationData"]["BSM_EWMAHisVol"][0],
+                              "delta": None}
+    columnar = option_router.quotes_valuation_response("X", contracts=contracts, layout="columnar",
+                                                       fields=["rho", "exerciseProbability"])
+    assert list(columnar["contracts"][1]["puts"]["valuationData"]) == ["exerciseProbability", "rho"]
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils.singleflight import SingleFlight, single_flight, async_single_flight
+
+
+def test_single_flight_coalesce():
+    sf = SingleFlight()
+    calls = []
+    results = []
+
+    def fetch(symbol):
+        calls.append(symbol)
+        time.sleep(0.2)
+        return {"symbol": symbol}
+
+    def worker():
+        results.append(sf.do(("history", "T"), fetch, "T"))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert len(results) == 8
+    assert all(r is results[0] for r in results)
+    assert sf.in_flight() == 0
+
+    # not a cache, the next call fetches again
+    sf.do(("history", "T"), fetch, "T")
+    assert len(calls) == 2
+
+
+def test_single_flight_error():
+    sf = SingleFlight()
+    errors = []
+
+    def fetch():
+        time.sleep(0.2)
+        raise ValueError("upstream failed")
+
+    def worker():
+        try:
+            sf.do("key", fetch)
+        except ValueError as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(errors) == 4
+    assert sf.in_flight() == 0
+
+
+def test_single_flight_decorator():
+    calls = []
+
+    @single_flight
+    def fetch(symbol, period="1y"):
+        calls.append((symbol, period))
+        time.sleep(0.2)
+        return len(calls)
+
+    threads = [threading.Thread(target=fetch, args=("T",)),
+               threading.Thread(target=fetch, args=("T", "1y")),
+               threading.Thread(target=fetch, kwargs={"symbol": "T", "period": "1y"}),
+               threading.Thread(target=fetch, args=("T", "1mo"))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(calls) == [("T", "1mo"), ("T", "1y")]
+
+    with pytest.raises(TypeError):
+        fetch()
+
+
+def test_async_single_flight():
+    calls = []
+
+    @async_single_flight
+    async def fetch(symbol, period="1y"):
+        calls.append((symbol, period))
+        await asyncio.sleep(0.1)
+        return {"symbol": symbol}
+
+    async def main():
+        return await asyncio.gather(fetch("T"), fetch("T", "1y"), fetch(symbol="T"), fetch("T", "1mo"))
+
+    results = asyncio.run(main())
+    assert sorted(calls) == [("T", "1mo"), ("T", "1y")]
+    assert results[0] is results[1] is results[2]
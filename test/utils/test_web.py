@@ -0,0 +1,116 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utils import web
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fail_cnt = 0
+    client_ports = set()
+    post_cnt = 0
+
+    def do_GET(self):
+        _Handler.client_ports.add(self.client_address[1])
+        if _Handler.fail_cnt > 0:
+            _Handler.fail_cnt -= 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = b"Date,Close\n01/02/2024,\"1,234.5\"\n"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        _Handler.post_cnt += 1
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(web, "HTTP_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(web, "_session", None)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    t = threading.Thread(target=httpd.serve_forever, daemon=True)
+    t.start()
+    _Handler.fail_cnt = 0
+    _Handler.client_ports = set()
+    _Handler.post_cnt = 0
+    yield "http://127.0.0.1:{port}/".format(port=httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_send_request_keep_alive(server):
+    for _ in range(5):
+        ret, content = web.send_request(server)
+        assert ret == 0
+        assert "1,234.5" in content
+
+    # all requests went through one pooled connection
+    assert len(_Handler.client_ports) == 1
+
+
+def test_send_request_retry(server):
+    _Handler.fail_cnt = 2
+    ret, content = web.send_request(server)
+    assert ret == 0
+
+    _Handler.fail_cnt = web.HTTP_RETRY_TOTAL + 1
+    ret, content = web.send_request(server)
+    assert ret == 503
+
+
+def test_post_not_retried(server):
+    # an upload may not be idempotent, the callers retry on their own
+    res = web.http_post(server, b'{"a": 1}', headers={"content-type": "application/json"})
+    assert res.status_code == 503
+    assert _Handler.post_cnt == 1
+
+
+def test_post_async_not_retried(server):
+    ret, _ = asyncio.run(web.send_post_async(server, {"content-type": "application/json"}, b'{"a": 1}'))
+    assert ret == -2
+    assert _Handler.post_cnt == 1
+
+
+def test_async_client_per_loop():
+    async def client():
+        return web.get_async_client()
+
+    # each asyncio.run is a new loop with its own client
+    assert asyncio.run(client()) is not asyncio.run(client())
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(client()) is loop.run_until_complete(client())
+    finally:
+        loop.close()
+
+
+def test_send_request_async(server):
+    async def main():
+        results = []
+        for _ in range(3):
+            results.append(await web.send_request_async(server))
+        return results
+
+    for ret, content in asyncio.run(main()):
+        assert ret == 0
+        assert "1,234.5" in content
+
+    _Handler.fail_cnt = 1
+    ret, content = asyncio.run(web.send_request_async(server))
+    assert ret == 0
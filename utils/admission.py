@@ -0,0 +1,130 @@
+import os
+import math
+import time
+import threading
+import contextlib
+
+from utils import executors, metrics
+
+
+# admission settings, can be overridden by env; work is counted in the units of the valuation rate limit
+ADMISSION_DEGRADE_IN_FLIGHT = int(os.environ.get("ADMISSION_DEGRADE_IN_FLIGHT", "16"))  # more is admitted degraded
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "48"))  # more is rejected
+ADMISSION_DEGRADE_QUEUE_WAIT = float(os.environ.get("ADMISSION_DEGRADE_QUEUE_WAIT", "2"))  # seconds
+ADMISSION_MAX_QUEUE_WAIT = float(os.environ.get("ADMISSION_MAX_QUEUE_WAIT", "10"))  # seconds
+ADMISSION_QUEUE_WAIT_ALPHA = float(os.environ.get("ADMISSION_QUEUE_WAIT_ALPHA", "0.2"))  # weight of the latest wait
+
+FULL = "full"
+DEGRADED = "degraded"
+
+
+class Overloaded(executors.ExecutorBusy):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, controller, mode, cost):
+        self.controller = controller
+        self.mode = mode
+        self.cost = cost
+        self.admitted = time.monotonic()
+        self.started = False
+        self.released = False
+
+    def timed(self, fn):
+        # fn, recording how long the work waited for an executor once admitted
+        def wrapper(*args, **kwargs):
+            self.controller._start(self)
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    def iterate(self, iterator):
+        # the same for an iterator, from its first next()
+        self.controller._start(self)
+        yield from iterator
+
+    def release(self):
+        # once the work is done or abandoned, more than once is fine
+        self.controller._release(self)
+
+
+class AdmissionController:
+    # tracks the work admitted in this worker process and how long it recently waited for an executor; a request is
+    # admitted in full when idle or below the degrade thresholds, degraded to the cheap mode (costing 1) below the max thresholds,
+    # rejected with Overloaded otherwise; the queue wait only counts while there is work in flight
+    def __init__(self, name, degrade_in_flight, max_in_flight, degrade_queue_wait, max_queue_wait, alpha):
+        self.name = name
+        self.degrade_in_flight = degrade_in_flight
+        self.max_in_flight = max_in_flight
+        self.degrade_queue_wait = degrade_queue_wait
+        self.max_queue_wait = max_queue_wait
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queued = 0
+        self._queue_wait = 0.0
+        self._counters = {"admitted": 0, "degraded": 0, "shed": 0}
+
+    def acquire(self, cost, degrade=True):
+        # a Ticket of mode FULL or DEGRADED, its work is in flight until ticket.release()
+        with self._lock:
+            queue_wait = self._queue_wait if self._in_flight > 0 else 0.0
+            if self._in_flight == 0 or (self._in_flight + cost <= self.degrade_in_flight and
+                                        queue_wait <= self.degrade_queue_wait):
+                mode = FULL
+            elif degrade and self._in_flight + 1 <= self.max_in_flight and queue_wait <= self.max_queue_wait:
+                mode, cost = DEGRADED, 1
+            else:
+                self._counters["shed"] += 1
+                raise Overloaded("{name} is overloaded: {in_flight} in flight, {wait:.1f}s queue wait".format(
+                    name=self.name, in_flight=self._in_flight, wait=queue_wait), max(1, math.ceil(queue_wait)))
+
+            self._in_flight += cost
+            self._queued += 1
+            self._counters["admitted" if mode == FULL else "degraded"] += 1
+            return Ticket(self, mode, cost)
+
+    def _start(self, ticket):
+        with self._lock:
+            if ticket.started:
+                return
+            ticket.started = True
+            self._queued -= 1
+            wait = time.monotonic() - ticket.admitted
+            self._queue_wait += self.alpha * (wait - self._queue_wait)
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if not ticket.started:
+                ticket.started = True
+                self._queued -= 1
+            self._in_flight -= ticket.cost
+
+    @contextlib.contextmanager
+    def admit(self, cost, degrade=True):
+        # acquire() for the duration of a with block
+        ticket = self.acquire(cost, degrade)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def metrics(self):
+        with self._lock:
+            output = dict(self._counters, inFlight=self._in_flight, queueDepth=self._queued,
+                          queueWaitSeconds=round(self._queue_wait, 3), degradeInFlight=self.degrade_in_flight,
+                          maxInFlight=self.max_in_flight)
+        # the executors' tasks running or waiting, of every route
+        output.update({"ioPending": executors.io.pending(), "cpuPending": executors.cpu.pending()})
+        return output
+
+
+valuation = AdmissionController("valuation", ADMISSION_DEGRADE_IN_FLIGHT, ADMISSION_MAX_IN_FLIGHT,
+                                ADMISSION_DEGRADE_QUEUE_WAIT, ADMISSION_MAX_QUEUE_WAIT, ADMISSION_QUEUE_WAIT_ALPHA)
+metrics.register("admission", valuation.metrics)
@@ -0,0 +1,86 @@
+import asyncio
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RateBudget:
+    # hands out request slots at most `rate` per second, shared by every thread and event loop of the process
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # reserve the next slot, returns the seconds to wait for it
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+            return slot - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def crawl_pages(fetch, consume, last_page, concurrency=4, budget=None, first_page=1):
+    # fetch(page) runs for pages [first_page, last_page) with at most `concurrency` pages in flight,
+    # consume(page, result) sees the results in page order and returns False to stop the crawl
+    stopped = threading.Event()
+
+    def run(page):
+        if budget is not None:
+            budget.wait()
+        if stopped.is_set():
+            return None
+        return fetch(page)
+
+    pending = collections.deque()
+    next_page = first_page
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="crawler") as executor:
+        try:
+            while True:
+                while next_page < last_page and len(pending) < concurrency:
+                    pending.append((next_page, executor.submit(run, next_page)))
+                    next_page += 1
+                if len(pending) == 0:
+                    return
+                page, future = pending.popleft()
+                if consume(page, future.result()) is False:
+                    return
+        finally:
+            stopped.set()
+            for _, future in pending:
+                future.cancel()
+
+
+async def crawl_pages_async(fetch, consume, last_page, concurrency=4, budget=None, first_page=1):
+    # same as crawl_pages, fetch(page) is a coroutine function
+    async def run(page):
+        if budget is not None:
+            await budget.wait_async()
+        return await fetch(page)
+
+    pending = collections.deque()
+    next_page = first_page
+    try:
+        while True:
+            while next_page < last_page and len(pending) < concurrency:
+                pending.append((next_page, asyncio.ensure_future(run(next_page))))
+                next_page += 1
+            if len(pending) == 0:
+                return
+            page, task = pending.popleft()
+            if consume(page, await task) is False:
+                return
+    finally:
+        for _, task in pending:
+            task.cancel()
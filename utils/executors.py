@@ -0,0 +1,253 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor
+
+import numpy as np
+
+
+# executor settings, can be overridden by env
+IO_EXECUTOR_WORKERS = int(os.environ.get("IO_EXECUTOR_WORKERS", "16"))  # threads for blocking fetches
+IO_EXECUTOR_QUEUE = int(os.environ.get("IO_EXECUTOR_QUEUE", "64"))  # tasks waiting for a thread, more are rejected
+# web worker processes on the host (gunicorn's own default for -w), each has its own pools: by default they share
+# the cores instead of each starting a process per core
+WEB_CONCURRENCY = max(int(os.environ.get("WEB_CONCURRENCY", "1")), 1)
+CPU_EXECUTOR_WORKERS = int(os.environ.get("CPU_EXECUTOR_WORKERS",
+                                          str(max((os.cpu_count() or 1) // WEB_CONCURRENCY, 1))))  # 0: in the caller
+CPU_EXECUTOR_QUEUE = int(os.environ.get("CPU_EXECUTOR_QUEUE", "32"))  # tasks waiting for a process
+CPU_EXECUTOR_START_METHOD = os.environ.get("CPU_EXECUTOR_START_METHOD", "forkserver")  # don't fork a threaded server
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+def run_inline(fn, *args, **kwargs):
+    # a finished future, for callers that expect one
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as ex:
+        future.set_exception(ex)
+    return future
+
+
+_END = object()
+
+
+class BoundedExecutor:
+    # a lazily created executor per process that rejects new tasks once max_workers + max_queue are pending
+    def __init__(self, name, max_workers, max_queue, new_executor):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._new_executor = new_executor
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._cond = threading.Condition()
+        # (loop, future) of coroutines waiting in submit_async for a free queue slot
+        self._waiters = []
+
+    def _get_executor(self):
+        # called with the condition held, a forked child must not reuse the parent's workers
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = self._new_executor(self.max_workers)
+            self._pid = os.getpid()
+            self._pending = 0
+        return self._executor
+
+    def _done(self, future):
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify()
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        # a slot is free, the submit_async waiters retry
+        with self._cond:
+            waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+
+    def pending(self):
+        with self._cond:
+            return self._pending
+
+    def submit(self, fn, *args, **kwargs):
+        # raises ExecutorBusy if the queue is full
+        return self._submit(0, fn, *args, **kwargs)
+
+    def submit_wait(self, fn, *args, **kwargs):
+        # waits for a free queue slot, for blocking callers that are already off the event loop
+        return self._submit(None, fn, *args, **kwargs)
+
+    def submit_within(self, timeout, fn, *args, **kwargs):
+        # submit_wait, raising ExecutorBusy if no queue slot is free within timeout seconds
+        return self._submit(timeout, fn, *args, **kwargs)
+
+    def _submit(self, timeout, fn, *args, **kwargs):
+        if self.max_workers <= 0:
+            # no workers configured, run in the caller
+            return run_inline(fn, *args, **kwargs)
+
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            executor = self._get_executor()
+            while self._pending >= self.max_workers + self.max_queue:
+                if end is not None and time.monotonic() >= end:
+                    raise ExecutorBusy('{name} executor is busy: {pending} pending'.format(name=self.name,
+                                                                                        pending=self._pending))
+                self._cond.wait(None if end is None else end - time.monotonic())
+            self._pending += 1
+
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except BrokenExecutor:
+            # a worker process died, start a new pool for the next task
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify()
+                if self._executor is executor:
+                    self._executor = None
+            self._wake_waiters()
+            raise
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    async def submit_async(self, fn, *args, **kwargs):
+        # submit_wait for the event loop, the wait for a free queue slot doesn't block it
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                return self.submit(fn, *args, **kwargs)
+            except ExecutorBusy:
+                waiter = loop.create_future()
+                with self._cond:
+                    if self._pending >= self.max_workers + self.max_queue:
+                        self._waiters.append((loop, waiter))
+                    else:
+                        waiter.set_result(None)
+                await waiter
+
+    async def run(self, fn, *args, **kwargs):
+        # await fn(*args, **kwargs) without blocking the event loop
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    async def iterate(self, iterator, admitted=False):
+        # async iterate a blocking iterator, each next() runs on the executor; only the first next() is rejected with
+        # ExecutorBusy (none if admitted, e.g. a part of an admitted batch), a started stream waits for a queue slot
+        # instead of failing partway; once the consumer is done or gone the iterator is closed on the executor too,
+        # after a next() that may still be running on it
+        future = None
+        try:
+            while True:
+                if future is None and not admitted:
+                    future = self.submit(next, iterator, _END)
+                else:
+                    future = await self.submit_async(next, iterator, _END)
+                item = await asyncio.wrap_future(future)
+                if item is _END:
+                    return
+                yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                if future is not None and not future.done():
+                    future.add_done_callback(lambda f: close())
+                else:
+                    try:
+                        self.submit(close)
+                    except ExecutorBusy:
+                        close()
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def new_thread_pool(max_workers):
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="io")
+
+
+def init_process_worker():
+    # a forked worker starts with the parent's random state, monte carlo tasks must not share it
+    np.random.seed()
+
+
+def new_process_pool(max_workers):
+    try:
+        context = multiprocessing.get_context(CPU_EXECUTOR_START_METHOD)
+    except ValueError:
+        logging.warning('start method {method} is not available'.format(method=CPU_EXECUTOR_START_METHOD))
+        context = multiprocessing.get_context()
+    # workers attach to the parent's SharedArray blocks, they must report to the parent's resource tracker
+    resource_tracker.ensure_running()
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_process_worker)
+
+
+class SharedArray:
+    # a float64 array in shared memory, a process pool task receives its name and attaches instead of a pickled copy;
+    # the creator release()s it once the tasks are done, a task close()s its attachment
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(self.shape)) * 8, 1))
+        self._owner = True
+        self.array = np.ndarray(self.shape, dtype=np.float64, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        return {"name": self._shm.name, "shape": self.shape}
+
+    def __setstate__(self, state):
+        self.shape = state["shape"]
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._owner = False
+        self.array = np.ndarray(self.shape, dtype=np.float64, buffer=self._shm.buf)
+
+    def close(self):
+        # views of self.array must be dropped before
+        if not self._owner and self.array is not None:
+            self.array = None
+            self._shm.close()
+
+    def release(self):
+        if self._owner and self.array is not None:
+            self.array = None
+            self._shm.close()
+            self._shm.unlink()
+
+
+# blocking I/O (yfinance, scraping) off the event loop
+io = BoundedExecutor("io", IO_EXECUTOR_WORKERS, IO_EXECUTOR_QUEUE, new_thread_pool)
+# CPU bound valuation off the GIL, the task and its arguments must be picklable
+cpu = BoundedExecutor("cpu", CPU_EXECUTOR_WORKERS, CPU_EXECUTOR_QUEUE, new_process_pool)
+
+
+def submit_cpu(fn, *args, **kwargs):
+    # run on the process pool once a queue slot is free, or in the caller if the pool is broken
+    try:
+        return cpu.submit_wait(fn, *args, **kwargs)
+    except BrokenExecutor:
+        return run_inline(fn, *args, **kwargs)
+
+
+def submit_cpu_within(timeout, fn, *args, **kwargs):
+    # submit_cpu waiting at most timeout seconds for a queue slot, the future then fails with ExecutorBusy
+    try:
+        return cpu.submit_within(timeout, fn, *args, **kwargs)
+    except ExecutorBusy as ex:
+        future = Future()
+        future.set_exception(ex)
+        return future
+    except BrokenExecutor:
+        return run_inline(fn, *args, **kwargs)
@@ -0,0 +1,156 @@
+import os
+import hashlib
+from datetime import datetime, time, timedelta, timezone
+from email.utils import format_datetime
+from urllib.parse import parse_qsl
+from zoneinfo import ZoneInfo
+
+from starlette.datastructures import Headers, MutableHeaders
+
+
+# Cache-Control settings, can be overridden by env
+CACHE_OPEN_MAX_AGE = int(os.environ.get("CACHE_OPEN_MAX_AGE", "60"))  # seconds, while quotes move
+CACHE_OPEN_STALE_WHILE_REVALIDATE = int(os.environ.get("CACHE_OPEN_STALE_WHILE_REVALIDATE", "30"))
+CACHE_CLOSED_MAX_AGE = int(os.environ.get("CACHE_CLOSED_MAX_AGE", "21600"))  # at most, it ends at the next open
+CACHE_CLOSED_STALE_WHILE_REVALIDATE = int(os.environ.get("CACHE_CLOSED_STALE_WHILE_REVALIDATE", "3600"))
+CACHE_PATH_PREFIXES = ("/option/", "/stock/")
+# set by a route on a response that must not be reused, e.g. the empty result of a failed upstream fetch; the
+# middleware keeps a route's own Cache-Control
+NO_STORE = {"Cache-Control": "no-store"}
+# paths whose data doesn't follow the trading session, e.g. yearly and quarterly reports
+CACHE_CLOSED_PATHS = ("/stock/benford-law",)
+
+MARKET_TIMEZONE = ZoneInfo("America/New_York")
+MARKET_OPEN = time(9, 30)
+MARKET_CLOSE = time(16, 30)  # the 16:00 close, and a while for the last prints and chains to settle
+
+
+def etag(*parts):
+    # a weak validator, the gzip middleware may re-encode the body
+    digest = hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+    return 'W/"{digest}"'.format(digest=digest[:32])
+
+
+def http_date(value):
+    # datetime or pandas Timestamp, naive ones are taken as UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc).replace(microsecond=0), usegmt=True)
+
+
+def if_none_match(headers, current_etag):
+    # weak comparison of the If-None-Match list, see RFC 9110 13.1.2
+    value = headers.get("if-none-match")
+    if not value:
+        return False
+    if value.strip() == "*":
+        return True
+
+    def opaque(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return opaque(current_etag) in [opaque(tag) for tag in value.split(",")]
+
+
+def market_open(now):
+    # regular NYSE session on weekdays, exchange holidays are treated as trading days
+    now = now.astimezone(MARKET_TIMEZONE)
+    return now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE
+
+
+def next_market_open(now):
+    now = now.astimezone(MARKET_TIMEZONE)
+    next_open = datetime.combine(now.date(), MARKET_OPEN, tzinfo=MARKET_TIMEZONE)
+    if now.time() >= MARKET_OPEN:
+        next_open += timedelta(days=1)
+    while next_open.weekday() >= 5:
+        next_open += timedelta(days=1)
+    return next_open
+
+
+def seconds_to_market_open(now):
+    return int((next_market_open(now) - now).total_seconds())
+
+
+def cache_control(path, now=None):
+    # short lived while the market is open; after the close until the next open, at most CACHE_CLOSED_MAX_AGE
+    now = now or datetime.now(timezone.utc)
+    if path.startswith(CACHE_CLOSED_PATHS):
+        max_age, stale = CACHE_CLOSED_MAX_AGE, CACHE_CLOSED_STALE_WHILE_REVALIDATE
+    elif market_open(now):
+        max_age, stale = CACHE_OPEN_MAX_AGE, CACHE_OPEN_STALE_WHILE_REVALIDATE
+    else:
+        max_age = max(min(seconds_to_market_open(now), CACHE_CLOSED_MAX_AGE), CACHE_OPEN_MAX_AGE)
+        stale = CACHE_CLOSED_STALE_WHILE_REVALIDATE
+    return "public, max-age={max_age}, stale-while-revalidate={stale}".format(max_age=max_age, stale=stale)
+
+
+def data_version(now=None):
+    # upstream quotes are taken as unchanged within a CACHE_OPEN_MAX_AGE window of the session, and from the close
+    # until the next open
+    now = now or datetime.now(timezone.utc)
+    if market_open(now):
+        return "open-{window}".format(window=int(now.timestamp()) // max(CACHE_OPEN_MAX_AGE, 1))
+    return "closed-{next_open}".format(next_open=int(next_market_open(now).timestamp()))
+
+
+def canonical_query(query_string):
+    # the same parameters in any order are the same query
+    return tuple(sorted(parse_qsl(query_string.decode("latin-1"), keep_blank_values=True)))
+
+
+class CacheControlMiddleware:
+    # adds Cache-Control to the GET responses under CACHE_PATH_PREFIXES, and to a whole (not streamed) 200 response
+    # without an ETag of its own an ETag from the canonical query and the body's digest; a matching If-None-Match
+    # then gets a 304 instead of the body
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or not scope["path"].startswith(CACHE_PATH_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_with_cache_headers(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                if message["status"] not in (200, 304):
+                    await send(message)
+                    return
+                headers = MutableHeaders(scope=message)
+                if "cache-control" not in headers:
+                    headers["Cache-Control"] = cache_control(scope["path"])
+                if message["status"] == 304 or "etag" in headers:
+                    await send(message)
+                    return
+                # wait for the body
+                start = message
+                return
+
+            if start is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            response_start, start = start, None
+            if message.get("more_body", False):
+                # streamed, there is no digest before the end
+                await send(response_start)
+                await send(message)
+                return
+
+            headers = MutableHeaders(scope=response_start)
+            headers["ETag"] = etag(scope["path"], canonical_query(scope["query_string"]),
+                                   hashlib.sha1(message.get("body", b"")).hexdigest())
+            if if_none_match(Headers(scope=scope), headers["ETag"]):
+                response_start["status"] = 304
+                del headers["content-length"]
+                await send(response_start)
+                await send({"type": "http.response.body", "body": b""})
+                return
+            await send(response_start)
+            await send(message)
+
+        await self.app(scope, receive, send_with_cache_headers)
@@ -0,0 +1,17 @@
+import os
+
+
+_sources = {}
+
+
+def register(name, source):
+    # source() returns a json serializable dict, read on every snapshot
+    _sources[name] = source
+
+
+def snapshot():
+    # the values are this worker process's, the pid tells the gunicorn workers apart
+    output = {"pid": os.getpid()}
+    for name, source in _sources.items():
+        output[name] = source()
+    return output
@@ -0,0 +1,129 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+import traceback
+
+
+# another worker's stores only show up in this process's size estimate when the directory is scanned again
+CACHE_RESCAN_SECONDS = float(os.environ.get("CACHE_RESCAN_SECONDS", "60"))
+
+
+class DiskLRUCache:
+    # bytes values in one file per key under a local directory, so every worker process on the host shares them;
+    # a file's mtime is its last use, the least recently used files are removed once the directory holds more than
+    # max_bytes (down to low_water of it, so a full cache is not scanned on every store), a value larger than
+    # max_entry_bytes is not stored
+    def __init__(self, directory, max_bytes, max_entry_bytes, low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        # running estimate of the directory's bytes, None until the first scan
+        self._bytes = None
+        self._scanned = 0.0
+        self._counters = {"hits": 0, "misses": 0, "stores": 0, "rejects": 0, "evictions": 0, "hitBytes": 0,
+                          "storedBytes": 0}
+        if self.enabled():
+            os.makedirs(directory, exist_ok=True)
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode("utf-8")).hexdigest())
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def get(self, key):
+        if not self.enabled():
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self._count("misses")
+            return None
+        except OSError:
+            logging.error(traceback.format_exc())
+            self._count("misses")
+            return None
+
+        self._count("hits")
+        self._count("hitBytes", len(value))
+        return value
+
+    def put(self, key, value):
+        if not self.enabled():
+            return False
+        if len(value) > self.max_entry_bytes:
+            self._count("rejects")
+            return False
+
+        path = self._path(key)
+        try:
+            # readers never see a partial file
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(temp_path, path)
+        except OSError:
+            logging.error(traceback.format_exc())
+            return False
+
+        self._count("stores")
+        self._count("storedBytes", len(value))
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += len(value)
+            scan = self._bytes is None or self._bytes > self.max_bytes or \
+                time.monotonic() - self._scanned > CACHE_RESCAN_SECONDS
+        if scan:
+            self.evict()
+        return True
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(".tmp-"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # removed by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * self.low_water:
+                    break
+                try:
+                    os.remove(path)
+                    self._count("evictions")
+                except FileNotFoundError:
+                    pass
+                total -= size
+        with self._lock:
+            self._bytes = total
+            self._scanned = time.monotonic()
+
+    def metrics(self):
+        # the counters are this process's, entries and bytes are the shared directory's
+        with self._lock:
+            output = dict(self._counters)
+        entries = self._entries() if self.enabled() else []
+        output.update({"entries": len(entries), "bytes": sum(size for _, size, _ in entries),
+                       "maxBytes": self.max_bytes, "maxEntryBytes": self.max_entry_bytes})
+        return output
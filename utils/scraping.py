@@ -0,0 +1,61 @@
+from lxml import etree
+
+
+# dividend.com /api/t2/body.html table, a row is
+# NAME | YIELD | DIV | FREQ | DEC-DATE | EX-DATE | PAY-DATE | AMOUNT | LAST_AMOUNT
+DIVIDEND_COM_ROWS = etree.XPath('//div[@class="mp-table-body-row"]')
+# the 4 elements after the 2nd div of the row (in document order): <a href=link>, ..., ..., symbol
+DIVIDEND_COM_NAME_CELLS = etree.XPath('((.//div)[2]/descendant::* | (.//div)[2]/following::*)[position() <= 4]')
+# the 2 elements after the 6th div of the row: month/day, year
+DIVIDEND_COM_EX_DATE_CELLS = etree.XPath('((.//div)[6]/descendant::* | (.//div)[6]/following::*)[position() <= 2]')
+
+# macrotrends.net historical data table, the first row is the header
+MACROTRENDS_TABLE = etree.XPath('(//table[@class="historical_data_table table"])[1]')
+TABLE_ROWS = etree.XPath('.//tr')
+TABLE_CELLS = etree.XPath('.//td')
+
+
+def parse_html(content):
+    # parse the page once, None for an empty page
+    if not content:
+        return None
+    try:
+        return etree.HTML(content)
+    except ValueError:
+        # lxml refuses str input with an xml encoding declaration
+        return etree.HTML(content.encode('utf-8'))
+
+
+def dividend_com_rows(content):
+    # [(link href, symbol, ex-date month/day, ex-date year)], a missing cell is None
+    dom = parse_html(content)
+    if dom is None:
+        return []
+
+    output = []
+    for row in DIVIDEND_COM_ROWS(dom):
+        href = symbol = month_day = year = None
+        name_cells = DIVIDEND_COM_NAME_CELLS(row)
+        if len(name_cells) == 4:
+            href = name_cells[0].get('href')
+            symbol = name_cells[3].text
+        ex_date_cells = DIVIDEND_COM_EX_DATE_CELLS(row)
+        if len(ex_date_cells) == 2:
+            month_day = ex_date_cells[0].text
+            year = ex_date_cells[1].text
+        output.append((href, symbol, month_day, year))
+
+    return output
+
+
+def macrotrends_table_rows(content):
+    # cell texts of every row of the historical data table, None if the page has no such table
+    dom = parse_html(content)
+    if dom is None:
+        return None
+
+    tables = MACROTRENDS_TABLE(dom)
+    if len(tables) == 0:
+        return None
+
+    return [[td.text for td in TABLE_CELLS(row)] for row in TABLE_ROWS(tables[0])]
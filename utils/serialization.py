@@ -0,0 +1,96 @@
+import typing
+
+import numpy as np
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def default(obj):
+    # numpy scalars orjson doesn't encode natively, e.g. longdouble from the binomial tree
+    if isinstance(obj, np.generic):
+        return float(obj) if isinstance(obj, np.floating) else obj.item()
+    raise TypeError
+
+
+def dumps(content):
+    # NaN and inf are encoded as null, the same as pydantic's model_dump_json
+    return orjson.dumps(content, default=default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def dumps_line(content):
+    return orjson.dumps(content, default=default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+
+
+class NumpyJSONResponse(JSONResponse):
+    # for content already shaped like the route's response_model: it is encoded as is, without validating it again
+    def render(self, content):
+        return dumps(content)
+
+
+def field_type(annotation):
+    # Optional[X] -> X
+    args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+    if typing.get_origin(annotation) is typing.Union and len(args) == 1:
+        return args[0]
+    return annotation
+
+
+def columns_to_model_records(model, columns):
+    # rows of `model` from a dict of numpy columns, a nested model field from a nested dict of columns;
+    # only the model's fields in its order, int and float fields cast as pydantic would and a missing optional
+    # column as None, so the rows encode the same as the validated models would
+    lengths = [len(column) for column in columns.values() if not isinstance(column, dict)]
+    if len(lengths) == 0:
+        return []
+
+    values = []
+    for name, field in model.model_fields.items():
+        annotation = field_type(field.annotation)
+        column = columns.get(name)
+        if column is None:
+            if field.is_required():
+                raise KeyError(name)
+            values.append([None] * lengths[0])
+        elif isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            values.append(columns_to_model_records(annotation, column))
+        elif annotation is int:
+            values.append(np.asarray(column).astype(np.int64).tolist())
+        elif annotation is float:
+            values.append(np.asarray(column, dtype=np.float64).tolist())
+        else:
+            values.append(np.asarray(column).tolist())
+
+    names = list(model.model_fields)
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+
+def columns_to_model_columns(model, columns):
+    # the struct of arrays counterpart of columns_to_model_records: one array per field, numeric columns are handed
+    # to orjson as contiguous numpy arrays; a missing optional field is None, an empty side has empty arrays
+    lengths = [len(column) for column in columns.values() if not isinstance(column, dict)]
+
+    output = {}
+    for name, field in model.model_fields.items():
+        annotation = field_type(field.annotation)
+        column = columns.get(name)
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            output[name] = columns_to_model_columns(annotation, column) if column is not None else None
+        elif len(lengths) == 0:
+            output[name] = []
+        elif column is None:
+            if field.is_required():
+                raise KeyError(name)
+            output[name] = None
+        elif annotation is int:
+            output[name] = np.ascontiguousarray(column, dtype=np.int64)
+        elif annotation is float:
+            output[name] = np.ascontiguousarray(column, dtype=np.float64)
+        else:
+            output[name] = np.asarray(column).tolist()
+
+    return output
+
+
+# records, a list of model dicts; columnar, a list per model field
+LAYOUTS = {"records": columns_to_model_records, "columnar": columns_to_model_columns}
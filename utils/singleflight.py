@@ -0,0 +1,112 @@
+import asyncio
+import functools
+import inspect
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # concurrent callers asking for the same key share one in-flight call instead of each running it,
+    # the result is not cached: once the call returns, the next caller runs it again
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    # asyncio flavor of SingleFlight, callers share one task per key on the same event loop
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        task = self._calls.get((loop, key))
+        if task is None:
+            task = loop.create_task(fn(*args, **kwargs))
+            self._calls[(loop, key)] = task
+            task.add_done_callback(lambda _: self._calls.pop((loop, key), None))
+
+        # a cancelled caller must not cancel the fetch the other callers are waiting for
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+group = SingleFlight()
+async_group = AsyncSingleFlight()
+
+
+def _flight_key(fn, signature, args, kwargs):
+    # bind the arguments, so f(x, 1) and f(x, n=1) join the same flight
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    key = (fn.__module__, fn.__qualname__, tuple(bound.arguments.items()))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def single_flight(fn):
+    # the returned value is shared by every caller of the same flight, callers must not mutate it
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = _flight_key(fn, signature, args, kwargs)
+        if key is None:
+            return fn(*args, **kwargs)
+        return group.do(key, fn, *args, **kwargs)
+
+    return wrapper
+
+
+def async_single_flight(fn):
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        key = _flight_key(fn, signature, args, kwargs)
+        if key is None:
+            return await fn(*args, **kwargs)
+        return await async_group.do(key, fn, *args, **kwargs)
+
+    return wrapper
@@ -1,13 +1,71 @@
+import os
+import asyncio
 import logging
+import threading
 import traceback
+import weakref
 
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
 
 
-def send_request(url):
+# pooled http client settings, can be overridden by env
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "10"))  # number of hosts kept in the pool
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "10"))  # keep-alive connections per host
+HTTP_POOL_BLOCK = os.environ.get("HTTP_POOL_BLOCK", "true").lower() == "true"  # wait instead of exceeding maxsize
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "30"))
+HTTP_RETRY_TOTAL = int(os.environ.get("HTTP_RETRY_TOTAL", "3"))
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", "0.5"))  # sleep backoff * 2^(retry-1) seconds
+HTTP_RETRY_STATUS = [429, 500, 502, 503, 504]
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def new_session():
+    # only urllib3's default idempotent methods are retried: POSTs upload data (the cron jobs to AF_URL) and their
+    # callers already retry in their own loops
+    retry = Retry(total=HTTP_RETRY_TOTAL, backoff_factor=HTTP_RETRY_BACKOFF, status_forcelist=HTTP_RETRY_STATUS,
+                  respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                          pool_block=HTTP_POOL_BLOCK, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    # one session per process, a forked gunicorn worker must not reuse the parent's sockets
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = new_session()
+                _session_pid = pid
+    return _session
+
+
+def http_get(url, headers=None, timeout=None, **kwargs):
+    return get_session().get(url, headers=headers, timeout=timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                             **kwargs)
+
+
+def http_post(url, data=None, headers=None, timeout=None, **kwargs):
+    return get_session().post(url, data, headers=headers,
+                              timeout=timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), **kwargs)
+
+
+def send_request(url, headers=None):
     try:
-        res = requests.get(url)
+        res = http_get(url, headers=headers)
         res.raise_for_status()
     except HTTPError as http_err:
         logging.error(f'HTTP error occurred: {http_err}')
@@ -21,7 +79,7 @@ def send_request(url):
 
 def send_post(url, headers, req_data):
     try:
-        res = requests.post(url, req_data, headers=headers)
+        res = http_post(url, req_data, headers=headers)
         res.raise_for_status()
     except HTTPError as http_err:
         logging.error(f'HTTP error occurred: {http_err}')
@@ -31,3 +89,61 @@ def send_post(url, headers, req_data):
         return -1, ex
 
     return 0, res.text
+
+
+def new_async_client():
+    # httpx only retries failed connects at the transport level, status retries are done in send_*_async
+    limits = httpx.Limits(max_connections=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE,
+                          max_keepalive_connections=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE)
+    timeout = httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    transport = httpx.AsyncHTTPTransport(limits=limits, retries=HTTP_RETRY_TOTAL)
+    return httpx.AsyncClient(transport=transport, timeout=timeout, follow_redirects=True)
+
+
+def get_async_client():
+    # an AsyncClient is bound to the event loop it was first used on, one per loop and dropped with it
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _async_clients[loop] = new_async_client()
+    return client
+
+
+async def http_request_async(method, url, **kwargs):
+    # as the sync session, only idempotent methods are retried on a status
+    res = None
+    for retry_i in range(HTTP_RETRY_TOTAL + 1):
+        res = await get_async_client().request(method, url, **kwargs)
+        if res.status_code not in HTTP_RETRY_STATUS or method.upper() not in Retry.DEFAULT_ALLOWED_METHODS or \
+                retry_i == HTTP_RETRY_TOTAL:
+            break
+        await asyncio.sleep(HTTP_RETRY_BACKOFF * (2 ** retry_i))
+    return res
+
+
+async def send_request_async(url, headers=None):
+    try:
+        res = await http_request_async("GET", url, headers=headers)
+        res.raise_for_status()
+    except httpx.HTTPStatusError as http_err:
+        logging.error(f'HTTP error occurred: {http_err}')
+        return res.status_code, http_err
+    except Exception as ex:
+        logging.error(traceback.format_exc())
+        return -1, ex
+
+    return 0, res.text
+
+
+async def send_post_async(url, headers, req_data):
+    try:
+        res = await http_request_async("POST", url, content=req_data, headers=headers)
+        res.raise_for_status()
+    except httpx.HTTPStatusError as http_err:
+        logging.error(f'HTTP error occurred: {http_err}')
+        return -2, http_err
+    except Exception as ex:
+        logging.error(traceback.format_exc())
+        return -1, ex
+
+    return 0, res.text
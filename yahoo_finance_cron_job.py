@@ -4,7 +4,6 @@ import json
 import pathlib
 import time
 import logging
-import requests
 import traceback
 from datetime import datetime
 from urllib.parse import urlencode
@@ -14,6 +13,7 @@ from urllib.parse import urlencode
 
 from models import formula
 from models import stock
+from utils import web
 
 
 afscreener_url = os.environ.get("AF_URL", "")
@@ -32,7 +32,7 @@ def send_request(url, retry):
     for r in range(retry):
         try:
             headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/105.0.0.0 Safari/537.36"}
-            res = requests.get(url, headers=headers)
+            res = web.http_get(url, headers=headers)
             res.raise_for_status()
             if res.status_code == 200:
                 return 0, res.text
@@ -56,7 +56,7 @@ def send_yahoo_request(url, retry):
                 "Connection": "keep-alive",
                 "Upgrade-Insecure-Requests": "1",
             }
-            res = requests.get(url, headers=headers)
+            res = web.http_get(url, headers=headers)
             res.raise_for_status()
             if res.status_code == 200:
                 return 0, res.text
@@ -73,7 +73,7 @@ def send_post_json(url, retry, req_data):
     for r in range(retry):
         try:
             headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/105.0.0.0 Safari/537.36"}
-            res = requests.post(url, req_data, headers=headers)
+            res = web.http_post(url, req_data, headers=headers)
             res.raise_for_status()
             if res.status_code == 200:
                 return 0, res.text